@@ -0,0 +1,163 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from db_wrapper import DBWrapper, concat_trade_logs
+from deribit_api_wrapper import DeribitApiWrapper
+from pnl_calc import PnLCalculator
+from utils import *
+
+
+def _select_accounts(config, names=None):
+    accounts = get_accounts(config)
+    if names is None:
+        return accounts
+    unknown = set(names) - {account['name'] for account in accounts}
+    if unknown:
+        raise Exception(f"Unknown accounts: {sorted(unknown)}")
+    return [account for account in accounts if account['name'] in names]
+
+
+def _sync_account(config, account, start_range):
+    # the wrappers are created by the thread using them, each account syncs on its own connection, the
+    # database is also read by the coroutines running on the event loop thread of the API wrapper
+    db_wrapper = DBWrapper(config['db_path'], check_same_thread=False, account=account['name'])
+    deribit_wrapper = DeribitApiWrapper(config, account)
+    try:
+        pnl_calc = PnLCalculator(config, deribit_wrapper, db_wrapper, start_range, None,
+                                 sync_on_load=False, trades=pd.DataFrame())
+        pnl_calc.sync_transactions()
+        return db_wrapper.get_sync_checkpoints()
+    finally:
+        deribit_wrapper.stop()
+        db_wrapper.conn.close()
+
+
+def sync_accounts(config, start_range, names=None):
+    """
+    Syncs the transaction logs and position snapshots of the accounts concurrently, one thread and
+    websocket connection per account. The refresh takes as long as the slowest account.
+
+    Args:
+        config (dict): Configuration with the 'deribit' accounts.
+        start_range (datetime): Start of the history to backfill.
+        names (list): Names of the accounts to sync, defaults to all the accounts of the config.
+
+    Returns:
+        checkpoints (dict): Sync checkpoints by currency, by account name.
+    """
+    accounts = _select_accounts(config, names)
+    with ThreadPoolExecutor(max_workers=len(accounts), thread_name_prefix='sync') as executor:
+        futures = {account['name']: executor.submit(_sync_account, config, account, start_range) for account in accounts}
+        return {name: future.result() for name, future in futures.items()}
+
+
+def _compute_account(config, account, start_range, end_range, streaming=False):
+    db_wrapper = DBWrapper(config['db_path'], check_same_thread=False, account=account['name'])
+    deribit_wrapper = DeribitApiWrapper(config, account)
+    try:
+        pnl_calc = PnLCalculator(config, deribit_wrapper, db_wrapper, start_range, end_range,
+                                 sync_on_load=False, streaming=streaming)
+        positions = pnl_calc.update_pnl()
+        return (pnl_calc._get_trades().assign(account=account['name']), positions.assign(account=account['name']),
+                pnl_calc.pnl_by_instrument.reset_index().assign(account=account['name']))
+    finally:
+        deribit_wrapper.stop()
+        db_wrapper.conn.close()
+
+
+def compute_accounts(config, start_range, end_range, names=None, processes=None, streaming=False):
+    """
+    Computes the PnL of the accounts in parallel, one process per account up to the number of CPUs.
+    The transaction logs are read from the database, see sync_accounts.
+
+    Args:
+        config (dict): Configuration with the 'deribit' accounts.
+        start_range (datetime): Start date for PnL calculations.
+        end_range (datetime): End date for PnL calculations.
+        names (list): Names of the accounts to compute, defaults to all the accounts of the config.
+        processes (int): Maximum number of worker processes, defaults to the number of CPUs.
+        streaming (bool): Whether the trades are streamed in chunks instead of loaded, see PnLCalculator.stream_pnl.
+                          The trades are then not returned.
+
+    Returns:
+        trades (pd.DataFrame): Trades with their PnL, with the 'account' of each trade.
+        positions (pd.DataFrame): Positions by account and instrument.
+        pnl_by_instrument (pd.DataFrame): PnL of the trades by account and instrument.
+    """
+    accounts = _select_accounts(config, names)
+    if len(accounts) == 1:
+        # a single account is computed in process
+        results = [_compute_account(config, accounts[0], start_range, end_range, streaming)]
+    else:
+        with ProcessPoolExecutor(max_workers=min(processes or os.cpu_count(), len(accounts))) as executor:
+            futures = [executor.submit(_compute_account, config, account, start_range, end_range, streaming)
+                       for account in accounts]
+            results = [future.result() for future in futures]
+    return tuple(concat_trade_logs(frames) for frames in zip(*results))
+
+
+def _load_account(config, account, start_range, end_range):
+    db_wrapper = DBWrapper(config['db_path'], account=account['name'])
+    try:
+        pnl_calc = PnLCalculator(config, None, db_wrapper, start_range, end_range, sync_on_load=False)
+        return pnl_calc._get_trades(), pnl_calc.get_opening_positions()
+    finally:
+        db_wrapper.conn.close()
+
+
+def load_accounts(config, start_range, end_range, names=None, executor=None):
+    """
+    Loads the processed trades and the opening positions of the accounts in parallel, one process per
+    account, e.g. for a process keeping them in memory across price updates. The transaction logs are
+    read from the database, see sync_accounts.
+
+    Args:
+        config (dict): Configuration with the 'deribit' accounts.
+        start_range (datetime): Start date for PnL calculations.
+        end_range (datetime): End date for PnL calculations.
+        names (list): Names of the accounts to load, defaults to all the accounts of the config.
+        executor (concurrent.futures.Executor): Pool running the loads, a process pool of the size of
+                                                compute_accounts is created when None.
+
+    Returns:
+        loaded (dict): Trades and opening positions, see PnLCalculator.get_opening_positions, by account name.
+    """
+    accounts = _select_accounts(config, names)
+    if len(accounts) == 1:
+        # a single account is loaded in process
+        return {accounts[0]['name']: _load_account(config, accounts[0], start_range, end_range)}
+    if executor is None:
+        with ProcessPoolExecutor(max_workers=min(os.cpu_count(), len(accounts))) as executor:
+            return load_accounts(config, start_range, end_range, names, executor)
+    futures = {account['name']: executor.submit(_load_account, config, account, start_range, end_range)
+               for account in accounts}
+    return {name: future.result() for name, future in futures.items()}
+
+
+def firm_positions(positions):
+    """
+    Consolidates the positions of the accounts by instrument. Quantities and PnL are summed, the
+    average prices are weighted by the quantities of each account.
+
+    Args:
+        positions (pd.DataFrame): Positions by account and instrument, see compute_accounts.
+
+    Returns:
+        positions (pd.DataFrame): Firm-level positions by instrument.
+    """
+    if positions.empty:
+        return positions.drop(columns='account', errors='ignore')
+    positions = positions.assign(buy_notional=positions['avg_long'] * positions['buy'],
+                                 sell_notional=positions['avg_short'] * positions['sell'])
+    firm = positions.groupby(['instrument_name', 'currency', 'trade_type'], observed=True, as_index=False)[
+        ['buy', 'sell', 'buy_notional', 'sell_notional', 'realized_pl', 'unrealized_pl']].sum()
+    buy = firm['buy'].to_numpy(dtype=float)
+    sell = firm['sell'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        firm['avg_long'] = np.where(buy > 0, firm['buy_notional'].to_numpy(dtype=float) / buy, 0.0)
+        firm['avg_short'] = np.where(sell > 0, firm['sell_notional'].to_numpy(dtype=float) / sell, 0.0)
+    firm['long/short'] = np.where(buy > sell, 'long', 'short')
+    return firm.drop(columns=['buy_notional', 'sell_notional'])
@@ -0,0 +1,104 @@
+"""
+Columnar archive tier of the transaction logs. DBWrapper compacts the closed months of transaction_logs
+into Parquet files partitioned by account, currency and month, which are read through memory-mapped Arrow.
+"""
+import os
+import time
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.fs
+import pyarrow.parquet as pq
+
+# integer columns of the archive, the other columns declared INTEGER in SQLite can hold text ids
+ARCHIVE_INTEGER_COLUMNS = ['id', 'user_seq', 'timestamp']
+ROW_GROUP_SIZE = 128 * 1024
+
+
+class ParquetArchive():
+    def __init__(self, root, column_types) -> None:
+        """
+        Initializes the ParquetArchive.
+
+        Args:
+            root (str): Directory of the Parquet files.
+            column_types (dict): Declared SQLite type by column of transaction_logs, without the account column.
+        """
+        self.root = root
+        self.schema = pa.schema([(column, pa.int64() if column in ARCHIVE_INTEGER_COLUMNS
+                                          else pa.float64() if column_type == 'REAL' else pa.string())
+                                 for column, column_type in column_types.items()])
+        self._filesystem = pyarrow.fs.LocalFileSystem(use_mmap=True)
+
+    def write(self, df, account, currency, month):
+        """
+        Writes the transaction logs of a partition to a new Parquet file.
+
+        Args:
+            df (pd.DataFrame): Transaction logs of the partition, sorted by timestamp.
+            account (str): Name of the account.
+            currency (str): Currency of the logs.
+            month (str): Month of the logs, 'YYYY-MM'.
+
+        Returns:
+            file (str): Path of the file relative to the archive root.
+        """
+        directory = os.path.join(f"account={account}", f"currency={currency}", f"month={month}")
+        os.makedirs(os.path.join(self.root, directory), exist_ok=True)
+        # a month backfilled after it was archived gets another file
+        file = os.path.join(directory, f"part-{time.time_ns()}.parquet")
+
+        df = df.reindex(columns=self.schema.names)
+        for field in self.schema:
+            if field.type == pa.string():
+                df[field.name] = df[field.name].map(str, na_action='ignore')
+            elif field.type == pa.float64():
+                df[field.name] = pd.to_numeric(df[field.name], errors='coerce')
+        table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+        pq.write_table(table, os.path.join(self.root, file), row_group_size=ROW_GROUP_SIZE)
+        return file
+
+    def remove(self, file):
+        """
+        Removes a file of the archive.
+
+        Args:
+            file (str): Path of the file relative to the archive root.
+        """
+        os.remove(os.path.join(self.root, file))
+
+    def read(self, files, columns=None, start_ts=None, end_ts=None, trades_only=False):
+        """
+        Reads the columns of the logs within a time range from archive files. Only the needed columns are
+        read, and the row groups outside of the range are skipped from their statistics.
+
+        Args:
+            files (list): Paths of the files relative to the archive root.
+            columns (list): Columns to read, all by default.
+            start_ts (int): Start of the range in unix ms, inclusive.
+            end_ts (int): End of the range in unix ms, inclusive.
+            trades_only (bool): Whether to keep only the trades, without the combo legs.
+
+        Returns:
+            table (pa.Table): Logs sorted by timestamp.
+        """
+        columns = list(columns or self.schema.names)
+        dataset = ds.dataset([os.path.join(self.root, file) for file in files], schema=self.schema,
+                             format='parquet', filesystem=self._filesystem)
+        expression = None
+        if start_ts is not None:
+            expression = ds.field('timestamp') >= start_ts
+        if end_ts is not None:
+            expression = _and(expression, ds.field('timestamp') <= end_ts)
+        if trades_only:
+            expression = _and(expression, (ds.field('type') == 'trade')
+                                          & ~pc.match_substring(ds.field('instrument_name'), '_'))
+        read_columns = columns if 'timestamp' in columns else columns + ['timestamp']
+        table = dataset.to_table(columns=read_columns, filter=expression).sort_by('timestamp')
+        return table.select(columns)
+
+
+def _and(expression, other):
+    return other if expression is None else expression & other
@@ -0,0 +1,266 @@
+"""
+Local stand-in for the Deribit websocket API, serving synthetic data over the subset of JSON-RPC used
+by DeribitApiWrapper, with injectable latency and rate limits.
+
+Usage:
+    python -m benchmarks.fake_deribit [--port 8770] [--logs 100000] [--latency 0.005] [--max-credits 5000 --refill-rate 1000]
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import websockets
+
+from benchmarks.synthetic import make_live_prices, make_transaction_logs
+
+# JSON-RPC errors returned by Deribit
+TOO_MANY_REQUESTS = {'code': 10028, 'message': 'too_many_requests'}
+METHOD_NOT_FOUND = {'code': -32601, 'message': 'Method not found'}
+
+
+class FakeDeribitServer():
+    def __init__(self, transaction_logs, live_prices,
+                       latency=0.0, jitter=0.0,
+                       max_credits=None, refill_rate=None, request_cost=500,
+                       tick_interval=None, host='127.0.0.1', port=0) -> None:
+        """
+        Initializes the FakeDeribitServer.
+
+        Args:
+            transaction_logs (pd.DataFrame): Entries served by private/get_transaction_log, e.g. make_transaction_logs().
+            live_prices (dict): Mark prices by instrument name and index prices by currency, e.g. make_live_prices().
+            latency (float): Seconds before every response.
+            jitter (float): Maximum random seconds added to the latency.
+            max_credits (float): Credit bucket of each connection, requests are not limited when None.
+            refill_rate (float): Credits added per second.
+            request_cost (float): Credits consumed by a request.
+            tick_interval (float): Seconds between ticker and price index notifications, only the initial
+                                   notification is sent when None.
+            host (str): Interface to listen on.
+            port (int): Port to listen on, 0 picks a free port.
+        """
+        self.live_prices = dict(live_prices)
+        self.latency = latency
+        self.jitter = jitter
+        self.max_credits = max_credits
+        self.refill_rate = refill_rate
+        self.request_cost = request_cost
+        self.tick_interval = tick_interval
+        self.host = host
+        self.port = port
+        self.request_counts = {}
+        self.rate_limited = 0
+
+        # logs of each currency sorted by timestamp, served newest first like Deribit
+        self._logs = {}
+        for ccy, logs in transaction_logs.groupby('currency'):
+            logs = logs.sort_values('timestamp', kind='mergesort')
+            self._logs[ccy] = (logs['timestamp'].to_numpy(dtype='int64'), json.loads(logs.to_json(orient='records')))
+
+        self._loop = None
+        self._thread = None
+        self._server = None
+
+    @property
+    def url(self):
+        return f"ws://{self.host}:{self.port}"
+
+    def start(self):
+        """
+        Starts the server on its own event loop in a daemon thread.
+
+        Returns:
+            url (str): Websocket url of the server, to use as the 'client_url' of the config.
+        """
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='fake_deribit', daemon=True)
+        self._thread.start()
+        self._server = asyncio.run_coroutine_threadsafe(self._serve(), self._loop).result()
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self.url
+
+    async def _serve(self):
+        return await websockets.serve(self._handler, self.host, self.port)
+
+    def stop(self):
+        """
+        Closes the connections and stops the event loop.
+        """
+        if self._thread is None:
+            return
+        self._server.close()
+        asyncio.run_coroutine_threadsafe(self._server.wait_closed(), self._loop).result(timeout=10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=10)
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    async def _handler(self, websocket):
+        connection = {'credits': self.max_credits, 'updated_at': time.monotonic(), 'channels': set()}
+        tasks = set()
+        if self.tick_interval is not None:
+            tasks.add(asyncio.create_task(self._tick(websocket, connection)))
+        try:
+            async for message in websocket:
+                request = json.loads(message)
+                # requests are answered concurrently, like the pipelined responses of Deribit
+                task = asyncio.create_task(self._respond(websocket, connection, request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _consume_credits(self, connection):
+        if self.max_credits is None:
+            return True
+        now = time.monotonic()
+        connection['credits'] = min(self.max_credits, connection['credits'] + (now - connection['updated_at']) * self.refill_rate)
+        connection['updated_at'] = now
+        if connection['credits'] < self.request_cost:
+            self.rate_limited += 1
+            return False
+        connection['credits'] -= self.request_cost
+        return True
+
+    async def _respond(self, websocket, connection, request):
+        method = request['method']
+        self.request_counts[method] = self.request_counts.get(method, 0) + 1
+        if self.latency or self.jitter:
+            await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+
+        response = {'jsonrpc': '2.0', 'id': request['id']}
+        if not self._consume_credits(connection):
+            response['error'] = TOO_MANY_REQUESTS
+        else:
+            handler = getattr(self, '_' + method.replace('/', '_'), None)
+            if handler is None:
+                response['error'] = METHOD_NOT_FOUND
+            else:
+                response['result'] = handler(connection, request.get('params', {}))
+        try:
+            await websocket.send(json.dumps(response))
+            if method.endswith('/subscribe'):
+                for channel in response.get('result', []):
+                    await self._notify(websocket, channel)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _notify(self, websocket, channel):
+        """
+        Sends the current data of a ticker or price index channel.
+        """
+        parts = channel.split('.')
+        timestamp = int(time.time() * 1000)
+        if parts[0] == 'ticker' and parts[1] in self.live_prices:
+            data = {'instrument_name': parts[1], 'mark_price': self.live_prices[parts[1]], 'timestamp': timestamp}
+        elif parts[0] == 'deribit_price_index':
+            data = {'index_name': parts[1], 'price': self._index_price(parts[1]), 'timestamp': timestamp}
+        else:
+            return
+        await websocket.send(json.dumps({'jsonrpc': '2.0', 'method': 'subscription',
+                                         'params': {'channel': channel, 'data': data}}))
+
+    async def _tick(self, websocket, connection):
+        while True:
+            await asyncio.sleep(self.tick_interval)
+            for channel in list(connection['channels']):
+                name = channel.split('.')[1]
+                if name in self.live_prices:
+                    self.live_prices[name] *= float(np.exp(random.gauss(0, 0.0005)))
+                await self._notify(websocket, channel)
+
+    def _index_price(self, index_name):
+        return self.live_prices.get(index_name.split('_')[0].upper(), 0.0)
+
+    def _public_auth(self, connection, params):
+        return {'access_token': 'access', 'refresh_token': 'refresh', 'expires_in': 900, 'token_type': 'bearer'}
+
+    def _private_get_transaction_log(self, connection, params):
+        timestamps, logs = self._logs.get(params['currency'], (np.array([], dtype='int64'), []))
+        first = np.searchsorted(timestamps, params['start_timestamp'], side='left')
+        last = np.searchsorted(timestamps, params['end_timestamp'], side='right')
+        offset = int(params.get('continuation') or 0)
+        stop = max(first, last - offset - params.get('count', 100))
+        page = logs[stop:last - offset][::-1]
+        return {'logs': page, 'continuation': offset + len(page) if stop > first else None}
+
+    def _public_get_order_book(self, connection, params):
+        instrument = params['instrument_name']
+        return {'instrument_name': instrument, 'mark_price': self.live_prices.get(instrument), 'bids': [], 'asks': [],
+                'timestamp': int(time.time() * 1000)}
+
+    def _public_get_index_price(self, connection, params):
+        return {'index_price': self._index_price(params['index_name']), 'estimated_delivery_price': self._index_price(params['index_name'])}
+
+    def _public_get_book_summary_by_currency(self, connection, params):
+        prefix = f"{params['currency']}-"
+        return [{'instrument_name': name, 'mark_price': price} for name, price in self.live_prices.items()
+                if name.startswith(prefix)]
+
+    def _public_get_delivery_prices(self, connection, params):
+        today = datetime.utcnow().date()
+        offset = params.get('offset') or 0
+        price = self._index_price(params['index_name'])
+        data = [{'date': (today - timedelta(days=offset + i)).strftime('%Y-%m-%d'), 'delivery_price': price}
+                for i in range(params.get('count', 10))]
+        return {'data': data, 'records_total': 10000}
+
+    def _public_get_tradingview_chart_data(self, connection, params):
+        # flat bars at the live price, the perpetuals without a live price follow their index
+        bar_ms = 24 * 60 * 60 * 1000 if params['resolution'] == '1D' else int(params['resolution']) * 60 * 1000
+        instrument = params['instrument_name']
+        price = self.live_prices.get(instrument, self.live_prices.get(instrument.split('-')[0]))
+        ticks = list(range(params['start_timestamp'] // bar_ms * bar_ms, params['end_timestamp'] + 1, bar_ms))
+        return {'ticks': ticks, 'close': [price] * len(ticks), 'status': 'ok' if ticks else 'no_data'}
+
+    def _subscribe(self, connection, params):
+        connection['channels'].update(params['channels'])
+        return params['channels']
+
+    def _unsubscribe(self, connection, params):
+        connection['channels'].difference_update(params['channels'])
+        return params['channels']
+
+    _public_subscribe = _private_subscribe = _subscribe
+    _public_unsubscribe = _private_unsubscribe = _unsubscribe
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8770)
+    parser.add_argument('--logs', type=int, default=100_000, help='synthetic transaction log entries')
+    parser.add_argument('--days', type=int, default=180, help='days of history before now')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before every response')
+    parser.add_argument('--max-credits', type=float, default=None)
+    parser.add_argument('--refill-rate', type=float, default=None)
+    parser.add_argument('--tick-interval', type=float, default=None)
+    args = parser.parse_args()
+
+    logs = make_transaction_logs(args.logs, start=datetime.now() - timedelta(days=args.days))
+    server = FakeDeribitServer(logs, make_live_prices(logs), latency=args.latency,
+                               max_credits=args.max_credits, refill_rate=args.refill_rate,
+                               tick_interval=args.tick_interval, port=args.port)
+    print(f"serving {len(logs)} transaction log entries on {server.start()}, Ctrl+C to stop")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,120 @@
+"""
+Benchmark of the vectorized Greeks of an option book against a scalar Black-76 loop.
+
+Each round moves the live prices, as a price update does, and recomputes the implied volatilities and
+the Greeks of the whole book, without network.
+
+Usage:
+    python -m benchmarks.greeks [--sizes 1000 10000 100000] [--rounds 20] [--scalar-max 10000]
+"""
+import argparse
+import math
+import time
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import make_instruments
+from risk_engine import YEAR_MS, black76, option_greeks
+from utils import datetime_to_unix_ms
+
+
+def scalar_price(forward, strike, time_to_expiry, vol, is_call):
+    """
+    Black-76 price and vega of one option with math.erf, used as the reference.
+    """
+    vol_sqrt_t = vol * math.sqrt(time_to_expiry)
+    d1 = (math.log(forward / strike) + 0.5 * vol_sqrt_t ** 2) / vol_sqrt_t
+    call = forward * 0.5 * (1 + math.erf(d1 / math.sqrt(2))) - strike * 0.5 * (1 + math.erf((d1 - vol_sqrt_t) / math.sqrt(2)))
+    vega = forward * math.exp(-0.5 * d1 * d1) / math.sqrt(2 * math.pi) * math.sqrt(time_to_expiry)
+    return (call if is_call else call - forward + strike), vega
+
+
+def scalar_greeks(price, forward, strike, time_to_expiry, is_call):
+    """
+    Implied volatility and Black-76 Greeks of one option, the loop the vectorized engine replaces.
+    """
+    vol = max(math.sqrt(2 * abs(math.log(forward / strike)) / time_to_expiry), 1e-3)
+    for _ in range(50):
+        model_price, vega = scalar_price(forward, strike, time_to_expiry, vol, is_call)
+        if abs(model_price - price) <= 1e-10 * forward or vega == 0:
+            break
+        vol = min(max(vol - (model_price - price) / vega, 1e-4), 20.0)
+    vol_sqrt_t = vol * math.sqrt(time_to_expiry)
+    d1 = (math.log(forward / strike) + 0.5 * vol_sqrt_t ** 2) / vol_sqrt_t
+    pdf_d1 = math.exp(-0.5 * d1 * d1) / math.sqrt(2 * math.pi)
+    call_delta = 0.5 * (1 + math.erf(d1 / math.sqrt(2)))
+    return {'delta': call_delta if is_call else call_delta - 1.0,
+            'gamma': pdf_d1 / (forward * vol_sqrt_t),
+            'vega': forward * pdf_d1 * math.sqrt(time_to_expiry) / 100.0,
+            'theta': -forward * pdf_d1 * vol / (2 * math.sqrt(time_to_expiry)) / 365.0}
+
+
+def make_book(size, now, now_ms, seed=0):
+    """
+    Builds an option book of about size options, with their live prices at random volatilities.
+
+    Returns:
+        book (pd.DataFrame): Open option positions, see PnLCalculator.option_book.
+        live_prices (dict): Live prices by instrument name and by currency.
+        vols (np.ndarray): Volatilities of the live prices.
+    """
+    rng = np.random.default_rng(seed)
+    strikes = max(size // 104, 1)
+    instruments = make_instruments(expiries=26, strikes=strikes, start=now + timedelta(days=1))
+    # the integer strikes of a dense chain repeat
+    book = instruments[instruments['trade_type'] == 'option'].drop_duplicates('instrument_name').set_index('instrument_name')
+    book = book.assign(strike=book['strike'].astype(float), expiry=pd.to_datetime(book['expiry']),
+                       position=rng.choice([-1.0, 1.0], len(book)) * rng.integers(1, 100, len(book)))
+    live_prices = {'BTC': 30000.0, 'ETH': 2000.0}
+    forward = book['currency'].map(live_prices).to_numpy()
+    time_to_expiry = (book['expiry'].to_numpy(dtype='datetime64[ms]').astype('int64') - now_ms) / YEAR_MS
+    vols = rng.uniform(0.3, 1.2, len(book))
+    prices = [scalar_price(f, k, t, v, cp == 'C')[0]
+              for f, k, t, v, cp in zip(forward, book['strike'], time_to_expiry, vols, book['cp'])]
+    live_prices.update(dict(zip(book.index, np.array(prices) / forward)))
+    return book[['currency', 'expiry', 'strike', 'cp', 'position']], live_prices, vols
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--scalar-max', type=int, default=10_000)
+    args = parser.parse_args()
+
+    now = datetime.utcnow()
+    now_ms = datetime_to_unix_ms(now.replace(tzinfo=timezone.utc))
+    print(f"{'options':>10} {'vectorized (ms)':>16} {'scalar (ms)':>12} {'max delta error':>16}")
+    for size in args.sizes:
+        book, live_prices, vols = make_book(size, now, now_ms)
+        forward = book['currency'].map(live_prices).to_numpy()
+        time_to_expiry = (book['expiry'].to_numpy(dtype='datetime64[ms]').astype('int64') - now_ms) / YEAR_MS
+        is_call = (book['cp'] == 'C').to_numpy()
+        greeks = option_greeks(book, live_prices, now_ms)
+        expected = black76(forward, book['strike'].to_numpy(), time_to_expiry, vols, is_call)
+        delta_error = np.abs(greeks['delta'].to_numpy() / book['position'].to_numpy() - expected['delta']).max()
+
+        rng = np.random.default_rng(1)
+        elapsed = 0.0
+        for _ in range(args.rounds):
+            # a price update moves the index and the marks
+            moved = {name: price * float(rng.uniform(0.999, 1.001)) for name, price in live_prices.items()}
+            start = time.perf_counter()
+            option_greeks(book, moved, now_ms)
+            elapsed += time.perf_counter() - start
+        vectorized_ms = elapsed / args.rounds * 1000
+
+        scalar_ms = float('nan')
+        if len(book) <= args.scalar_max:
+            usd_marks = [live_prices[name] * f for name, f in zip(book.index, forward)]
+            start = time.perf_counter()
+            scalar = pd.DataFrame([scalar_greeks(price, f, k, t, call)
+                                   for price, f, k, t, call in zip(usd_marks, forward, book['strike'], time_to_expiry, is_call)])
+            scalar_ms = (time.perf_counter() - start) * 1000
+            np.testing.assert_allclose(greeks['delta'].to_numpy() / book['position'].to_numpy(), scalar['delta'].to_numpy(), atol=1e-3)
+        print(f"{len(book):>10} {vectorized_ms:>16.2f} {scalar_ms:>12.2f} {delta_error:>16.2e}")
+
+if __name__ == "__main__":
+    main()
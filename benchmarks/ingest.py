@@ -0,0 +1,64 @@
+"""
+Benchmark of DBWrapper.save_to_db against a table already holding many rows.
+
+Usage:
+    python -m benchmarks.ingest [--existing 1000000] [--batch 1000] [--legacy]
+"""
+import argparse
+import os
+import tempfile
+
+from benchmarks.positions import timed
+from benchmarks.synthetic import make_transaction_logs
+from db_wrapper import DBWrapper
+from utils import convert_to_int_or_str
+
+
+def legacy_save_to_db(db_wrapper, df, table_name):
+    """
+    Former DBWrapper.save_to_db, which filtered the existing keys in Python before appending with to_sql.
+    """
+    # the keys within the partition of the account, which leads the primary key since schema version 6
+    db_wrapper.cursor.execute(f"SELECT * FROM pragma_table_info('{table_name}') WHERE pk ORDER BY pk")
+    table_keys = [column[1] for column in db_wrapper.cursor.fetchall() if column[1] != 'account']
+    db_wrapper.cursor.execute(f"SELECT {table_keys[0]}, {table_keys[1]} FROM {table_name} WHERE account = ?", (db_wrapper.account,))
+    existing_records = db_wrapper.cursor.fetchall()
+
+    def filter_pairs(row):
+        return (convert_to_int_or_str(row[table_keys[0]]), convert_to_int_or_str(row[table_keys[1]])) not in existing_records
+
+    df = df[df.apply(filter_pairs, axis=1)].assign(account=db_wrapper.account)
+    for column in df.columns:
+        df[column] = df[column].apply(convert_to_int_or_str)
+    df.to_sql(name=table_name, con=db_wrapper.conn, if_exists='append', index=False)
+    db_wrapper.conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--existing', type=int, default=1_000_000, help='rows already in the table')
+    parser.add_argument('--batch', type=int, default=1000, help='rows per saved batch, half of them already in DB')
+    parser.add_argument('--legacy', action='store_true', help='also time the former implementation')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_wrapper = DBWrapper(os.path.join(tmp_dir, 'benchmark.db'))
+        chunk = 100_000
+        for start_id in range(0, args.existing, chunk):
+            db_wrapper.save_to_db(make_transaction_logs(min(chunk, args.existing - start_id), start_id=start_id, seed=start_id),
+                                  table_name='transaction_logs')
+
+        overlap = args.batch // 2
+        batch = make_transaction_logs(args.batch, start_id=args.existing - overlap, seed=1)
+        _, bulk_time = timed(db_wrapper.save_to_db, batch, table_name='transaction_logs')
+        print(f"existing rows: {args.existing}, batch: {args.batch} ({overlap} already in DB)")
+        print(f"bulk upsert : {bulk_time:.4f} s")
+
+        if args.legacy:
+            batch = make_transaction_logs(args.batch, start_id=args.existing + args.batch - overlap, seed=2)
+            _, legacy_time = timed(legacy_save_to_db, db_wrapper, batch, 'transaction_logs')
+            print(f"legacy      : {legacy_time:.4f} s ({legacy_time / bulk_time:.0f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark of the incremental live positions against recomputing every position on each event.
+
+Every event is a user.trades notification of one fill or a ticker price update, followed by a read
+of the realized and unrealized PnL.
+
+Usage:
+    python -m benchmarks.live_positions [--history 100000] [--events 10000] [--recompute-events 20]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from benchmarks.positions import timed
+from benchmarks.synthetic import make_trades, make_live_prices
+from instrument_registry import InstrumentRegistry
+from pnl_calc import LivePositions
+from position_engine import accumulate_positions, calculate_positions
+
+
+def make_events(trades, live_prices, seed=2):
+    """
+    Turns processed trades into user.trades notifications, alternating with ticker price updates.
+    """
+    rng = np.random.default_rng(seed)
+    events = []
+    for trade in trades.itertuples(index=False):
+        amount = trade.amount * trade.index_price if trade.trade_type == 'future' else trade.amount
+        events.append(('trade', [{'trade_id': f"live-{trade.trade_id}", 'instrument_name': trade.instrument_name,
+                                  'direction': trade.direction, 'amount': amount, 'price': trade.price,
+                                  'index_price': trade.index_price, 'timestamp': int(trade.timestamp)}]))
+        events.append(('price', (trade.instrument_name, live_prices[trade.instrument_name] * rng.lognormal(0, 0.001))))
+    return events
+
+
+def replay(live_positions, events):
+    for kind, data in events:
+        if kind == 'trade':
+            live_positions.on_user_trades('user.trades.any.any.raw', data)
+        else:
+            live_positions.on_price(*data)
+        live_positions.pnl()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--history', type=int, default=100_000, help='fills applied before the events')
+    parser.add_argument('--events', type=int, default=10_000, help='live fills, each followed by a price update')
+    parser.add_argument('--recompute-events', type=int, default=20,
+                        help='events on which the full recomputation is timed')
+    args = parser.parse_args()
+
+    trades = make_trades(args.history + args.events)
+    history, live = trades.iloc[:args.history], trades.iloc[args.history:]
+    live_prices = make_live_prices(trades)
+    events = make_events(live, live_prices)
+
+    live_positions = LivePositions(InstrumentRegistry())
+    _, build_time = timed(live_positions.apply_trades, history)
+    live_positions.update_prices(live_prices)
+    _, replay_time = timed(replay, live_positions, events)
+
+    expected = accumulate_positions(trades)
+    positions = live_positions.to_frame().set_index('instrument_name').loc[expected.index]
+    np.testing.assert_allclose(positions[['buy', 'sell', 'realized_pl']].to_numpy(dtype=float),
+                               expected[['buy', 'sell', 'realized_pl']].to_numpy(dtype=float), rtol=1e-9)
+    np.testing.assert_allclose(live_positions.pnl(), positions[['realized_pl', 'unrealized_pl']].sum().to_numpy(), rtol=1e-6)
+
+    start = time.perf_counter()
+    for i in range(args.recompute_events):
+        calculate_positions(trades.iloc[:args.history + i], live_prices)
+    recompute_time = (time.perf_counter() - start) / args.recompute_events
+
+    incremental_time = replay_time / len(events)
+    print(f"history of {args.history} fills applied in {build_time:.3f} s")
+    print(f"{'per event':>24} {'incremental (us)':>17} {'recompute (us)':>15} {'speed-up':>10}")
+    print(f"{len(events):>24} {incremental_time * 1e6:>17.1f} {recompute_time * 1e6:>15.0f} {recompute_time / incremental_time:>9.0f}x")
+
+
+if __name__ == "__main__":
+    main()
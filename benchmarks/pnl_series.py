@@ -0,0 +1,89 @@
+"""
+Benchmark of the PnL time series over a year of daily or hourly boundaries.
+
+The historical marks of every instrument and currency are a random walk stored in a temporary database,
+the series is computed from the trades and the marks read back from it, without network. The series of the
+fills reduced chunk by chunk, as in streaming mode, and the series of a range without fills are checked.
+
+Usage:
+    python -m benchmarks.pnl_series [--fills 100000 1000000] [--expiries 26] [--strikes 10] [--bucket day]
+"""
+import argparse
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import make_instruments, make_live_prices, make_trades
+from db_wrapper import DBWrapper
+from pnl_calc import PNL_BUCKETS
+from position_engine import accumulate_positions, bucket_flows, pnl_time_series
+from utils import datetime_to_unix_ms
+
+
+def make_price_history(live_prices, ticks, seed=2):
+    """
+    Builds random walks ending on the live prices, one price per tick.
+
+    Returns:
+        histories (dict): List of (timestamp, price) by name.
+    """
+    rng = np.random.default_rng(seed)
+    return {name: list(zip(ticks.tolist(), (price * np.exp(np.cumsum(rng.normal(0.0, 0.01, len(ticks)))[::-1])).tolist()))
+            for name, price in live_prices.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fills', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--expiries', type=int, default=26)
+    parser.add_argument('--strikes', type=int, default=10)
+    parser.add_argument('--bucket', choices=list(PNL_BUCKETS), default='day')
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--chunk-size', type=int, default=100_000, help='fills per chunk of the streaming check')
+    args = parser.parse_args()
+
+    resolution, bucket_ms = PNL_BUCKETS[args.bucket]
+    end = datetime.now()
+    start = end - timedelta(days=args.days)
+    start_ts, end_ts = datetime_to_unix_ms(start), datetime_to_unix_ms(end)
+    boundaries = np.unique(np.concatenate([[start_ts], np.arange((start_ts // bucket_ms + 1) * bucket_ms, end_ts, bucket_ms), [end_ts]]))
+    instruments = make_instruments(expiries=args.expiries, strikes=args.strikes, start=start + timedelta(days=7))
+
+    print(f"{'fills':>10} {'instruments':>12} {'boundaries':>11} {'marks':>10} {'read (s)':>9} {'series (s)':>11}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.fills:
+            trades = make_trades(size, instruments=instruments, start=start, days=args.days)
+            live_prices = make_live_prices(trades)
+            db_wrapper = DBWrapper(os.path.join(tmp_dir, f"{size}.db"))
+            ticks = np.arange((start_ts // bucket_ms) * bucket_ms, end_ts, bucket_ms)
+            for name, prices in make_price_history(live_prices, ticks).items():
+                db_wrapper.save_price_history(name, resolution, prices, start_ts - bucket_ms, end_ts)
+
+            started = time.perf_counter()
+            marks = db_wrapper.get_price_history(list(live_prices), resolution, start_ts - bucket_ms, end_ts)
+            read_time = time.perf_counter() - started
+            started = time.perf_counter()
+            series = pnl_time_series(bucket_flows(trades, boundaries), pd.DataFrame(), marks, boundaries)
+            series_time = time.perf_counter() - started
+
+            # streaming mode reduces the fills chunk by chunk
+            chunks = [trades.iloc[chunk_start:chunk_start + args.chunk_size] for chunk_start in range(0, len(trades), args.chunk_size)]
+            streamed = pnl_time_series(pd.concat([bucket_flows(chunk, boundaries) for chunk in chunks], ignore_index=True),
+                                       pd.DataFrame(), marks, boundaries)
+            values = ['realized_pl', 'unrealized_pl', 'total_pl', 'usd_fees', 'unpriced']
+            np.testing.assert_allclose(streamed[values].to_numpy(dtype=float), series[values].to_numpy(dtype=float), rtol=1e-9, atol=1e-6)
+
+            # a range without fills marks the positions carried from the range before
+            quiet = pnl_time_series(bucket_flows(pd.DataFrame(), boundaries), accumulate_positions(trades), marks, boundaries)
+            assert len(quiet) == len(boundaries) and np.isclose(quiet['realized_pl'], 0.0).all() and (quiet['usd_fees'] == 0.0).all()
+            print(f"{size:>10} {trades['instrument_name'].nunique():>12} {len(boundaries):>11} {len(marks):>10} "
+                  f"{read_time:>9.2f} {series_time:>11.2f}")
+            db_wrapper.conn.close()
+
+
+if __name__ == "__main__":
+    main()
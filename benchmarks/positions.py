@@ -0,0 +1,105 @@
+"""
+Benchmark of the position engine against the former row by row implementation.
+
+Usage:
+    python -m benchmarks.positions [--sizes 10000 100000 1000000] [--legacy-max 10000]
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.synthetic import make_trades, make_live_prices
+from position_engine import calculate_positions, to_usd_prices
+
+
+def legacy_calculate_positions(trades, live_prices):
+    """
+    Row by row implementation formerly used by PnLCalculator.calculate_positions, kept as a reference.
+    """
+    trades = trades.assign(price=to_usd_prices(trades))
+    positions = pd.DataFrame()
+    for instrument in trades['instrument_name'].unique():
+        trades_subset = trades[trades['instrument_name'] == instrument].sort_values(by='timestamp', ascending=True, kind='mergesort').reset_index(drop=True)
+        for idx, row in trades_subset.iterrows():
+            trades_subset.loc[idx, 'buy'] = trades_subset[trades_subset['direction'] == 'buy'].loc[0:idx, 'amount'].sum()
+            trades_subset.loc[idx, 'sell'] = trades_subset[trades_subset['direction'] == 'sell'].loc[0:idx, 'amount'].sum()
+            trades_subset.loc[idx, 'long/short'] = 'long' if trades_subset.loc[idx, 'buy'] > trades_subset.loc[idx, 'sell'] else 'short'
+
+            buy_amount_subset = trades_subset[trades_subset['direction'] == 'buy'].loc[0:idx, 'amount']
+            buy_price_subset = trades_subset[trades_subset['direction'] == 'buy'].loc[0:idx, 'price']
+            sell_amount_subset = trades_subset[trades_subset['direction'] == 'sell'].loc[0:idx, 'amount']
+            sell_price_subset = trades_subset[trades_subset['direction'] == 'sell'].loc[0:idx, 'price']
+
+            if not buy_amount_subset.empty:
+                trades_subset.loc[idx, 'avg_long'] = buy_amount_subset.dot(buy_price_subset) / buy_amount_subset.sum()
+            else:
+                trades_subset.loc[idx, 'avg_long'] = 0
+
+            if not sell_amount_subset.empty:
+                trades_subset.loc[idx, 'avg_short'] = sell_amount_subset.dot(sell_price_subset) / sell_amount_subset.sum()
+            else:
+                trades_subset.loc[idx, 'avg_short'] = 0
+
+        last_idx = trades_subset.index[-1]
+        trades_subset.loc[last_idx, 'avg_long_to_short'] = trades_subset.loc[(trades_subset['buy'] < trades_subset['sell']).index[-1], 'avg_long']
+        trades_subset.loc[last_idx, 'avg_short_to_long'] = trades_subset.loc[(trades_subset['sell'] < trades_subset['buy']).index[-1], 'avg_short']
+
+        last_row = trades_subset.iloc[last_idx]
+        if last_row['long/short'] == 'long':
+            trades_subset.loc[last_idx, 'realized_pl'] = (last_row['avg_short'] - last_row['avg_long_to_short']) * last_row['sell']
+        else:
+            trades_subset.loc[last_idx, 'realized_pl'] = (last_row['avg_short_to_long'] - last_row['avg_long']) * last_row['buy']
+
+        live_price = live_prices[instrument] * (1 if last_row['trade_type'] == 'future' else live_prices[last_row['currency']])
+        trades_subset.loc[last_idx, 'unrealized_pl'] = (live_price - last_row['avg_long']) * last_row['buy'] \
+                                                     + (last_row['avg_short'] - live_price) * last_row['sell'] \
+                                                     - trades_subset.loc[last_idx, 'realized_pl']
+
+        positions = pd.concat([positions, pd.DataFrame(trades_subset.loc[last_idx]).T], axis=0)
+
+    return positions
+
+
+def check_same_positions(positions, reference):
+    """
+    Asserts that two positions frames hold the same values.
+    """
+    assert list(positions.columns) == list(reference.columns), 'columns differ'
+    assert list(positions.index) == list(reference.index), 'index differs'
+    assert (positions['instrument_name'].to_numpy() == reference['instrument_name'].to_numpy()).all(), 'instruments differ'
+    assert (positions['long/short'].to_numpy() == reference['long/short'].to_numpy()).all(), 'long/short differs'
+    for column in ['buy', 'sell', 'avg_long', 'avg_short', 'realized_pl', 'unrealized_pl']:
+        np.testing.assert_allclose(positions[column].astype(float), reference[column].astype(float), rtol=1e-9, err_msg=column)
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000, 1_000_000])
+    parser.add_argument('--legacy-max', type=int, default=10_000,
+                        help='largest size on which the row by row reference is timed')
+    args = parser.parse_args()
+
+    print(f"{'fills':>10} {'engine (s)':>12} {'legacy (s)':>12} {'speed-up':>10}")
+    for size in args.sizes:
+        trades = make_trades(size)
+        live_prices = make_live_prices(trades)
+        positions, engine_time = timed(calculate_positions, trades, live_prices)
+
+        if size <= args.legacy_max:
+            reference, legacy_time = timed(legacy_calculate_positions, trades, live_prices)
+            check_same_positions(positions, reference)
+            print(f"{size:>10} {engine_time:>12.4f} {legacy_time:>12.2f} {legacy_time / engine_time:>9.0f}x")
+        else:
+            print(f"{size:>10} {engine_time:>12.4f} {'skipped':>12} {'-':>10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+"""
+Benchmark of the columnar trade repricing against the per trade reference.
+
+Usage:
+    python -m benchmarks.repricing [--sizes 10000 100000] [--reference-max 10000]
+"""
+import argparse
+
+import numpy as np
+
+from benchmarks.positions import timed
+from benchmarks.synthetic import make_trades, make_live_prices
+from pnl_calc import PnLCalculator
+from position_engine import mark_to_market
+
+
+def reference_mark_to_market(trades, live_prices):
+    """
+    Reprices the trades row by row with PnLCalculator.usd_pnl_by_trade.
+    """
+    pnl_calc = PnLCalculator.__new__(PnLCalculator)
+    pnl_calc.instrument_live_prices = live_prices
+    return [pnl_calc.usd_pnl_by_trade(trade) for _, trade in trades.iterrows()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10_000, 100_000])
+    parser.add_argument('--reference-max', type=int, default=10_000,
+                        help='largest size on which the per trade reference is timed')
+    args = parser.parse_args()
+
+    print(f"{'fills':>10} {'columnar (s)':>13} {'per trade (s)':>14} {'speed-up':>10}")
+    for size in args.sizes:
+        trades = make_trades(size)
+        live_prices = make_live_prices(trades)
+        (usd_pnl, usd_pnl_including_fees, usd_fees), columnar_time = timed(mark_to_market, trades, live_prices)
+
+        if size <= args.reference_max:
+            reference, reference_time = timed(reference_mark_to_market, trades, live_prices)
+            np.testing.assert_allclose(usd_pnl_including_fees.to_numpy(), [r[1] for r in reference], rtol=1e-9)
+            print(f"{size:>10} {columnar_time:>13.4f} {reference_time:>14.2f} {reference_time / columnar_time:>9.0f}x")
+        else:
+            print(f"{size:>10} {columnar_time:>13.4f} {'skipped':>14} {'-':>10}")
+
+
+if __name__ == "__main__":
+    main()
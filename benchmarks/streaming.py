@@ -0,0 +1,75 @@
+"""
+Benchmark of the peak memory of the streaming PnL computation against loading the whole range.
+
+The transaction logs are written to a temporary database, the PnL of the range is computed against
+synthetic live prices, without network. Peak memory is measured with tracemalloc, which sees the
+NumPy buffers of the DataFrames.
+
+Usage:
+    python -m benchmarks.streaming [--sizes 100000 1000000] [--chunk-size 100000]
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from benchmarks.synthetic import make_live_prices, make_transaction_logs
+from db_wrapper import DBWrapper
+from pnl_calc import PnLCalculator
+
+
+def measured(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 2 ** 20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[100_000, 1_000_000])
+    parser.add_argument('--chunk-size', type=int, default=100_000)
+    parser.add_argument('--days', type=int, default=365)
+    args = parser.parse_args()
+
+    config = {'deribit': {'currencies': ['BTC', 'ETH']}, 'stream_chunk_size': args.chunk_size}
+    print(f"{'fills':>10} {'loaded (s)':>11} {'peak (MiB)':>11} {'streamed (s)':>13} {'peak (MiB)':>11}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for size in args.sizes:
+            end = datetime.now()
+            start = end - timedelta(days=args.days)
+            logs = make_transaction_logs(size, start=start, days=args.days)
+            live_prices = make_live_prices(logs)
+            db_wrapper = DBWrapper(os.path.join(tmp_dir, f"{size}.db"))
+            db_wrapper.save_to_db(logs, table_name='transaction_logs')
+            del logs
+
+            def loaded():
+                pnl_calc = PnLCalculator(config, None, db_wrapper, start, end, sync_on_load=False)
+                pnl_calc.instrument_live_prices = live_prices
+                pnl_calc.reprice_trades()
+                return pnl_calc.calculate_positions()
+
+            def streamed():
+                pnl_calc = PnLCalculator(config, None, db_wrapper, start, end, sync_on_load=False, streaming=True)
+                pnl_calc.instrument_live_prices = live_prices
+                return pnl_calc.stream_pnl()[0]
+
+            expected, loaded_time, loaded_peak = measured(loaded)
+            positions, streamed_time, streamed_peak = measured(streamed)
+            columns = ['buy', 'sell', 'realized_pl', 'unrealized_pl']
+            np.testing.assert_allclose(positions.set_index('instrument_name').loc[expected['instrument_name'], columns].to_numpy(dtype=float),
+                                       expected[columns].to_numpy(dtype=float), rtol=1e-6)
+            print(f"{size:>10} {loaded_time:>11.2f} {loaded_peak:>11.0f} {streamed_time:>13.2f} {streamed_peak:>11.0f}")
+            db_wrapper.conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,210 @@
+"""
+Offline benchmark suite of the PnL hot paths, on synthetic transaction logs served by a local Deribit
+stand-in. Every scenario is repeated and its timings are written as JSON, to compare between commits.
+
+Usage:
+    python -m benchmarks.suite [--fills 100000] [--latency 0.005] [--output results.json] [--compare baseline.json]
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from benchmarks.fake_deribit import FakeDeribitServer
+from benchmarks.synthetic import make_live_prices, make_transaction_logs
+from db_wrapper import DBWrapper
+from deribit_api_wrapper import DeribitApiWrapper
+from pnl_calc import PnLCalculator
+from tracing import tracer
+
+SCENARIOS = ['ingest', 'sync', 'load', 'update_live_prices', 'update_pnl', 'calculate_positions']
+
+
+class Suite():
+    def __init__(self, args, tmp_dir) -> None:
+        """
+        Initializes the Suite: generates the transaction logs, starts the Deribit stand-in and
+        prepares a synced database shared by the read scenarios.
+
+        Args:
+            args (argparse.Namespace): Parsed command line arguments.
+            tmp_dir (str): Directory of the benchmark databases.
+        """
+        self.args = args
+        self.tmp_dir = tmp_dir
+        self.end = datetime.now()
+        self.start = self.end - timedelta(days=args.days)
+        self.logs = make_transaction_logs(args.fills, currencies=tuple(args.currencies), start=self.start,
+                                          days=args.days, expiries=args.expiries, strikes=args.strikes)
+        self.live_prices = make_live_prices(self.logs)
+        self.server = FakeDeribitServer(self.logs, self.live_prices, latency=args.latency, jitter=args.jitter,
+                                        max_credits=args.max_credits, refill_rate=args.refill_rate)
+        self.config = {
+            'db_path': os.path.join(tmp_dir, 'synced.db'),
+            'deribit': {
+                'client_id': 'benchmark',
+                'client_secret': 'benchmark',
+                'client_url': self.server.start(),
+                'currencies': list(args.currencies),
+                'sync_history_weeks': args.days // 7 + 1,
+            },
+        }
+        self.deribit_wrapper = DeribitApiWrapper(self.config)
+        # the coroutines of the API wrapper read the database from its event loop thread
+        self.db_wrapper = DBWrapper(self.config['db_path'], check_same_thread=False)
+        self._db_count = 0
+
+    def close(self):
+        self.deribit_wrapper.stop()
+        self.server.stop()
+        self.db_wrapper.conn.close()
+
+    def _new_db(self):
+        self._db_count += 1
+        return DBWrapper(os.path.join(self.tmp_dir, f"scenario_{self._db_count}.db"), check_same_thread=False)
+
+    def _pnl_calculator(self, db_wrapper=None, trades=None):
+        return PnLCalculator(self.config, deribit_wrapper=self.deribit_wrapper,
+                             db_wrapper=db_wrapper or self.db_wrapper,
+                             start_range=self.start, end_range=self.end,
+                             sync_on_load=False, trades=trades)
+
+    def prepare(self):
+        """
+        Syncs the shared database once, the read scenarios run on it.
+        """
+        self._pnl_calculator(trades=pd.DataFrame()).sync_transactions()
+
+    def ingest(self):
+        db_wrapper = self._new_db()
+        # pages of the size saved by the sync
+        pages = [self.logs.iloc[i:i + self.args.page_size] for i in range(0, len(self.logs), self.args.page_size)]
+        start = time.perf_counter()
+        for page in pages:
+            db_wrapper.save_to_db(page, table_name='transaction_logs')
+        elapsed = time.perf_counter() - start
+        db_wrapper.conn.close()
+        return elapsed
+
+    def sync(self):
+        db_wrapper = self._new_db()
+        pnl_calc = self._pnl_calculator(db_wrapper=db_wrapper, trades=pd.DataFrame())
+        start = time.perf_counter()
+        pnl_calc.sync_transactions()
+        elapsed = time.perf_counter() - start
+        db_wrapper.conn.close()
+        return elapsed
+
+    def load(self):
+        start = time.perf_counter()
+        self._pnl_calculator()
+        return time.perf_counter() - start
+
+    def update_live_prices(self):
+        pnl_calc = self._pnl_calculator()
+        start = time.perf_counter()
+        self.deribit_wrapper.run(pnl_calc.update_live_prices())
+        return time.perf_counter() - start
+
+    def update_pnl(self):
+        pnl_calc = self._pnl_calculator()
+        start = time.perf_counter()
+        pnl_calc.update_pnl()
+        return time.perf_counter() - start
+
+    def calculate_positions(self):
+        pnl_calc = self._pnl_calculator()
+        pnl_calc.instrument_live_prices = self.live_prices
+        pnl_calc.get_opening_positions()
+        start = time.perf_counter()
+        pnl_calc.calculate_positions()
+        return time.perf_counter() - start
+
+    def run(self, scenario):
+        """
+        Runs a scenario the configured number of times.
+
+        Returns:
+            result (dict): Timings in seconds, and the requests served by the stand-in during the scenario.
+        """
+        requests_before = sum(self.server.request_counts.values())
+        rate_limited_before = self.server.rate_limited
+        seconds = [getattr(self, scenario)() for _ in range(self.args.repeat)]
+        return {
+            'seconds': seconds,
+            'min': min(seconds),
+            'median': statistics.median(seconds),
+            'requests': (sum(self.server.request_counts.values()) - requests_before) / self.args.repeat,
+            'rate_limited': (self.server.rate_limited - rate_limited_before) / self.args.repeat,
+        }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fills', type=int, default=100_000, help='synthetic transaction log entries')
+    parser.add_argument('--currencies', nargs='+', default=['BTC', 'ETH'])
+    parser.add_argument('--days', type=int, default=180, help='days of history before now')
+    parser.add_argument('--expiries', type=int, default=26, help='weekly option expiries per currency')
+    parser.add_argument('--strikes', type=int, default=10, help='strikes per expiry')
+    parser.add_argument('--latency', type=float, default=0.005, help='seconds before every response of the stand-in')
+    parser.add_argument('--jitter', type=float, default=0.0, help='maximum random seconds added to the latency')
+    parser.add_argument('--max-credits', type=float, default=None, help='credit bucket of the stand-in, no limit when omitted')
+    parser.add_argument('--refill-rate', type=float, default=None, help='credits per second of the stand-in')
+    parser.add_argument('--page-size', type=int, default=1000, help='rows per save_to_db call of the ingest scenario')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=SCENARIOS)
+    parser.add_argument('--trace', action='store_true', help='enable the tracer and add its spans, latencies and counters to the results')
+    parser.add_argument('--output', help='JSON file the results are written to')
+    parser.add_argument('--compare', help='JSON results of a previous run to compare the medians with')
+    args = parser.parse_args()
+
+    tracer.configure(args.trace)
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        suite = Suite(args, tmp_dir)
+        try:
+            suite.prepare()
+            for scenario in args.scenarios:
+                results[scenario] = suite.run(scenario)
+        finally:
+            suite.close()
+
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+
+    print(f"{'scenario':<22} {'median (s)':>11} {'min (s)':>9} {'requests':>9} {'vs baseline':>12}")
+    for scenario, result in results.items():
+        ratio = f"{result['median'] / baseline[scenario]['median']:.2f}x" if scenario in baseline else '-'
+        print(f"{scenario:<22} {result['median']:>11.4f} {result['min']:>9.4f} {result['requests']:>9.0f} {ratio:>12}")
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'pandas': pd.__version__,
+                'params': vars(args),
+                'results': results,
+                'trace': tracer.snapshot() if args.trace else None,
+            }, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
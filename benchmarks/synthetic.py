@@ -0,0 +1,156 @@
+import numpy as np
+import pandas as pd
+from datetime import datetime, timedelta
+
+from utils import datetime_to_unix_ms
+
+
+def make_instruments(currencies=('BTC', 'ETH'), expiries=4, strikes=10, start=datetime(2023, 1, 6)):
+    """
+    Builds a list of synthetic Deribit instruments.
+
+    Args:
+        currencies (tuple): Underlying currencies.
+        expiries (int): Number of weekly expiries per currency.
+        strikes (int): Number of strikes per expiry, each listed as a call and a put.
+        start (datetime): First expiry date.
+
+    Returns:
+        instruments (pd.DataFrame): One row per instrument with its currency, trade type, expiry, strike and call/put.
+    """
+    rows = []
+    spots = {'BTC': 30000, 'ETH': 2000}
+    for ccy in currencies:
+        spot = spots.get(ccy, 100)
+        rows.append((f"{ccy}-PERPETUAL", ccy, 'future', 'PERP', None, None))
+        for week in range(expiries):
+            expiry = start + timedelta(weeks=week)
+            expiry_code = expiry.strftime('%d%b%y').upper().lstrip('0')
+            for i in range(strikes):
+                strike = int(spot * (0.8 + 0.4 * i / max(strikes - 1, 1)))
+                for cp in ('C', 'P'):
+                    rows.append((f"{ccy}-{expiry_code}-{strike}-{cp}", ccy, 'option', expiry, str(strike), cp))
+    return pd.DataFrame(rows, columns=['instrument_name', 'currency', 'trade_type', 'expiry', 'strike', 'cp'])
+
+
+def make_trades(n_fills, instruments=None, start=datetime(2023, 1, 1), seed=0, days=365):
+    """
+    Builds a synthetic processed trades frame, as returned by PnLCalculator._process_transactions_from_db.
+
+    Args:
+        n_fills (int): Number of fills.
+        instruments (pd.DataFrame): Instruments to trade, defaults to make_instruments().
+        start (datetime): Timestamp of the first fill.
+        seed (int): Random seed.
+        days (int): Days over which the fills are spread.
+
+    Returns:
+        trades (pd.DataFrame): Synthetic trades.
+    """
+    rng = np.random.default_rng(seed)
+    if instruments is None:
+        instruments = make_instruments()
+
+    picked = instruments.iloc[rng.integers(0, len(instruments), n_fills)].reset_index(drop=True)
+    start_ms = datetime_to_unix_ms(start)
+    timestamps = start_ms + rng.integers(0, days * 24 * 3600 * 1000, n_fills)
+    # options only trade until their expiry
+    expiry_ms = np.array([datetime_to_unix_ms(expiry) if isinstance(expiry, datetime) else np.iinfo('int64').max
+                          for expiry in picked['expiry']], dtype='int64')
+    late = timestamps > expiry_ms
+    timestamps[late] = start_ms + (rng.random(late.sum()) * np.maximum(expiry_ms[late] - start_ms, 0)).astype('int64')
+    order = np.argsort(timestamps, kind='stable')
+    picked = picked.iloc[order].reset_index(drop=True)
+
+    is_future = (picked['trade_type'] == 'future').to_numpy()
+    index_price = np.where(picked['currency'] == 'BTC', 30000.0, 2000.0) * rng.lognormal(0, 0.05, n_fills)
+
+    trades = picked.copy()
+    trades['timestamp'] = timestamps[order]
+    trades['type'] = 'trade'
+    trades['id'] = np.arange(n_fills)
+    trades['trade_id'] = np.arange(n_fills)
+    trades['direction'] = np.where(rng.random(n_fills) < 0.5, 'buy', 'sell')
+    trades['side'] = np.where(trades['direction'] == 'buy', 'open buy', 'open sell')
+    trades['index_price'] = index_price
+    trades['price'] = np.where(is_future, index_price, np.round(rng.uniform(0.001, 0.2, n_fills), 4))
+    trades['amount'] = np.where(is_future, rng.integers(1, 100, n_fills) * 10 / index_price, rng.integers(1, 50, n_fills) / 10)
+    trades['commission'] = np.where(is_future, 0.0, 0.0003 * trades['amount'])
+    trades['datetime'] = pd.to_datetime(trades['timestamp'], unit='ms')
+    return trades
+
+
+def make_live_prices(trades, seed=1):
+    """
+    Builds a live price dictionary covering every instrument and currency of the trades.
+
+    Args:
+        trades (pd.DataFrame): Synthetic trades or transaction log entries.
+        seed (int): Random seed.
+
+    Returns:
+        live_prices (dict): Live prices by instrument name and by currency.
+    """
+    rng = np.random.default_rng(seed)
+    live_prices = {ccy: 30000.0 if ccy == 'BTC' else 2000.0 for ccy in trades['currency'].unique()}
+    for instrument, ccy in trades[['instrument_name', 'currency']].drop_duplicates().itertuples(index=False):
+        # options are the only names with strike and call/put parts
+        is_future = len(instrument.split('-')) < 4
+        live_prices[instrument] = live_prices[ccy] * float(rng.uniform(0.9, 1.1)) if is_future else float(rng.uniform(0.0, 0.2))
+    return live_prices
+
+
+def make_transaction_logs(n_logs, currencies=('BTC', 'ETH'), start_id=0, start=datetime(2023, 1, 1), seed=0,
+                          days=365, expiries=4, strikes=10):
+    """
+    Builds synthetic trade entries shaped like the logs of private/get_transaction_log.
+
+    Args:
+        n_logs (int): Number of log entries.
+        currencies (tuple): Currencies of the entries.
+        start_id (int): First log id, ids and user_seq are consecutive from there.
+        start (datetime): Timestamp of the first entry.
+        seed (int): Random seed.
+        days (int): Days over which the entries are spread.
+        expiries (int): Number of weekly option expiries per currency, from the start.
+        strikes (int): Number of strikes per expiry.
+
+    Returns:
+        logs (pd.DataFrame): Synthetic transaction log entries.
+    """
+    rng = np.random.default_rng(seed)
+    instruments = make_instruments(currencies=currencies, expiries=expiries, strikes=strikes, start=start + timedelta(days=5))
+    trades = make_trades(n_logs, instruments=instruments, start=start, seed=seed, days=days)
+    ids = np.arange(start_id, start_id + n_logs)
+    is_future = (trades['trade_type'] == 'future').to_numpy()
+    return pd.DataFrame({
+        'username': 'synthetic',
+        'user_seq': ids,
+        'user_role': np.where(rng.random(n_logs) < 0.5, 'maker', 'taker'),
+        'user_id': 1,
+        'type': 'trade',
+        'trade_id': ids,
+        'timestamp': trades['timestamp'].to_numpy(),
+        'side': trades['side'].to_numpy(),
+        'price_currency': np.where(is_future, 'USD', trades['currency']),
+        'price': trades['price'].to_numpy(),
+        'position': 0.0,
+        'order_id': ids,
+        'mark_price': trades['price'].to_numpy(),
+        'instrument_name': trades['instrument_name'].to_numpy(),
+        'info': '',
+        'index_price': trades['index_price'].to_numpy(),
+        'id': ids,
+        'fee_balance': 0.0,
+        'equity': 1.0,
+        'currency': trades['currency'].to_numpy(),
+        'commission': trades['commission'].to_numpy(),
+        'change': 0.0,
+        'cashflow': 0.0,
+        'balance': 1.0,
+        # futures are logged in USD, options in contracts
+        'amount': np.where(is_future, trades['amount'] * trades['index_price'], trades['amount']),
+        'total_interest_pl': 0.0,
+        'session_upl': 0.0,
+        'session_rpl': 0.0,
+    })
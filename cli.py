@@ -0,0 +1,251 @@
+"""
+Headless entry point of the PnL calculator, for batch jobs.
+
+Usage:
+    python cli.py sync [--start 2023-08-01] [--accounts main sub1]
+    python cli.py compute --start 2023-08-01 [--end 2023-09-01] [--accounts main sub1] [--output-dir output] [--format parquet] [--streaming]
+    python cli.py report [--input-dir output] [--format parquet] [--by account]
+    python cli.py archive [--before 2023-09-01] [--accounts main sub1]
+
+The modules talking to Deribit, SQLite and pandas are imported by the subcommands that need them,
+so that the CLI starts without paying for them.
+"""
+import argparse
+import importlib.util
+import os
+import sys
+from datetime import datetime
+
+from utils import read_json
+
+# columns and dtypes of the written files, missing columns are written empty
+TRADES_SCHEMA = {
+    'account': 'object',
+    'id': 'int64',
+    'user_seq': 'int64',
+    'trade_id': 'object',
+    'order_id': 'object',
+    'timestamp': 'int64',
+    'datetime': 'datetime64[ns]',
+    'instrument_name': 'object',
+    'currency': 'object',
+    'trade_type': 'object',
+    'expiry': 'datetime64[ns]',
+    'strike': 'float64',
+    'cp': 'object',
+    'side': 'object',
+    'direction': 'object',
+    'price': 'float64',
+    'mark_price': 'float64',
+    'index_price': 'float64',
+    'amount': 'float64',
+    'commission': 'float64',
+    'usd_pnl': 'float64',
+    'usd_pnl_including_fees': 'float64',
+    'usd_fees': 'float64',
+}
+FIRM_POSITIONS_SCHEMA = {
+    'instrument_name': 'object',
+    'currency': 'object',
+    'trade_type': 'object',
+    'buy': 'float64',
+    'sell': 'float64',
+    'avg_long': 'float64',
+    'avg_short': 'float64',
+    'long/short': 'object',
+    'realized_pl': 'float64',
+    'unrealized_pl': 'float64',
+}
+POSITIONS_SCHEMA = {'account': 'object', **FIRM_POSITIONS_SCHEMA}
+INSTRUMENT_PNL_SCHEMA = {
+    'account': 'object',
+    'instrument_name': 'object',
+    'currency': 'object',
+    'trade_type': 'object',
+    'trades': 'int64',
+    'usd_pnl': 'float64',
+    'usd_pnl_including_fees': 'float64',
+    'usd_fees': 'float64',
+}
+OUTPUT_FILES = {'trades': 'trades_pnl', 'positions': 'positions', 'firm_positions': 'firm_positions',
+                'instrument_pnl': 'instrument_pnl'}
+
+
+def parse_date(value):
+    return datetime.fromisoformat(value)
+
+
+def load_config(args):
+    config = read_json(args.config)
+    from tracing import tracer
+    tracer.configure(config.get('tracing', False))
+    return config
+
+
+def apply_schema(df, schema):
+    """
+    Returns the columns of the schema in its order and dtypes, categories are written as plain strings.
+
+    Args:
+        df (pd.DataFrame): Trades or positions.
+        schema (dict): Dtype by column.
+
+    Returns:
+        df (pd.DataFrame): DataFrame with exactly the columns of the schema.
+    """
+    import pandas as pd
+
+    df = df.reindex(columns=list(schema))
+    for column, dtype in schema.items():
+        if dtype == 'object':
+            df[column] = df[column].astype(object).where(df[column].isna(), df[column].astype(str))
+        elif dtype == 'datetime64[ns]':
+            # perpetuals have no expiry
+            df[column] = pd.to_datetime(df[column], errors='coerce')
+        else:
+            df[column] = df[column].astype(dtype)
+    return df
+
+
+def write_frame(df, output_dir, name, file_format):
+    path = os.path.join(output_dir, f"{OUTPUT_FILES[name]}.{file_format}")
+    if file_format == 'parquet':
+        df.to_parquet(path, index=False)
+    else:
+        df.to_csv(path, index=False)
+    return path
+
+
+def read_frame(input_dir, name, file_format, schema):
+    import pandas as pd
+    path = os.path.join(input_dir, f"{OUTPUT_FILES[name]}.{file_format}")
+    if file_format == 'parquet':
+        return pd.read_parquet(path)
+    return pd.read_csv(path, parse_dates=[column for column, dtype in schema.items() if dtype == 'datetime64[ns]'])
+
+
+def sync(args):
+    """
+    Syncs the transaction logs of the accounts concurrently, backfilling them from the start date, and
+    extends the position snapshots.
+    """
+    from accounts import sync_accounts
+
+    config = load_config(args)
+    # without a start date, only the recent history is synced
+    for account, checkpoints in sync_accounts(config, args.start or datetime.now(), args.accounts).items():
+        for ccy, checkpoint in checkpoints.items():
+            print(f"{account} {ccy}: synced up to user_seq {checkpoint['last_user_seq']}")
+
+
+def compute(args):
+    """
+    Computes the PnL of the trades and positions of the accounts over a date range against the live prices,
+    one process per account, and writes them with the firm-level positions and the PnL by instrument.
+    """
+    from accounts import compute_accounts, firm_positions, sync_accounts
+
+    config = load_config(args)
+    if args.chunk_size is not None:
+        config['stream_chunk_size'] = args.chunk_size
+    if not args.no_sync:
+        sync_accounts(config, args.start, args.accounts)
+    trades, positions, pnl_by_instrument = compute_accounts(config, args.start, args.end, args.accounts, args.processes,
+                                                            streaming=args.streaming)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    outputs = [('positions', positions, POSITIONS_SCHEMA), ('firm_positions', firm_positions(positions), FIRM_POSITIONS_SCHEMA),
+               ('instrument_pnl', pnl_by_instrument, INSTRUMENT_PNL_SCHEMA)]
+    # the streamed trades are not kept, only their PnL by instrument is written
+    if not args.streaming:
+        outputs.insert(0, ('trades', trades, TRADES_SCHEMA))
+    for name, df, schema in outputs:
+        path = write_frame(apply_schema(df, schema), args.output_dir, name, args.format)
+        print(f"{len(df)} {name} written to {path}")
+
+
+def report(args):
+    """
+    Prints the PnL summaries of the files written by compute.
+    """
+    import pandas as pd
+
+    pnl_by_instrument = read_frame(args.input_dir, 'instrument_pnl', args.format, INSTRUMENT_PNL_SCHEMA)
+    positions = read_frame(args.input_dir, 'positions', args.format, POSITIONS_SCHEMA)
+    index = 'instrument_name' if args.by == 'instrument' else args.by
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        print("PnL summary:")
+        print(pnl_by_instrument.pivot_table(index=index, values=['usd_pnl', 'usd_pnl_including_fees', 'usd_fees'], aggfunc='sum', margins=True))
+        print()
+        print("PnL realized/unrealized:")
+        print(positions.pivot_table(index=index, values=['realized_pl', 'unrealized_pl'], aggfunc='sum', margins=True))
+
+
+def archive(args):
+    """
+    Compacts the synced closed months of the transaction logs of the accounts into the Parquet archive.
+    """
+    from db_wrapper import DBWrapper
+    from accounts import _select_accounts
+
+    config = load_config(args)
+    for account in _select_accounts(config, args.accounts):
+        db_wrapper = DBWrapper(config['db_path'], account=account['name'])
+        try:
+            for ccy, month, rows in db_wrapper.compact_transaction_logs(args.before):
+                print(f"{account['name']} {ccy} {month}: {rows} transaction logs archived")
+        finally:
+            db_wrapper.conn.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--config', default='config.json', help='configuration file, see README')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sync_parser = subparsers.add_parser('sync', help=sync.__doc__.strip())
+    sync_parser.add_argument('--start', type=parse_date, default=None, help='backfill the transaction logs from this date')
+    sync_parser.add_argument('--accounts', nargs='+', default=None, help='names of the accounts, all by default')
+    sync_parser.set_defaults(func=sync)
+
+    compute_parser = subparsers.add_parser('compute', help=compute.__doc__.strip())
+    compute_parser.add_argument('--start', type=parse_date, required=True, help='start of the range, e.g. 2023-08-01')
+    compute_parser.add_argument('--end', type=parse_date, default=None, help='end of the range, now by default')
+    compute_parser.add_argument('--accounts', nargs='+', default=None, help='names of the accounts, all by default')
+    compute_parser.add_argument('--processes', type=int, default=None, help='worker processes, the number of CPUs by default')
+    compute_parser.add_argument('--no-sync', action='store_true', help='use the transaction logs already in DB')
+    compute_parser.add_argument('--output-dir', default='output')
+    compute_parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet')
+    compute_parser.add_argument('--streaming', action='store_true',
+                                help='stream the trades in chunks with bounded memory, the trades file is not written')
+    compute_parser.add_argument('--chunk-size', type=int, default=None, help='trades per chunk, config stream_chunk_size by default')
+    compute_parser.set_defaults(func=compute)
+
+    report_parser = subparsers.add_parser('report', help=report.__doc__.strip())
+    report_parser.add_argument('--input-dir', default='output')
+    report_parser.add_argument('--format', choices=['parquet', 'csv'], default='parquet')
+    report_parser.add_argument('--by', choices=['account', 'currency', 'instrument'], default='currency')
+    report_parser.set_defaults(func=report)
+
+    archive_parser = subparsers.add_parser('archive', help=archive.__doc__.strip())
+    archive_parser.add_argument('--before', type=parse_date, default=None,
+                                help='archive the months before the month of this date, the current month by default')
+    archive_parser.add_argument('--accounts', nargs='+', default=None, help='names of the accounts, all by default')
+    archive_parser.set_defaults(func=archive)
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    args = parser.parse_args(argv)
+    # checked before the sync, a missing engine would only fail when writing the outputs
+    if getattr(args, 'format', None) == 'parquet' and importlib.util.find_spec('pyarrow') is None:
+        parser.error("--format parquet requires pyarrow, install requirements.txt or use --format csv")
+    if getattr(args, 'end', 'unset') is None:
+        args.end = datetime.now()
+    args.func(args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
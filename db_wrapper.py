@@ -1,26 +1,131 @@
+import os
+import re
 import sqlite3
+from contextlib import nullcontext
 from datetime import datetime, timedelta
 from utils import *
+from tracing import tracer
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+# sides of the trades and currencies of the transaction logs, fixed categories so that the frames of
+# different chunks and accounts concatenate without falling back to object
+SIDE_DTYPE = pd.CategoricalDtype(['open buy', 'open sell', 'close buy', 'close sell'])
+CURRENCY_DTYPE = pd.CategoricalDtype(['BTC', 'ETH', 'USDC', 'USDT', 'EURR'])
+
+# columns of transaction_logs needed to compute the PnL of trades, with their in-memory dtype
+TRADE_LOG_COLUMNS = {
+    'id': 'int64',
+    'user_seq': 'int64',
+    'trade_id': 'object',
+    'order_id': 'object',
+    'timestamp': 'int64',
+    'instrument_name': 'category',
+    'currency': CURRENCY_DTYPE,
+    'side': SIDE_DTYPE,
+    'price': 'float64',
+    'mark_price': 'float64',
+    'index_price': 'float64',
+    'amount': 'float64',
+    'commission': 'float64',
+}
+
+
+def concat_trade_logs(frames):
+    """
+    Concatenates trade frames, e.g. the chunks of a range or the trades of several accounts, keeping the
+    categorical columns categorical: the categories of each column, e.g. the instrument names, are united.
+
+    Args:
+        frames (list): DataFrames with the same columns.
+
+    Returns:
+        trades (pd.DataFrame): Concatenated trades, with a new index.
+    """
+    frames = list(frames)
+    columns = frames[0].columns
+    categorical = [column for column in columns
+                   if all(column in frame and isinstance(frame[column].dtype, pd.CategoricalDtype) for frame in frames)]
+    trades = pd.concat([frame.drop(columns=categorical) for frame in frames], ignore_index=True)
+    for column in categorical:
+        trades[column] = union_categoricals([frame[column] for frame in frames])
+    return trades[columns]
 
 class DBWrapper():
-    def __init__(self, db_path) -> None:
+    def __init__(self, db_path, check_same_thread=True, account=DEFAULT_ACCOUNT, archive_path=None) -> None:
         """
         Initializes the DBWrapper instance and establishes a connection to the database.
 
+        The transaction logs, sync checkpoints and position snapshots are partitioned by account: each
+        wrapper reads and writes the partition of its account, the market data tables are shared.
+
+        The closed months of the transaction logs can be compacted into a Parquet archive, see
+        compact_transaction_logs. The trade log reads combine the archive and SQLite.
+
         Args:
             db_path (str): Path to the SQLite database file.
+            check_same_thread (bool): Whether only the creating thread may use the connection.
+            account (str): Name of the account, see get_accounts.
+            archive_path (str): Directory of the Parquet archive, '<db name>_archive' next to the database by default.
         """
         self.logger = set_logger(name=__name__, log_file='db_wrapper.log', log_level='INFO')
 
         self.db_path = db_path
-        self.conn = sqlite3.connect(self.db_path)
+        self.account = account
+        self.archive_path = archive_path or os.path.splitext(db_path)[0] + '_archive'
+        self._archive = None
+        self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=check_same_thread)
         self.cursor = self.conn.cursor()
-        self._create_tables()          
+        self._table_columns = {}
+        self._set_pragmas()
+        self._migrate()
+
+    def _set_pragmas(self):
+        """
+        Sets the connection pragmas. WAL lets the GUI read while the sync writes.
+        """
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        self.cursor.execute("PRAGMA synchronous = NORMAL")
+        self.cursor.execute("PRAGMA temp_store = MEMORY")
+        self.cursor.execute("PRAGMA cache_size = -65536")
+        self.cursor.execute("PRAGMA mmap_size = 268435456")
+
+    def _migrate(self):
+        """
+        Applies the schema migrations newer than the database version, stored in PRAGMA user_version.
+        Each migration runs in its own transaction, holding the write lock.
+        """
+        migrations = [self._create_tables,
+                      self._migrate_integer_timestamps,
+                      self._create_delivery_prices_table,
+                      self._create_instruments_table,
+                      self._create_position_snapshots_table,
+                      self._partition_by_account,
+                      self._create_archive_partitions_table,
+                      self._create_price_history_table]
+
+        version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+        for target_version, migration in enumerate(migrations, start=1):
+            if version >= target_version:
+                continue
+            # the version is read again under the write lock, concurrent connections migrate only once
+            self.cursor.execute("BEGIN IMMEDIATE")
+            version = self.cursor.execute("PRAGMA user_version").fetchone()[0]
+            if version >= target_version:
+                self.conn.rollback()
+                continue
+            try:
+                migration()
+                self.cursor.execute(f"PRAGMA user_version = {target_version}")
+                self.conn.commit()
+            except Exception:
+                self.conn.rollback()
+                raise
+            self.logger.info(f"DB schema migrated to version {target_version}")
 
     def _create_tables(self):
         """
-        Creates the necessary tables if they don't exist in the database.
+        Schema version 1: creates the necessary tables if they don't exist in the database.
         """
         create_table_sql = '''
             CREATE TABLE IF NOT EXISTS trades (
@@ -100,85 +205,338 @@ class DBWrapper():
             '''
 
         self.cursor.execute(create_table_sql)
-        self.conn.commit()
 
-    def save_to_db(self, df, table_name, if_exists='append', index=False):
+        create_table_sql = '''
+            CREATE TABLE IF NOT EXISTS sync_checkpoints (
+                currency TEXT PRIMARY KEY,
+                last_user_seq INTEGER,
+                synced_from INTEGER,
+                synced_to INTEGER
+            );
+            '''
+
+        self.cursor.execute(create_table_sql)
+
+    def _migrate_integer_timestamps(self):
+        """
+        Schema version 2: stores timestamps as INTEGER and indexes the columns used by range queries.
+        """
+        self._change_column_type('trades', 'timestamp', 'INTEGER')
+        self._change_column_type('transaction_logs', 'timestamp', 'INTEGER')
+
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_logs_timestamp ON transaction_logs (timestamp)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_logs_type_timestamp ON transaction_logs (type, timestamp)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_logs_instrument_timestamp ON transaction_logs (instrument_name, timestamp)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_trades_timestamp ON trades (timestamp)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_trades_instrument_timestamp ON trades (instrument_name, timestamp)")
+
+    def _create_delivery_prices_table(self):
+        """
+        Schema version 3: stores the delivery prices of the indexes, which never change once published.
+        """
+        create_table_sql = '''
+            CREATE TABLE IF NOT EXISTS delivery_prices (
+                index_name TEXT,
+                date TEXT,
+                delivery_price REAL,
+                PRIMARY KEY (index_name, date)
+            );
+            '''
+        self.cursor.execute(create_table_sql)
+
+    def _create_instruments_table(self):
+        """
+        Schema version 4: stores the parsed details of the instruments.
+        """
+        create_table_sql = '''
+            CREATE TABLE IF NOT EXISTS instruments (
+                instrument_name TEXT PRIMARY KEY,
+                kind TEXT,
+                underlying TEXT,
+                expiry INTEGER,
+                strike REAL,
+                cp TEXT,
+                contract_size REAL
+            );
+            '''
+        self.cursor.execute(create_table_sql)
+
+    def _create_position_snapshots_table(self):
+        """
+        Schema version 5: stores daily position snapshots, the state of each instrument including the
+        fills before snapshot_ts, and the range of trade history they were built from.
+        """
+        create_table_sql = '''
+            CREATE TABLE IF NOT EXISTS position_snapshots (
+                instrument_name TEXT,
+                snapshot_ts INTEGER,
+                currency TEXT,
+                trade_type TEXT,
+                buy REAL,
+                sell REAL,
+                buy_notional REAL,
+                sell_notional REAL,
+                avg_long REAL,
+                avg_short REAL,
+                realized_pl REAL,
+                PRIMARY KEY (instrument_name, snapshot_ts)
+            );
+            '''
+        self.cursor.execute(create_table_sql)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_position_snapshots_ts ON position_snapshots (snapshot_ts)")
+
+        create_table_sql = '''
+            CREATE TABLE IF NOT EXISTS position_snapshot_range (
+                id INTEGER PRIMARY KEY CHECK (id = 0),
+                history_from INTEGER,
+                built_until INTEGER
+            );
+            '''
+        self.cursor.execute(create_table_sql)
+
+    def _partition_by_account(self):
+        """
+        Schema version 6: adds a leading account column to the primary keys and indexes of the tables
+        holding the data of an account. The existing rows belong to the default account.
+        """
+        self._add_account_column('transaction_logs', ['id', 'currency'])
+        self._add_account_column('sync_checkpoints', ['currency'])
+        self._add_account_column('position_snapshots', ['instrument_name', 'snapshot_ts'])
+        self._add_account_column('position_snapshot_range', [])
+
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_logs_timestamp ON transaction_logs (account, timestamp)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_logs_type_timestamp ON transaction_logs (account, type, timestamp)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_transaction_logs_instrument_timestamp ON transaction_logs (account, instrument_name, timestamp)")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_position_snapshots_ts ON position_snapshots (account, snapshot_ts)")
+
+    def _create_archive_partitions_table(self):
+        """
+        Schema version 7: lists the Parquet files of the transaction logs archive, with the time range of
+        their logs and trades for partition pruning.
+        """
+        create_table_sql = '''
+            CREATE TABLE IF NOT EXISTS archive_partitions (
+                account TEXT NOT NULL,
+                file TEXT NOT NULL,
+                currency TEXT,
+                month_start INTEGER,
+                month_end INTEGER,
+                rows INTEGER,
+                first_ts INTEGER,
+                last_ts INTEGER,
+                first_trade_ts INTEGER,
+                last_trade_ts INTEGER,
+                PRIMARY KEY (account, file)
+            );
+            '''
+        self.cursor.execute(create_table_sql)
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS idx_archive_partitions_month ON archive_partitions (account, month_start)")
+
+    def _create_price_history_table(self):
+        """
+        Schema version 8: stores the historical prices of the instruments and indexes, and the time range
+        fetched for each of them.
+        """
+        create_table_sql = '''
+            CREATE TABLE IF NOT EXISTS price_history (
+                name TEXT,
+                resolution TEXT,
+                timestamp INTEGER,
+                price REAL,
+                PRIMARY KEY (name, resolution, timestamp)
+            );
+            '''
+        self.cursor.execute(create_table_sql)
+
+        create_table_sql = '''
+            CREATE TABLE IF NOT EXISTS price_history_range (
+                name TEXT,
+                resolution TEXT,
+                fetched_from INTEGER,
+                fetched_to INTEGER,
+                PRIMARY KEY (name, resolution)
+            );
+            '''
+        self.cursor.execute(create_table_sql)
+
+    def _add_account_column(self, table_name, primary_key):
+        """
+        Rebuilds a table with an account column leading its primary key. The indexes of the table are dropped.
+
+        Args:
+            table_name (str): Name of the database table.
+            primary_key (list): Columns of the primary key after the account.
+        """
+        self.cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+        create_table_sql = self.cursor.fetchone()[0]
+        # renamed tables are stored with a quoted name
+        create_table_sql = re.sub(rf'CREATE TABLE (IF NOT EXISTS )?"?{table_name}"?', f'CREATE TABLE {table_name}_migration',
+                                  create_table_sql, count=1)
+        # the previous primary key, inline or as a table constraint, and its check are replaced
+        create_table_sql = re.sub(r',\s*PRIMARY KEY\s*\([^)]*\)', '', create_table_sql)
+        create_table_sql = re.sub(r'\s+PRIMARY KEY\b', '', create_table_sql)
+        create_table_sql = re.sub(r'\s+CHECK\s*\([^)]*\)', '', create_table_sql)
+        create_table_sql = create_table_sql.replace('(', f"(\n                account TEXT NOT NULL DEFAULT '{DEFAULT_ACCOUNT}',", 1)
+        closing = create_table_sql.rindex(')')
+        create_table_sql = (create_table_sql[:closing].rstrip()
+                            + f",\n                PRIMARY KEY ({', '.join(['account'] + primary_key)})\n            )")
+
+        columns = self._get_table_columns(table_name)
+        self.cursor.execute(create_table_sql)
+        self.cursor.execute(f'''
+            INSERT INTO {table_name}_migration ({', '.join(columns)})
+            SELECT {', '.join(columns)}
+            FROM {table_name}
+            ''')
+        self.cursor.execute(f"DROP TABLE {table_name}")
+        self.cursor.execute(f"ALTER TABLE {table_name}_migration RENAME TO {table_name}")
+        self._table_columns.pop(table_name, None)
+
+    def _change_column_type(self, table_name, column, column_type):
+        """
+        Changes the declared type of a column by rebuilding the table, SQLite cannot alter it in place.
+        Existing values are cast to the new type.
+
+        Args:
+            table_name (str): Name of the database table.
+            column (str): Name of the column.
+            column_type (str): New SQLite type of the column.
+        """
+        self.cursor.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,))
+        create_table_sql = self.cursor.fetchone()[0]
+        create_table_sql = re.sub(rf'CREATE TABLE (IF NOT EXISTS )?{table_name}\b', f'CREATE TABLE {table_name}_migration',
+                                  create_table_sql, count=1)
+        create_table_sql = re.sub(rf'\b{column}\s+\w+', f'{column} {column_type}', create_table_sql, count=1)
+
+        columns = self._get_table_columns(table_name)
+        select_columns = [f'CAST({name} AS {column_type})' if name == column else name for name in columns]
+        self.cursor.execute(create_table_sql)
+        self.cursor.execute(f'''
+            INSERT INTO {table_name}_migration ({', '.join(columns)})
+            SELECT {', '.join(select_columns)}
+            FROM {table_name}
+            ''')
+        self.cursor.execute(f"DROP TABLE {table_name}")
+        self.cursor.execute(f"ALTER TABLE {table_name}_migration RENAME TO {table_name}")
+
+    def save_to_db(self, df, table_name, if_exists='append', commit=True):
         """
-        Saves a DataFrame to the specified database table.
+        Saves a DataFrame to the specified database table in one transaction. Rows whose primary key
+        already exists in the table are ignored. Rows of the tables partitioned by account are saved
+        to the account of the wrapper.
 
         Args:
             df (pd.DataFrame): DataFrame to be saved.
             table_name (str): Name of the database table.
-            if_exists (str): Behavior when the table already exists ('fail', 'replace', 'append').
-            index (bool): Whether to include the index in the table.
+            if_exists (str): Behavior when the table already holds rows ('append', 'replace').
+            commit (bool): Whether to commit, the caller commits the current transaction otherwise.
 
         Returns:
             None
         """
-        df = self._exclude_existing_records_from_df(df, table_name)
-        df = self._convert_dtypes(df)
-        df.to_sql(name=table_name, con=self.conn, if_exists=if_exists, index=index)
-        self.conn.commit()
+        if 'account' in self._get_table_columns(table_name):
+            df = df.assign(account=self.account)
+        columns = [column for column in df.columns if column in self._get_table_columns(table_name)]
+        ignored_columns = set(df.columns) - set(columns)
+        if ignored_columns:
+            self.logger.warning(f"Columns not in {table_name} ignored : {sorted(ignored_columns)}")
 
-    def _get_unique_keys(self, table_name):
+        rows = self._convert_dtypes(df[columns])
+        self._insert_rows(table_name, columns, rows.itertuples(index=False, name=None), len(rows), if_exists, commit)
+
+    def save_records(self, records, table_name, commit=True):
         """
-        Retrieves primary keys and all key combinations from a table.
+        Saves records, e.g. the entries of an API response, without building a DataFrame. Rows whose
+        primary key already exists in the table are ignored, keys missing from a record are saved as
+        NULL and nested values as text.
 
         Args:
+            records (list): Dicts keyed by column name.
             table_name (str): Name of the database table.
-
-        Returns:
-            primary_keys (list): List of primary key column names.
-            all_keys_combinations (list): List of tuples representing existing key combinations.
+            commit (bool): Whether to commit, the caller commits the current transaction otherwise.
         """
-        self.cursor.execute(f"SELECT * FROM pragma_table_info('{table_name}') WHERE pk")
-        table_info = self.cursor.fetchall()
+        if not records:
+            return
+        columns = [column for column in self._get_table_columns(table_name) if column != 'account']
+        ignored_columns = set(records[0]) - set(columns)
+        if ignored_columns:
+            self.logger.warning(f"Columns not in {table_name} ignored : {sorted(ignored_columns)}")
 
-        primary_keys = [column[1] for column in table_info]
+        prefix = (self.account,) if 'account' in self._get_table_columns(table_name) else ()
 
-        all_keys_combinations_sql = f'''
-            SELECT {primary_keys[0]}, {primary_keys[1]}
-            FROM {table_name}
+        def to_row(record):
+            return prefix + tuple(str(value) if isinstance(value, (dict, list)) else value
+                                  for value in map(record.get, columns))
+
+        self._insert_rows(table_name, ['account'] * len(prefix) + columns, map(to_row, records), len(records), 'append', commit)
+
+    def _insert_rows(self, table_name, columns, rows, row_count, if_exists, commit):
+        """
+        Inserts rows of python values, ignoring the rows whose primary key already exists.
+
+        Args:
+            table_name (str): Name of the database table.
+            columns (list): Columns of the rows.
+            rows (iterable): Tuples of values.
+            row_count (int): Number of rows, for the logs and counters.
+            if_exists (str): Behavior when the table already holds rows ('append', 'replace').
+            commit (bool): Whether to commit the transaction.
+        """
+        insert_sql = f'''
+            INSERT OR IGNORE INTO {table_name} ({', '.join(columns)})
+            VALUES ({', '.join(['?'] * len(columns))})
             '''
-        
-        self.cursor.execute(all_keys_combinations_sql)
-        all_keys_combinations = self.cursor.fetchall()
+        changes_before = self.conn.total_changes
+        with tracer.span('db.save_to_db', table=table_name, rows=row_count):
+            with self.conn if commit else nullcontext():
+                if if_exists == 'replace' and 'account' in columns:
+                    self.cursor.execute(f"DELETE FROM {table_name} WHERE account = ?", (self.account,))
+                    changes_before = self.conn.total_changes
+                elif if_exists == 'replace':
+                    self.cursor.execute(f"DELETE FROM {table_name}")
+                    changes_before = self.conn.total_changes
+                self.cursor.executemany(insert_sql, rows)
+        self.logger.info(f"Number of new rows saved in DB : {self.conn.total_changes - changes_before}")
+        if tracer.enabled:
+            tracer.count('db.rows_offered', row_count)
+            tracer.count('db.rows_written', self.conn.total_changes - changes_before)
 
-        return primary_keys, all_keys_combinations
-    
-    def _convert_dtypes(self, df):
+    def _get_table_columns(self, table_name):
         """
-        Converts DataFrame column data types for compatibility.
+        Retrieves the column names of a table.
 
         Args:
-            df (pd.DataFrame): DataFrame to be converted.
+            table_name (str): Name of the database table.
 
         Returns:
-            df (pd.DataFrame): Converted DataFrame.
+            columns (list): List of column names.
         """
-        for column in df.columns:
-            df[column] = df[column].apply(convert_to_int_or_str)
-        return df
+        if table_name not in self._table_columns:
+            self.cursor.execute(f"SELECT name FROM pragma_table_info('{table_name}')")
+            self._table_columns[table_name] = [column[0] for column in self.cursor.fetchall()]
+        return self._table_columns[table_name]
     
-    def _exclude_existing_records_from_df(self, df, table_name):
+    def _convert_dtypes(self, df):
         """
-        Excludes existing records from the DataFrame based on primary keys.
+        Converts DataFrame values to types supported by sqlite3, column by column. Numeric columns are
+        bound as numbers (SQLite stores NaN as NULL), the other missing values become NULL and nested
+        values are stored as text, the column affinity does the rest.
 
         Args:
-            df (pd.DataFrame): DataFrame to be filtered.
-            table_name (str): Name of the database table.
+            df (pd.DataFrame): DataFrame to be converted.
 
         Returns:
-            df_filtered (pd.DataFrame): Filtered DataFrame without existing records.
+            df (pd.DataFrame): Converted DataFrame, of python objects outside the numeric columns.
         """
-        table_keys, existing_records = self._get_unique_keys(table_name)
-
-        def filter_pairs(row):
-            return (convert_to_int_or_str(row[table_keys[0]]), convert_to_int_or_str(row[table_keys[1]])) not in existing_records
-
-        df_filtered = df[df.apply(filter_pairs, axis=1)]
-        self.logger.info(f"Number of new rows saved in DB : {df_filtered.shape[0]}")
-        return df_filtered
+        df = df.copy()
+        for column in df.columns:
+            values = df[column]
+            if values.dtype.kind in 'biuf':
+                continue
+            if values.dtype == object and values.map(type).isin([dict, list]).any():
+                values = values.map(lambda value: str(value) if isinstance(value, (dict, list)) else value)
+            df[column] = values.astype(object).where(values.notna(), None)
+        return df
 
     def get_transactions_by_datetime_range(self, start_range=None, end_range=None):
         """
@@ -196,12 +554,19 @@ class DBWrapper():
         if start_range == None:
             start_range = end_range - timedelta(weeks=2)
 
-        sql_query = f'''
+        sql_query = '''
             SELECT *
             FROM transaction_logs
-            WHERE timestamp >= {datetime_to_unix_ms(start_range)} AND timestamp <= {datetime_to_unix_ms(end_range)}
+            WHERE account = ? AND timestamp >= ? AND timestamp <= ?
             '''
-        return pd.read_sql_query(sql_query, self.conn)
+        start_ts, end_ts = datetime_to_unix_ms(start_range), datetime_to_unix_ms(end_range)
+        transactions_df = pd.read_sql_query(sql_query, self.conn, params=(self.account, start_ts, end_ts))
+        files = self._get_archive_files(start_ts, end_ts)
+        if files:
+            archived = self._get_archive().read(files, start_ts=start_ts, end_ts=end_ts).to_pandas()
+            transactions_df = pd.concat([archived, transactions_df.drop(columns='account')], ignore_index=True)\
+                                .sort_values('timestamp', kind='stable', ignore_index=True)
+        return transactions_df
     
     def get_trades_by_datetime_range(self, start_range=None, end_range=None):
         """
@@ -219,10 +584,507 @@ class DBWrapper():
         if start_range == None:
             start_range = end_range - timedelta(weeks=2)
 
-        sql_query = f'''
+        sql_query = '''
             SELECT *
             FROM trades
-            WHERE timestamp >= {datetime_to_unix_ms(start_range)} AND timestamp <= {datetime_to_unix_ms(end_range)}
+            WHERE timestamp >= ? AND timestamp <= ?
             '''
-        return pd.read_sql_query(sql_query, self.conn)
+        return pd.read_sql_query(sql_query, self.conn,
+                                 params=(datetime_to_unix_ms(start_range), datetime_to_unix_ms(end_range)))
+
+    def _trade_logs_query(self, start_range, end_range, columns):
+        if end_range == None:
+            end_range = datetime.now()
+        if start_range == None:
+            start_range = end_range - timedelta(weeks=2)
+        if columns is None:
+            columns = list(TRADE_LOG_COLUMNS)
 
+        sql_query = f'''
+            SELECT {', '.join(columns)}
+            FROM transaction_logs
+            WHERE account = ? AND type = 'trade'
+              AND timestamp >= ? AND timestamp <= ?
+              AND instr(instrument_name, '_') = 0
+            ORDER BY timestamp
+            '''
+        params = (self.account,) + tuple(value if isinstance(value, int) else datetime_to_unix_ms(value)
+                                         for value in (start_range, end_range))
+        return sql_query, params, columns, {column: TRADE_LOG_COLUMNS[column] for column in columns if column in TRADE_LOG_COLUMNS}
+
+    def get_trade_logs_by_datetime_range(self, start_range=None, end_range=None, columns=None):
+        """
+        Retrieves the trade entries of the transaction logs within the specified datetime range.
+        Filtering and column selection run in SQL and in the archive files of the range, combo legs
+        (instrument names containing '_') are excluded.
+
+        Args:
+            start_range (datetime): Start of the datetime range, or unix ms.
+            end_range (datetime): End of the datetime range, or unix ms.
+            columns (list): Columns to retrieve, defaults to TRADE_LOG_COLUMNS.
+
+        Returns:
+            trades_df (pd.DataFrame): Typed DataFrame containing the trades within the range.
+        """
+        _, params, columns, dtype = self._trade_logs_query(start_range, end_range, columns)
+        trades_df = self._read_trade_logs(params[1], params[2], columns)
+        files = self._get_archive_files(params[1], params[2])
+        if files:
+            trades_df = concat_trade_logs([self._read_archived_trade_logs(files, columns, params[1], params[2]).astype(dtype),
+                                           trades_df])
+            if 'timestamp' in columns:
+                trades_df = trades_df.sort_values('timestamp', kind='stable', ignore_index=True)
+        return trades_df
+
+    def _read_trade_logs(self, start_ts, end_ts, columns):
+        sql_query, params, _, dtype = self._trade_logs_query(start_ts, end_ts, columns)
+        with tracer.span('db.get_trade_logs'):
+            trades_df = pd.read_sql_query(sql_query, self.conn, params=params, dtype=dtype)
+        if tracer.enabled:
+            tracer.count('db.rows_read', len(trades_df))
+        return trades_df
+
+    def iter_trade_logs_by_datetime_range(self, start_range=None, end_range=None, chunk_size=100_000, columns=None):
+        """
+        Yields the trade entries of get_trade_logs_by_datetime_range in timestamp-ordered chunks, a single
+        chunk is held in memory at a time. The chunks are read on their own cursor, so the connection can
+        be written to between them. The months with archive files are read whole, merged with their
+        SQLite rows, and then chunked.
+
+        Args:
+            start_range (datetime): Start of the datetime range, or unix ms.
+            end_range (datetime): End of the datetime range, or unix ms.
+            chunk_size (int): Maximum number of trades per chunk.
+            columns (list): Columns to retrieve, defaults to TRADE_LOG_COLUMNS.
+
+        Yields:
+            trades_df (pd.DataFrame): Typed DataFrame containing the next trades of the range.
+        """
+        _, params, columns, dtype = self._trade_logs_query(start_range, end_range, columns)
+        start_ts, end_ts = params[1], params[2]
+        archived_months = {}
+        for month_start, month_end, file in self._get_archive_files(start_ts, end_ts, with_months=True):
+            archived_months.setdefault((month_start, month_end), []).append(file)
+
+        for (month_start, month_end), files in sorted(archived_months.items()):
+            if start_ts < month_start:
+                yield from self._iter_trade_logs(start_ts, month_start - 1, chunk_size, columns)
+            month_start, month_end = max(start_ts, month_start), min(end_ts, month_end - 1)
+            month = concat_trade_logs([self._read_archived_trade_logs(files, columns, month_start, month_end).astype(dtype),
+                                       self._read_trade_logs(month_start, month_end, columns)])
+            if 'timestamp' in columns:
+                month = month.sort_values('timestamp', kind='stable', ignore_index=True)
+            for offset in range(0, len(month), chunk_size):
+                yield month.iloc[offset:offset + chunk_size].reset_index(drop=True)
+            start_ts = month_end + 1
+        if start_ts <= end_ts:
+            yield from self._iter_trade_logs(start_ts, end_ts, chunk_size, columns)
+
+    def _iter_trade_logs(self, start_ts, end_ts, chunk_size, columns):
+        sql_query, params, _, dtype = self._trade_logs_query(start_ts, end_ts, columns)
+        cursor = self.conn.execute(sql_query, params)
+        try:
+            columns = [description[0] for description in cursor.description]
+            while True:
+                with tracer.span('db.get_trade_logs'):
+                    rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    return
+                if tracer.enabled:
+                    tracer.count('db.rows_read', len(rows))
+                yield pd.DataFrame.from_records(rows, columns=columns).astype(dtype)
+        finally:
+            cursor.close()
+
+    def get_trade_log_instruments(self, start_range=None, end_range=None):
+        """
+        Retrieves the instruments traded within the specified datetime range, without reading the trades.
+
+        Args:
+            start_range (datetime): Start of the datetime range, or unix ms.
+            end_range (datetime): End of the datetime range, or unix ms.
+
+        Returns:
+            instruments (dict): Currency by instrument name.
+        """
+        sql_query, params, columns, _ = self._trade_logs_query(start_range, end_range, ['instrument_name', 'currency'])
+        sql_query = sql_query.replace('SELECT', 'SELECT DISTINCT', 1).replace('ORDER BY timestamp', '')
+        instruments = dict(self.conn.execute(sql_query, params).fetchall())
+        files = self._get_archive_files(params[1], params[2])
+        if files:
+            archived = self._get_archive().read(files, columns, params[1], params[2], trades_only=True)\
+                           .group_by(columns).aggregate([])
+            instruments.update(zip(archived['instrument_name'].to_pylist(), archived['currency'].to_pylist()))
+        return instruments
+
+    def get_trade_log_time_range(self):
+        """
+        Retrieves the timestamps of the first and last trades of the transaction logs, read from the
+        (account, type, timestamp) index and the archive partitions.
+
+        Returns:
+            time_range (tuple): (first, last) timestamps in unix ms, None if there are no trades.
+        """
+        self.cursor.execute('''
+            SELECT MIN(first_ts), MAX(last_ts)
+            FROM (SELECT MIN(timestamp) AS first_ts, MAX(timestamp) AS last_ts
+                  FROM transaction_logs WHERE account = ? AND type = 'trade'
+                  UNION ALL
+                  SELECT MIN(first_trade_ts), MAX(last_trade_ts)
+                  FROM archive_partitions WHERE account = ?)
+            ''', (self.account, self.account))
+        row = self.cursor.fetchone()
+        return None if row[0] is None else row
+
+    def _get_archive(self):
+        if self._archive is None:
+            # pyarrow is only needed once the transaction logs are archived
+            from archive import ParquetArchive
+            self.cursor.execute("SELECT name, type FROM pragma_table_info('transaction_logs') WHERE name != 'account'")
+            self._archive = ParquetArchive(self.archive_path, dict(self.cursor.fetchall()))
+        return self._archive
+
+    def _get_archive_files(self, start_ts, end_ts, with_months=False):
+        """
+        Retrieves the archive files of the account holding logs within a time range (unix ms, inclusive).
+
+        Args:
+            start_ts (int): Start of the range.
+            end_ts (int): End of the range.
+            with_months (bool): Whether to return the (month_start, month_end, file) of the files.
+
+        Returns:
+            files (list): Paths of the files relative to the archive root, ordered by month and currency.
+        """
+        self.cursor.execute('''
+            SELECT month_start, month_end, file
+            FROM archive_partitions
+            WHERE account = ? AND month_start <= ? AND month_end > ?
+              AND last_ts >= ? AND first_ts <= ?
+            ORDER BY month_start, currency, file
+            ''', (self.account, end_ts, start_ts, start_ts, end_ts))
+        rows = self.cursor.fetchall()
+        return rows if with_months else [row[2] for row in rows]
+
+    def _read_archived_trade_logs(self, files, columns, start_ts, end_ts):
+        with tracer.span('db.read_archive', files=len(files)):
+            trades_df = self._get_archive().read(files, columns, start_ts, end_ts, trades_only=True).to_pandas()
+        if tracer.enabled:
+            tracer.count('db.archive_rows_read', len(trades_df))
+        return trades_df
+
+    def compact_transaction_logs(self, before=None):
+        """
+        Moves the transaction logs of the closed months from SQLite to the Parquet archive, one file per
+        currency and month. Only the months synced to their end and starting before the month of `before`
+        are archived, SQLite keeps the recent logs written by the sync.
+
+        Args:
+            before (datetime): Logs of the months before the month of this date are archived, defaults to now.
+
+        Returns:
+            partitions (list): (currency, month, rows) of the archived partitions.
+        """
+        archive = self._get_archive()
+        before = (before or datetime.now()).strftime('%Y-%m')
+        checkpoints = self.get_sync_checkpoints()
+        self.cursor.execute('''
+            SELECT currency, strftime('%Y-%m', timestamp / 1000, 'unixepoch') AS month,
+                   CAST(strftime('%s', timestamp / 1000, 'unixepoch', 'start of month') AS INTEGER) * 1000,
+                   CAST(strftime('%s', timestamp / 1000, 'unixepoch', 'start of month', '+1 month') AS INTEGER) * 1000
+            FROM transaction_logs
+            WHERE account = ?
+            GROUP BY currency, month
+            HAVING month < ?
+            ORDER BY month, currency
+            ''', (self.account, before))
+        months = self.cursor.fetchall()
+
+        partitions = []
+        for currency, month, month_start, month_end in months:
+            synced_to = checkpoints.get(currency, {}).get('synced_to')
+            if synced_to is None or synced_to < month_end:
+                continue
+            file = None
+            with tracer.span('db.compact_partition', currency=currency, month=month):
+                # the logs are read, archived and deleted under the write lock, a concurrent backfill is not lost
+                self.cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    logs = pd.read_sql_query('''
+                        SELECT * FROM transaction_logs
+                        WHERE account = ? AND currency = ? AND timestamp >= ? AND timestamp < ?
+                        ORDER BY timestamp
+                        ''', self.conn, params=(self.account, currency, month_start, month_end))
+                    file = archive.write(logs.drop(columns='account'), self.account, currency, month)
+                    trades = logs[logs['type'] == 'trade']
+                    self.cursor.execute('''
+                        INSERT INTO archive_partitions (account, file, currency, month_start, month_end, rows,
+                                                        first_ts, last_ts, first_trade_ts, last_trade_ts)
+                        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                        ''', (self.account, file, currency, month_start, month_end, len(logs),
+                              int(logs['timestamp'].min()), int(logs['timestamp'].max()),
+                              None if trades.empty else int(trades['timestamp'].min()),
+                              None if trades.empty else int(trades['timestamp'].max())))
+                    self.cursor.execute('''
+                        DELETE FROM transaction_logs
+                        WHERE account = ? AND currency = ? AND timestamp >= ? AND timestamp < ?
+                        ''', (self.account, currency, month_start, month_end))
+                    self.conn.commit()
+                except Exception:
+                    self.conn.rollback()
+                    if file is not None:
+                        archive.remove(file)
+                    raise
+            self.logger.info(f"Archived {len(logs)} transaction logs of {self.account} {currency} {month} to {file}")
+            partitions.append((currency, month, len(logs)))
+        return partitions
+
+    def get_sync_checkpoint(self, currency):
+        """
+        Retrieves the transaction log sync checkpoint of a currency.
+
+        Args:
+            currency (str): Currency code.
+
+        Returns:
+            checkpoint (dict): 'last_user_seq', 'synced_from' and 'synced_to' (unix ms), None if never synced.
+        """
+        self.cursor.execute('''
+            SELECT last_user_seq, synced_from, synced_to
+            FROM sync_checkpoints
+            WHERE account = ? AND currency = ?
+            ''', (self.account, currency))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return {'last_user_seq': row[0], 'synced_from': row[1], 'synced_to': row[2]}
+
+    def save_sync_checkpoint(self, currency, last_user_seq, synced_from, synced_to, commit=True):
+        """
+        Saves the transaction log sync checkpoint of a currency.
+
+        Args:
+            currency (str): Currency code.
+            last_user_seq (int): Highest user_seq saved in DB.
+            synced_from (int): Start of the synced window (unix ms).
+            synced_to (int): End of the synced window (unix ms).
+            commit (bool): Whether to commit, the caller commits the current transaction otherwise.
+        """
+        self.cursor.execute('''
+            INSERT OR REPLACE INTO sync_checkpoints (account, currency, last_user_seq, synced_from, synced_to)
+            VALUES (?, ?, ?, ?, ?)
+            ''', (self.account, currency, last_user_seq, synced_from, synced_to))
+        if commit:
+            self.conn.commit()
+
+    def get_sync_checkpoints(self):
+        """
+        Retrieves the transaction log sync checkpoints of all currencies.
+
+        Returns:
+            checkpoints (dict): Checkpoint by currency, see get_sync_checkpoint.
+        """
+        self.cursor.execute('''
+            SELECT currency, last_user_seq, synced_from, synced_to
+            FROM sync_checkpoints
+            WHERE account = ?
+            ORDER BY currency
+            ''', (self.account,))
+        return {row[0]: {'last_user_seq': row[1], 'synced_from': row[2], 'synced_to': row[3]}
+                for row in self.cursor.fetchall()}
+
+    def get_delivery_prices(self, index_name, dates):
+        """
+        Retrieves the stored delivery prices of an index.
+
+        Args:
+            index_name (str): Index name, e.g. 'btc_usd'.
+            dates (list): Delivery dates as 'YYYY-MM-DD' strings.
+
+        Returns:
+            delivery_prices (dict): Delivery price by date, dates not stored are omitted.
+        """
+        dates = list(dates)
+        self.cursor.execute(f'''
+            SELECT date, delivery_price
+            FROM delivery_prices
+            WHERE index_name = ? AND date IN ({', '.join(['?'] * len(dates))})
+            ''', [index_name] + dates)
+        return dict(self.cursor.fetchall())
+
+    def save_delivery_prices(self, index_name, delivery_prices):
+        """
+        Saves delivery prices of an index, as returned by public/get_delivery_prices.
+
+        Args:
+            index_name (str): Index name, e.g. 'btc_usd'.
+            delivery_prices (list): Dicts with the 'date' and 'delivery_price'.
+        """
+        with self.conn:
+            self.cursor.executemany('''
+                INSERT OR IGNORE INTO delivery_prices (index_name, date, delivery_price)
+                VALUES (?, ?, ?)
+                ''', [(index_name, row['date'], row['delivery_price']) for row in delivery_prices])
+
+    def get_price_history_ranges(self, names, resolution):
+        """
+        Retrieves the time ranges of the stored price histories.
+
+        Args:
+            names (list): Instrument names or currency codes.
+            resolution (str): Resolution of the prices, e.g. '1D'.
+
+        Returns:
+            ranges (dict): (fetched_from, fetched_to) in unix ms by name, names never fetched are omitted.
+        """
+        names = list(names)
+        self.cursor.execute(f'''
+            SELECT name, fetched_from, fetched_to
+            FROM price_history_range
+            WHERE resolution = ? AND name IN ({', '.join(['?'] * len(names))})
+            ''', [resolution] + names)
+        return {name: (fetched_from, fetched_to) for name, fetched_from, fetched_to in self.cursor.fetchall()}
+
+    def save_price_history(self, name, resolution, prices, fetched_from, fetched_to):
+        """
+        Saves historical prices and extends the fetched time range of the name, in one transaction.
+
+        Args:
+            name (str): Instrument name or currency code.
+            resolution (str): Resolution of the prices, e.g. '1D'.
+            prices (list): Tuples of (timestamp, price), timestamp in unix ms.
+            fetched_from (int): Start of the fetched range, adjacent to the stored range.
+            fetched_to (int): End of the fetched range, adjacent to the stored range.
+        """
+        with self.conn:
+            self.cursor.executemany('''
+                INSERT OR REPLACE INTO price_history (name, resolution, timestamp, price)
+                VALUES (?, ?, ?, ?)
+                ''', [(name, resolution, timestamp, price) for timestamp, price in prices])
+            self.cursor.execute('''
+                INSERT INTO price_history_range (name, resolution, fetched_from, fetched_to)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (name, resolution) DO UPDATE
+                SET fetched_from = MIN(fetched_from, excluded.fetched_from),
+                    fetched_to = MAX(fetched_to, excluded.fetched_to)
+                ''', (name, resolution, fetched_from, fetched_to))
+
+    def get_price_history(self, names, resolution, start_ts, end_ts):
+        """
+        Retrieves the stored historical prices of instruments and currencies within a time range.
+
+        Args:
+            names (list): Instrument names or currency codes.
+            resolution (str): Resolution of the prices, e.g. '1D'.
+            start_ts (int): Start of the range in unix ms.
+            end_ts (int): End of the range in unix ms.
+
+        Returns:
+            prices (pd.DataFrame): 'name', 'timestamp' and 'price', sorted by timestamp.
+        """
+        names = list(names)
+        return pd.read_sql_query(f'''
+            SELECT name, timestamp, price
+            FROM price_history
+            WHERE resolution = ? AND timestamp >= ? AND timestamp <= ?
+              AND name IN ({', '.join(['?'] * len(names))})
+            ORDER BY timestamp
+            ''', self.conn, params=[resolution, start_ts, end_ts] + names)
+
+    def get_instruments(self):
+        """
+        Retrieves the stored instrument details.
+
+        Returns:
+            instruments (list): Tuples of (instrument_name, kind, underlying, expiry, strike, cp, contract_size),
+                                expiry in unix ms.
+        """
+        self.cursor.execute('''
+            SELECT instrument_name, kind, underlying, expiry, strike, cp, contract_size
+            FROM instruments
+            ''')
+        return self.cursor.fetchall()
+
+    def save_instruments(self, instruments):
+        """
+        Saves instrument details.
+
+        Args:
+            instruments (list): Tuples of (instrument_name, kind, underlying, expiry, strike, cp, contract_size),
+                                expiry in unix ms.
+        """
+        with self.conn:
+            self.cursor.executemany('''
+                INSERT OR IGNORE INTO instruments (instrument_name, kind, underlying, expiry, strike, cp, contract_size)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ''', instruments)
+
+    def get_position_snapshot_range(self):
+        """
+        Retrieves the range of the position snapshots.
+
+        Returns:
+            snapshot_range (dict): 'history_from', the first trade timestamp when the snapshots were built,
+                                   and 'built_until', the last snapshot_ts (unix ms). None if never built.
+        """
+        self.cursor.execute('''
+            SELECT history_from, built_until
+            FROM position_snapshot_range
+            WHERE account = ?
+            ''', (self.account,))
+        row = self.cursor.fetchone()
+        if row is None:
+            return None
+        return {'history_from': row[0], 'built_until': row[1]}
+
+    def get_position_snapshots(self, snapshot_ts):
+        """
+        Retrieves the latest snapshot of each instrument taken at or before snapshot_ts.
+
+        Args:
+            snapshot_ts (int): Time of the snapshot (unix ms).
+
+        Returns:
+            snapshots (pd.DataFrame): Snapshots indexed by instrument_name.
+        """
+        sql_query = '''
+            SELECT s.instrument_name, s.snapshot_ts, s.currency, s.trade_type, s.buy, s.sell,
+                   s.buy_notional, s.sell_notional, s.avg_long, s.avg_short, s.realized_pl
+            FROM position_snapshots s
+            JOIN (SELECT instrument_name, MAX(snapshot_ts) AS snapshot_ts
+                  FROM position_snapshots
+                  WHERE account = ? AND snapshot_ts <= ?
+                  GROUP BY instrument_name) latest
+              ON s.account = ? AND s.instrument_name = latest.instrument_name AND s.snapshot_ts = latest.snapshot_ts
+            '''
+        return pd.read_sql_query(sql_query, self.conn, params=(self.account, snapshot_ts, self.account), index_col='instrument_name')
+
+    def save_position_snapshots(self, snapshots, history_from, built_until):
+        """
+        Saves position snapshots and the new range of the snapshots in one transaction.
+
+        Args:
+            snapshots (pd.DataFrame): Snapshots with the columns of the position_snapshots table.
+            history_from (int): First trade timestamp of the history the snapshots were built from (unix ms).
+            built_until (int): Last snapshot_ts (unix ms).
+        """
+        columns = self._get_table_columns('position_snapshots')
+        rows = self._convert_dtypes(snapshots.assign(account=self.account).reindex(columns=columns)).itertuples(index=False, name=None)
+        with self.conn:
+            self.cursor.executemany(f'''
+                INSERT OR REPLACE INTO position_snapshots ({', '.join(columns)})
+                VALUES ({', '.join(['?'] * len(columns))})
+                ''', rows)
+            self.cursor.execute('''
+                INSERT OR REPLACE INTO position_snapshot_range (account, id, history_from, built_until)
+                VALUES (?, 0, ?, ?)
+                ''', (self.account, history_from, built_until))
+        self.logger.info(f"Number of position snapshots saved in DB : {len(snapshots)}")
+
+    def clear_position_snapshots(self):
+        """
+        Deletes the position snapshots of the account, e.g. once older trades were backfilled.
+        """
+        with self.conn:
+            self.cursor.execute("DELETE FROM position_snapshots WHERE account = ?", (self.account,))
+            self.cursor.execute("DELETE FROM position_snapshot_range WHERE account = ?", (self.account,))
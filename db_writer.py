@@ -0,0 +1,152 @@
+import asyncio
+import queue
+import threading
+from concurrent.futures import Future
+
+from db_wrapper import DBWrapper
+from tracing import tracer
+from utils import *
+
+_STOP = object()
+
+
+class DBWriter():
+    def __init__(self, db_path, account=DEFAULT_ACCOUNT, max_queue=16, max_batches=32) -> None:
+        """
+        Initializes the DBWriter, a thread owning its own SQLite connection that applies the writes
+        queued by the event loop. The writes waiting in the queue are applied in one transaction, so
+        the network and the disk overlap and the commits are amortized.
+
+        Args:
+            db_path (str): Path to the SQLite database file.
+            account (str): Account of the writes, see DBWrapper.
+            max_queue (int): Writes the queue holds before submit waits, bounding the parsed pages in memory.
+            max_batches (int): Maximum writes per transaction.
+        """
+        self.logger = set_logger(name=__name__, log_file='db_writer.log', log_level='INFO')
+
+        self.db_path = db_path
+        self.account = account
+        self.max_batches = max_batches
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._thread = None
+        self._error = None
+
+    def start(self):
+        """
+        Starts the writer thread.
+        """
+        self._thread = threading.Thread(target=self._run, name='db_writer', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        db_wrapper = None
+        try:
+            db_wrapper = DBWrapper(self.db_path, account=self.account)
+            while True:
+                items = [self._queue.get()]
+                while len(items) < self.max_batches:
+                    try:
+                        items.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                flushes = [item for item in items if isinstance(item, Future)]
+                writes = [item for item in items if isinstance(item, tuple)]
+                # the writes following a failure are dropped, a checkpoint never gets ahead of its rows
+                if writes and self._error is None:
+                    try:
+                        with tracer.span('db.write_transaction', writes=len(writes)):
+                            with db_wrapper.conn:
+                                for method, args in writes:
+                                    getattr(db_wrapper, method)(*args, commit=False)
+                    except Exception as e:
+                        self.logger.error(f"Write failed: {e}")
+                        self._error = e
+                for flush in flushes:
+                    if self._error is not None:
+                        flush.set_exception(self._error)
+                    else:
+                        flush.set_result(None)
+                if _STOP in items:
+                    return
+        except Exception as e:
+            # e.g. the database cannot be opened, the waiting flushes fail instead of hanging
+            self.logger.error(f"Writer failed: {e}")
+            self._error = e
+            self._fail_pending()
+        finally:
+            if db_wrapper is not None:
+                db_wrapper.conn.close()
+
+    def _fail_pending(self):
+        """
+        Resolves the flushes still queued with the error of the writer, the writes are dropped.
+        """
+        while True:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                return
+            if isinstance(item, Future):
+                item.set_exception(self._error or Exception("DB writer thread is not running"))
+
+    async def _put(self, item):
+        """
+        Queues an item, failing with the writer error once the thread is gone rather than waiting forever.
+        """
+        while True:
+            self._check()
+            try:
+                await asyncio.to_thread(self._queue.put, item, timeout=0.5)
+                return
+            except queue.Full:
+                continue
+
+    def _check(self):
+        """
+        Raises the writer error, or an error when the writer thread is not running.
+        """
+        if self._error is not None:
+            raise self._error
+        if self._thread is None or not self._thread.is_alive():
+            raise Exception("DB writer thread is not running")
+
+    async def submit(self, method, *args):
+        """
+        Queues a write, waiting while the queue is full.
+
+        Args:
+            method (str): DBWrapper method taking a commit argument, e.g. 'save_to_db'.
+            *args: Arguments of the method.
+        """
+        await self._put((method, args))
+
+    async def flush(self):
+        """
+        Waits until the writes submitted so far are committed.
+
+        Raises:
+            Exception: Error of a failed write.
+        """
+        future = Future()
+        await self._put(future)
+        waited = asyncio.wrap_future(future)
+        while True:
+            try:
+                return await asyncio.wait_for(asyncio.shield(waited), timeout=0.5)
+            except asyncio.TimeoutError:
+                # the writer may have stopped after the put, the flush is then never reached
+                if not self._thread.is_alive():
+                    self._fail_pending()
+
+    async def close(self):
+        """
+        Commits the queued writes and stops the writer thread.
+        """
+        try:
+            await self.flush()
+        finally:
+            if self._thread.is_alive():
+                await asyncio.to_thread(self._queue.put, _STOP)
+            await asyncio.to_thread(self._thread.join)
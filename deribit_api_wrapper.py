@@ -1,176 +1,518 @@
 from utils import * 
 import asyncio
+import itertools
+import threading
+import time
 import websockets
 import json
 from datetime import datetime, timedelta
 
 import pandas as pd
 
+from rate_limiter import account_rate_limiters
+from tracing import tracer
+
 base_url = "wss://www.deribit.com/ws/api/v2"
+# channels sent per subscribe request
+SUBSCRIPTION_BATCH_SIZE = 100
+# Deribit credit limits by engine, overridable with the 'rate_limits' config key
+DEFAULT_RATE_LIMITS = {
+    'non_matching_engine': {'max_credits': 50000, 'refill_rate': 10000, 'cost': 500},
+    'matching_engine': {'max_credits': 10000, 'refill_rate': 2500, 'cost': 500},
+}
+# methods counted against the matching engine limits
+MATCHING_ENGINE_METHODS = {
+    "private/buy", "private/sell", "private/edit", "private/edit_by_label",
+    "private/cancel", "private/cancel_all", "private/cancel_all_by_currency",
+    "private/cancel_all_by_instrument", "private/cancel_by_label", "private/close_position",
+}
+# JSON-RPC error codes returned when the credits are exhausted
+RATE_LIMIT_ERROR_CODES = {10028}
 
 
 class DeribitApiWrapper():
-    def __init__(self, config) -> None:
-        self.client_id = config['deribit']['client_id']
-        self.client_secret = config['deribit']['client_secret']
+    def __init__(self, config, account=None) -> None:
+        """
+        Initializes the DeribitApiWrapper. The websocket session is opened lazily by the first request
+        and shared by all the requests running on the same event loop, run() keeps one event loop thread
+        per wrapper so that the session outlives the calls. Each wrapper authenticates a single account,
+        on its own connection, and spends the credits of the account with its other wrappers.
+
+        Args:
+            config (dict): Configuration with the 'deribit' credentials and client url.
+            account (dict): Account with its 'name', 'client_id' and 'client_secret', see get_accounts.
+                            Defaults to the first account of the config.
+        """
+        self.logger = set_logger(name=__name__, log_file='deribit_api_wrapper.log', log_level='INFO')
+
+        if account is None:
+            account = get_accounts(config)[0]
+        self.account = account['name']
+        self.client_id = account['client_id']
+        self.client_secret = account['client_secret']
         self.client_url = config['deribit']['client_url']
-        self.json = {
-            "jsonrpc" : "2.0",
-            "id" : 1,
-            "method" : None,
-        }
+        self.request_timeout = config['deribit'].get('request_timeout', 30)
+        self.max_retries = config['deribit'].get('max_retries', 3)
 
-    async def _private_api(self, request):
-        options = {
-            "grant_type" : "client_credentials",
-            "client_id" : self.client_id,
-            "client_secret" : self.client_secret
-        }
-
-        self.json["method"] = "public/auth"
-        self.json["params"] = options
-
-        async with websockets.connect(self.client_url) as websocket:
-            await websocket.send(json.dumps(self.json))
-            while websocket.open:
-                response = await websocket.recv()
-                
-                # send a private subscription request
-                if "private/subscribe" in request:
-                    await websocket.send(request)
-                    while websocket.open:
-                        response = await websocket.recv()
-                        response = json.loads(response)
-                        print(response)
-
-                # send a private method request
-                else:
-                    await websocket.send(request)
-                    response = await websocket.recv()
-                    response = json.loads(response)
-                    break
-            return response
-        
-    async def _public_api(self, request):
-        async with websockets.connect(self.client_url) as websocket:
-            await websocket.send(request)
-            response = await websocket.recv()
-            response = json.loads(response)
+        rate_limits = {engine: {**limits, **config['deribit'].get('rate_limits', {}).get(engine, {})}
+                       for engine, limits in DEFAULT_RATE_LIMITS.items()}
+        self.request_costs = {engine: limits['cost'] for engine, limits in rate_limits.items()}
+        # shared with the other wrappers of the account, e.g. the one of the price feed
+        self.rate_limiters = account_rate_limiters((self.client_url, self.client_id), rate_limits)
+
+        self._request_ids = itertools.count(1)
+        self._session_loop = None
+        self._reset_session()
+        self._loop = None
+        self._thread = None
+        self._thread_lock = threading.Lock()
+
+    def _reset_session(self):
+        """
+        Forgets the websocket session, used when the event loop owning it changed.
+        """
+        self._websocket = None
+        self._reader_task = None
+        self._pending_requests = {}
+        self._connect_lock = asyncio.Lock()
+        self._auth_lock = asyncio.Lock()
+        self._access_token = None
+        self._refresh_token = None
+        self._token_expiry = 0
+        self._subscriptions = {}
+
+    async def _get_websocket(self):
+        """
+        Returns the shared websocket, (re)connecting it if needed.
+
+        Returns:
+            websocket: Open websocket connection.
+        """
+        loop = asyncio.get_running_loop()
+        if self._session_loop is not loop:
+            # a session belongs to the loop that opened it, e.g. the price feed loop or the one of run()
+            self._session_loop = loop
+            self._reset_session()
+
+        async with self._connect_lock:
+            if self._websocket is None or self._websocket.closed:
+                self._websocket = await websockets.connect(self.client_url, max_size=None)
+                self._reader_task = asyncio.create_task(self._read_responses(self._websocket))
+                self._access_token = None
+                self.logger.info(f"Connected to {self.client_url} as {self.account}")
+        return self._websocket
+
+    async def _read_responses(self, websocket):
+        """
+        Routes every response of the websocket to the request awaiting its id.
+
+        Args:
+            websocket: Websocket connection to read from.
+        """
+        try:
+            async for message in websocket:
+                if tracer.enabled:
+                    tracer.count('api.bytes_received', len(message))
+                response = json.loads(message)
+                if response.get('method') == 'subscription':
+                    self._dispatch_notification(response['params'])
+                    continue
+                _, future = self._pending_requests.pop(response.get('id'), (None, None))
+                if future is not None and not future.done():
+                    future.set_result(response)
+        except websockets.ConnectionClosed as e:
+            self.logger.warning(f"Connection closed: {e}")
+        finally:
+            for request_id, (request_websocket, future) in list(self._pending_requests.items()):
+                if request_websocket is websocket:
+                    del self._pending_requests[request_id]
+                    if not future.done():
+                        future.set_exception(ConnectionError('websocket connection closed'))
+            if websocket is self._websocket and self._subscriptions:
+                asyncio.create_task(self._resubscribe())
+
+    def _dispatch_notification(self, params):
+        """
+        Calls the callbacks registered on the channel of a subscription notification.
+
+        Args:
+            params (dict): Notification parameters holding the 'channel' and its 'data'.
+        """
+        _, callbacks = self._subscriptions.get(params['channel'], (None, []))
+        for callback in callbacks:
+            try:
+                callback(params['channel'], params['data'])
+            except Exception as e:
+                self.logger.error(f"Callback of {params['channel']} failed: {e}")
+
+    async def _resubscribe(self):
+        """
+        Reopens the connection and restores the subscriptions after a disconnection.
+        """
+        public_channels = [channel for channel, (private, _) in self._subscriptions.items() if not private]
+        private_channels = [channel for channel, (private, _) in self._subscriptions.items() if private]
+        while self._subscriptions:
+            try:
+                for channels, private in [(public_channels, False), (private_channels, True)]:
+                    method = "private/subscribe" if private else "public/subscribe"
+                    for i in range(0, len(channels), SUBSCRIPTION_BATCH_SIZE):
+                        await self._request(method, {"channels" : channels[i:i + SUBSCRIPTION_BATCH_SIZE]}, private=private)
+                self.logger.info(f"Restored {len(self._subscriptions)} subscriptions")
+                return
+            except Exception as e:
+                self.logger.error(f"Failed to restore subscriptions ({e}), retrying")
+                await asyncio.sleep(10)
+
+    async def _send(self, websocket, method, params):
+        """
+        Sends a JSON-RPC request with a unique id and waits for its response. The request waits
+        for credits in the rate limiter of its engine first.
+
+        Args:
+            websocket: Websocket connection to send the request on.
+            method (str): JSON-RPC method.
+            params (dict): Method parameters.
+
+        Returns:
+            response (dict): JSON-RPC response.
+        """
+        engine = self._get_engine(method)
+        await self.rate_limiters[engine].acquire(self.request_costs[engine])
+
+        request_id = next(self._request_ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending_requests[request_id] = (websocket, future)
+        try:
+            message = json.dumps({
+                "jsonrpc" : "2.0",
+                "id" : request_id,
+                "method" : method,
+                "params" : params
+            })
+            sent_at = None
+            if tracer.enabled:
+                tracer.count('api.requests')
+                tracer.count('api.bytes_sent', len(message))
+                sent_at = time.perf_counter()
+            await websocket.send(message)
+            response = await asyncio.wait_for(future, self.request_timeout)
+            if sent_at is not None:
+                tracer.record_latency(method, time.perf_counter() - sent_at)
             return response
+        finally:
+            self._pending_requests.pop(request_id, None)
+
+    async def _authenticate(self, websocket):
+        """
+        Authenticates the websocket session, refreshing the access token shortly before it expires.
+
+        Args:
+            websocket: Websocket connection to authenticate.
+        """
+        async with self._auth_lock:
+            if self._access_token is not None and time.monotonic() < self._token_expiry:
+                return
+
+            if self._refresh_token is not None and self._access_token is not None:
+                options = {
+                    "grant_type" : "refresh_token",
+                    "refresh_token" : self._refresh_token
+                }
+            else:
+                options = {
+                    "grant_type" : "client_credentials",
+                    "client_id" : self.client_id,
+                    "client_secret" : self.client_secret
+                }
+            response = await self._send(websocket, "public/auth", options)
+            if 'error' in response and options['grant_type'] == 'refresh_token':
+                self._access_token = None
+                options = {
+                    "grant_type" : "client_credentials",
+                    "client_id" : self.client_id,
+                    "client_secret" : self.client_secret
+                }
+                response = await self._send(websocket, "public/auth", options)
+            if 'error' in response:
+                raise Exception(f"Deribit authentication failed: {response['error']}")
+
+            result = response['result']
+            self._access_token = result['access_token']
+            self._refresh_token = result.get('refresh_token')
+            self._token_expiry = time.monotonic() + 0.9 * result.get('expires_in', 900)
+
+    def _get_engine(self, method):
+        return 'matching_engine' if method in MATCHING_ENGINE_METHODS else 'non_matching_engine'
+
+    async def _request(self, method, params, private=False):
+        """
+        Sends a request on the shared session, reconnecting and retrying when the connection drops,
+        and backing off when Deribit rejects it for exceeding the rate limits.
+
+        Args:
+            method (str): JSON-RPC method.
+            params (dict): Method parameters.
+            private (bool): Whether the method requires an authenticated session.
+
+        Returns:
+            response (dict): JSON-RPC response.
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                websocket = await self._get_websocket()
+                if private:
+                    await self._authenticate(websocket)
+                response = await self._send(websocket, method, params)
+            except (ConnectionError, OSError, websockets.ConnectionClosed) as e:
+                if attempt == self.max_retries:
+                    raise
+                self.logger.warning(f"{method} failed ({e}), retrying")
+                await asyncio.sleep(min(2 ** attempt, 10))
+                continue
+
+            rate_limiter = self.rate_limiters[self._get_engine(method)]
+            if response.get('error', {}).get('code') not in RATE_LIMIT_ERROR_CODES:
+                rate_limiter.recover()
+                return response
+            rate_limiter.throttle()
+            if tracer.enabled:
+                tracer.count('api.rate_limited')
+            if attempt == self.max_retries:
+                return response
+            self.logger.warning(f"{method} rate limited, retrying with {rate_limiter.refill_rate:.0f} credits/s")
+            await asyncio.sleep(min(2 ** attempt, 10) * 0.5)
+
+    def _private_api(self, method, params):
+        return self._request(method, params, private=True)
+
+    def _public_api(self, method, params):
+        return self._request(method, params, private=False)
+
+    def _get_loop(self):
+        """
+        Returns the event loop of the wrapper, started in a daemon thread by the first call.
+        """
+        with self._thread_lock:
+            if self._thread is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name=f"deribit_{self.account}", daemon=True)
+                self._thread.start()
+        return self._loop
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the event loop thread of the wrapper and waits for its result. The loop lives as
+        long as the wrapper, so the next calls reuse the websocket session and its access token instead of
+        connecting and authenticating again.
+
+        The caller is blocked while the coroutine runs, the objects it uses from the loop thread, e.g. a
+        DBWrapper opened with check_same_thread=False, are not used concurrently.
+
+        Args:
+            coroutine: Coroutine using the wrapper.
+
+        Returns:
+            result: Result of the coroutine.
+        """
+        loop = self._get_loop()
+        if threading.current_thread() is self._thread:
+            coroutine.close()
+            raise Exception('run() cannot be called from the event loop of the wrapper, await the coroutine instead')
+        return asyncio.run_coroutine_threadsafe(coroutine, loop).result()
+
+    def stop(self):
+        """
+        Closes the session and stops the event loop thread started by run().
+        """
+        with self._thread_lock:
+            if self._thread is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.close(), self._loop).result(timeout=10)
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=10)
+            self._loop.close()
+            self._loop = None
+            self._thread = None
+
+    async def close(self):
+        """
+        Closes the websocket session and drops the subscriptions.
+        """
+        self._subscriptions = {}
+        if self._websocket is not None:
+            await self._websocket.close()
+            self._websocket = None
+
+    async def subscribe(self, channels, callback, private=False):
+        """
+        Subscribes to channels on the shared session. The callback is called with the channel and
+        the data of every notification, subscriptions are restored after a reconnection.
+
+        Args:
+            channels (list): Channel names, e.g. 'ticker.BTC-PERPETUAL.100ms'.
+            callback (callable): Function called with (channel, data).
+            private (bool): Whether the channels require an authenticated session.
+
+        Returns:
+            subscribed (list): Channels confirmed by Deribit.
+        """
+        # connect first, a session opened on a new event loop starts without subscriptions
+        await self._get_websocket()
+        for channel in channels:
+            self._subscriptions.setdefault(channel, (private, []))[1].append(callback)
+
+        method = "private/subscribe" if private else "public/subscribe"
+        subscribed = []
+        for i in range(0, len(channels), SUBSCRIPTION_BATCH_SIZE):
+            response = await self._request(method, {"channels" : channels[i:i + SUBSCRIPTION_BATCH_SIZE]}, private=private)
+            if 'error' in response:
+                self.logger.error(f"{method} failed: {response['error']}")
+            else:
+                subscribed.extend(response['result'])
+        return subscribed
+
+    async def subscribe_user_trades(self, currencies, callback, kind='any', interval='100ms'):
+        """
+        Subscribes to the fills of the account on the private user.trades channels.
+
+        Args:
+            currencies (list): Currency codes.
+            callback (callable): Function called with (channel, data), data being a list of trades.
+            kind (str): Instrument kind, 'future', 'option' or 'any'.
+            interval (str): Notification interval, 'raw' or e.g. '100ms'.
+
+        Returns:
+            subscribed (list): Channels confirmed by Deribit.
+        """
+        channels = [f"user.trades.{kind}.{ccy}.{interval}" for ccy in currencies]
+        return await self.subscribe(channels, callback, private=True)
+
+    async def unsubscribe(self, channels, private=False):
+        """
+        Unsubscribes from channels and forgets their callbacks.
+
+        Args:
+            channels (list): Channel names.
+            private (bool): Whether the channels were subscribed on the authenticated session.
+        """
+        for channel in channels:
+            self._subscriptions.pop(channel, None)
+        method = "private/unsubscribe" if private else "public/unsubscribe"
+        for i in range(0, len(channels), SUBSCRIPTION_BATCH_SIZE):
+            await self._request(method, {"channels" : channels[i:i + SUBSCRIPTION_BATCH_SIZE]}, private=private)
 
-    async def public_sub(self, request):
-        async with websockets.connect(self.client_url) as websocket:
-            await websocket.send(request)
-            while websocket.open:
-                response = await websocket.recv()
-                response = json.loads(response)
-                print(response)
-        
-    async def _loop(self, api, request):
-        # response = asyncio.get_event_loop().run_until_complete(
-        #     api(json.dumps(request)))
-        response = await api(json.dumps(request))
-        return response
-    
     def get_order_history_by_instrument(self, instrument_name):
        options = {
            "instrument_name" : instrument_name,
            "include_old" : True,
            "count" : 20
            }
-       self.json["method"] = "private/get_order_history_by_instrument"
-       self.json["params"] = options
-       return self._loop(self._private_api, self.json)
+       return self._private_api("private/get_order_history_by_instrument", options)
     
     def get_user_trades_by_instrument(self, instrument_name, count = 100):
        options = {
            "instrument_name" : instrument_name,
            "count" : count
            }
-       self.json["method"] = "private/get_user_trades_by_instrument"
-       self.json["params"] = options
-       return self._loop(self._private_api, self.json)
+       return self._private_api("private/get_user_trades_by_instrument", options)
     
     def get_user_trades_by_currency(self, currency, count = 100):
        options = {
            "currency" : currency,
            "count" : count
            }
-       self.json["method"] = "private/get_user_trades_by_currency"
-       self.json["params"] = options
-       return self._loop(self._private_api, self.json)
+       return self._private_api("private/get_user_trades_by_currency", options)
     
     def get_settlement_history_by_currency(self, currency, count = 100):
        options = {
            "currency" : currency,
            "count" : count
            }
-       self.json["method"] = "private/get_settlement_history_by_currency"
-       self.json["params"] = options
-       return self._loop(self._private_api, self.json)
+       return self._private_api("private/get_settlement_history_by_currency", options)
     
-    def get_transaction_log(self, currency, count = 100):
+    def get_transaction_log(self, currency, count = 100, start_timestamp=None, end_timestamp=None, continuation=None):
        end = datetime.now()
-       end_timestamp = datetime_to_unix_ms(end)
-       start_timestamp = datetime_to_unix_ms(end - timedelta(weeks=52))
+       if end_timestamp is None:
+           end_timestamp = datetime_to_unix_ms(end)
+       if start_timestamp is None:
+           start_timestamp = datetime_to_unix_ms(end - timedelta(weeks=52))
        options = {
            "currency" : currency,
            "count" : count,
            "start_timestamp" : start_timestamp,
            "end_timestamp" : end_timestamp
            }
-       self.json["method"] = "private/get_transaction_log"
-       self.json["params"] = options
-       return self._loop(self._private_api, self.json)
+       if continuation is not None:
+           options["continuation"] = continuation
+       return self._private_api("private/get_transaction_log", options)
     
     def get_positions(self, currency):
        options = {
            "currency" : currency
            }
-       self.json["method"] = "private/get_positions"
-       self.json["params"] = options
-       return self._loop(self._private_api, self.json)
+       return self._private_api("private/get_positions", options)
     
     def get_index_price(self, index_name):
         options = {"index_name" : index_name}
-        self.json["method"] = "public/get_index_price"
-        self.json["params"] = options
-        return self._loop(self._public_api, self.json)
+        return self._public_api("public/get_index_price", options)
     
     def get_instrument_id(self, instrument_name):
         options = {
             "instrument_name" : instrument_name
             }
-        self.json["method"] = "public/get_instrument"
-        self.json["params"] = options
-        return self._loop(self._public_api, self.json)
+        return self._public_api("public/get_instrument", options)
     
     def get_order_book_by_instrument_id(self, instrument_id, depth=1):
         options = {
             "instrument_id" : instrument_id,
             "depth" : depth
             }
-        self.json["method"] = "public/get_order_book_by_instrument_id"
-        self.json["params"] = options
-        return self._loop(self._public_api, self.json)
+        return self._public_api("public/get_order_book_by_instrument_id", options)
     
     def get_order_book_by_instrument(self, instrument_name, depth=1):
         options = {
             "instrument_name" : instrument_name,
             "depth" : depth
             }
-        self.json["method"] = "public/get_order_book"
-        self.json["params"] = options
-        return self._loop(self._public_api, self.json)
+        return self._public_api("public/get_order_book", options)
     
+    def get_book_summary_by_currency(self, currency, kind=None):
+        options = {
+            "currency" : currency
+            }
+        if kind is not None:
+            options["kind"] = kind
+        return self._public_api("public/get_book_summary_by_currency", options)
+
+    async def get_mark_price_snapshot(self, currencies, kind=None):
+        """
+        Fetches the mark prices of all the instruments of the currencies, with one book summary
+        request per currency.
+
+        Args:
+            currencies (list): Currency codes.
+            kind (str): Instrument kind ('future', 'option'), all kinds when None.
+
+        Returns:
+            mark_prices (dict): Mark price by instrument name.
+        """
+        responses = await asyncio.gather(*[self.get_book_summary_by_currency(ccy, kind=kind) for ccy in currencies])
+        mark_prices = {}
+        for ccy, response in zip(currencies, responses):
+            if 'error' in response:
+                self.logger.error(f"public/get_book_summary_by_currency failed for {ccy}: {response['error']}")
+                continue
+            for summary in response['result']:
+                if summary.get('mark_price') is not None:
+                    mark_prices[summary['instrument_name']] = summary['mark_price']
+        return mark_prices
+
     def get_last_settlements_by_instrument(self, instrument_name, type='settlement'):
         options = {
             "instrument_name" : instrument_name,
             "type" : type
             }
-        self.json["method"] = "public/get_last_settlements_by_instrument"
-        self.json["params"] = options
-        return self._loop(self._public_api, self.json)
+        return self._public_api("public/get_last_settlements_by_instrument", options)
     
     def get_delivery_prices(self, index_name, offset=None, count=10):
         options = {
@@ -178,6 +520,13 @@ class DeribitApiWrapper():
             "count" : count,
             "offset" : offset
             }
-        self.json["method"] = "public/get_delivery_prices"
-        self.json["params"] = options
-        return self._loop(self._public_api, self.json)
+        return self._public_api("public/get_delivery_prices", options)
+
+    def get_tradingview_chart_data(self, instrument_name, start_timestamp, end_timestamp, resolution='1D'):
+        options = {
+            "instrument_name" : instrument_name,
+            "start_timestamp" : start_timestamp,
+            "end_timestamp" : end_timestamp,
+            "resolution" : resolution
+            }
+        return self._public_api("public/get_tradingview_chart_data", options)
@@ -0,0 +1,125 @@
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import pandas as pd
+
+from utils import *
+
+Instrument = namedtuple('Instrument', ['kind', 'underlying', 'expiry', 'strike', 'cp', 'contract_size'])
+
+# Deribit instruments expire at 08:00 UTC
+EXPIRY_TIME = timedelta(hours=8)
+# USD value of one inverse future contract, options are sized in the underlying
+FUTURE_CONTRACT_SIZES = {'BTC': 10, 'ETH': 1}
+
+
+def parse_instrument_name(instrument_name):
+    """
+    Parses a Deribit instrument name.
+
+    Args:
+        instrument_name (str): Name of the instrument, e.g. 'BTC-PERPETUAL', 'BTC-29SEP23',
+                               'BTC-29SEP23-30000-C' or 'BTC_USDC'.
+
+    Returns:
+        instrument (Instrument): Kind ('future', 'option' or 'spot'), underlying, expiry (naive UTC
+                                 datetime, None for perpetuals and spot), strike, call/put and contract size.
+    """
+    instrument_breakdown = instrument_name.split('-')
+    underlying = instrument_breakdown[0].split('_')[0]
+    if len(instrument_breakdown) == 1:
+        return Instrument('spot', underlying, None, None, None, 1)
+    if instrument_breakdown[1] == 'PERPETUAL' or 'PERP' in instrument_name:
+        return Instrument('future', underlying, None, None, None, FUTURE_CONTRACT_SIZES.get(underlying, 1))
+
+    expiry = convert_from_deribit_date(instrument_breakdown[1], as_string=False) + EXPIRY_TIME
+    if len(instrument_breakdown) == 2:
+        return Instrument('future', underlying, expiry, None, None, FUTURE_CONTRACT_SIZES.get(underlying, 1))
+    # strikes use 'd' as decimal separator, e.g. 'XRP-29SEP23-0d5-C'
+    strike = float(instrument_breakdown[2].replace('d', '.'))
+    return Instrument('option', underlying, expiry, strike, instrument_breakdown[3], 1)
+
+
+class InstrumentRegistry():
+    def __init__(self, db_wrapper=None) -> None:
+        """
+        Initializes the InstrumentRegistry, which parses every instrument name once and keeps the
+        details in memory, and in the database when a DBWrapper is given.
+
+        Args:
+            db_wrapper (DBWrapper): Instance of DBWrapper persisting the instruments, optional.
+        """
+        self.db_wrapper = db_wrapper
+        self.instruments = {}
+        if db_wrapper is not None:
+            for row in db_wrapper.get_instruments():
+                instrument_name, kind, underlying, expiry, strike, cp, contract_size = row
+                expiry = unix_ms_to_datetime(expiry) if expiry is not None else None
+                self.instruments[instrument_name] = Instrument(kind, underlying, expiry, strike, cp, contract_size)
+
+    def get(self, instrument_name):
+        """
+        Returns the details of an instrument, parsing its name the first time.
+
+        Args:
+            instrument_name (str): Name of the instrument.
+
+        Returns:
+            instrument (Instrument): Details of the instrument.
+        """
+        instrument = self.instruments.get(instrument_name)
+        if instrument is None:
+            self.register([instrument_name])
+            instrument = self.instruments[instrument_name]
+        return instrument
+
+    def register(self, instrument_names):
+        """
+        Parses the instruments not registered yet, and persists them.
+
+        Args:
+            instrument_names (list): Names of the instruments.
+        """
+        new_instruments = {name: parse_instrument_name(name) for name in set(instrument_names) if name not in self.instruments}
+        if not new_instruments:
+            return
+        self.instruments.update(new_instruments)
+        if self.db_wrapper is not None:
+            self.db_wrapper.save_instruments([
+                (name, instrument.kind, instrument.underlying,
+                 utc_datetime_to_unix_ms(instrument.expiry) if instrument.expiry is not None else None,
+                 instrument.strike, instrument.cp, instrument.contract_size)
+                for name, instrument in new_instruments.items()])
+
+    def to_frame(self, instrument_names):
+        """
+        Returns the details of instruments as a DataFrame.
+
+        Args:
+            instrument_names (list): Names of the instruments.
+
+        Returns:
+            instruments (pd.DataFrame): One row per name, indexed by name, with the Instrument fields as columns.
+        """
+        instrument_names = list(instrument_names)
+        self.register(instrument_names)
+        return pd.DataFrame([self.instruments[name] for name in instrument_names],
+                            index=pd.Index(instrument_names, name='instrument_name'),
+                            columns=list(Instrument._fields))
+
+    def is_expired(self, instrument_name, at_ts=None):
+        """
+        Checks whether an instrument has expired. The expiry and the time are compared in unix ms, the
+        naive expiries are UTC whatever the timezone of the host.
+
+        Args:
+            instrument_name (str): Name of the instrument.
+            at_ts (int): Time in unix ms, now by default.
+
+        Returns:
+            expired (bool): True if the instrument has an expiry before the time.
+        """
+        expiry = self.get(instrument_name).expiry
+        if at_ts is None:
+            at_ts = datetime_to_unix_ms(datetime.now())
+        return expiry is not None and utc_datetime_to_unix_ms(expiry) < at_ts
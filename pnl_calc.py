@@ -1,15 +1,284 @@
+import numpy as np
 import pandas as pd
 from deribit_api_wrapper import DeribitApiWrapper
-from db_wrapper import DBWrapper
+from db_wrapper import DBWrapper, SIDE_DTYPE, TRADE_LOG_COLUMNS, concat_trade_logs
+from instrument_registry import InstrumentRegistry, parse_instrument_name
+from price_feed import PriceFeed
+from risk_engine import option_greeks
+from position_engine import DAY_MS, HOUR_MS, accumulate_positions, bucket_flows, bucket_marks, calculate_positions, carried_positions, \
+                            daily_position_snapshots, fold_instrument_pnl, instrument_pnl, mark_to_market, pnl_time_series, \
+                            priced_positions, to_usd_prices
+from tracing import traced, tracer
+from transaction_sync import TransactionLogSync
 from utils import *
 import asyncio
+import threading
+
+# dtypes of the processed trades, strings with few distinct values are categoricals
+TRADE_COLUMNS = {
+    **TRADE_LOG_COLUMNS,
+    'trade_type': pd.CategoricalDtype(['future', 'option']),
+    'expiry': 'datetime64[ns]',
+    'strike': 'float64',
+    'cp': pd.CategoricalDtype(['C', 'P']),
+    'direction': pd.CategoricalDtype(['buy', 'sell']),
+    'datetime': 'datetime64[ns]',
+}
+# chart resolution of the historical prices and length of the buckets of the PnL time series
+PNL_BUCKETS = {'day': ('1D', DAY_MS), 'hour': ('60', HOUR_MS)}
+# bars requested per chart request
+MAX_CHART_BARS = 5000
+# columns of LivePositions.to_frame, those of position_engine.carried_positions
+LIVE_POSITION_COLUMNS = ['instrument_name', 'currency', 'trade_type', 'buy', 'sell', 'buy_notional', 'sell_notional',
+                         'avg_long', 'avg_short', 'long/short', 'realized_pl', 'unrealized_pl',
+                         'avg_long_to_short', 'avg_short_to_long']
+
+
+class PositionState():
+    __slots__ = ('currency', 'trade_type', 'buy', 'sell', 'buy_notional', 'sell_notional',
+                 'opening_realized_pl', 'active', 'unrealized_pl', 'counted_unrealized_pl')
+
+    def __init__(self, currency, trade_type, buy=0.0, sell=0.0, buy_notional=0.0, sell_notional=0.0,
+                       opening_realized_pl=0.0, active=False) -> None:
+        """
+        Initializes the USD position state of an instrument.
+
+        Args:
+            currency (str): Currency of the instrument.
+            trade_type (str): 'future' or 'option'.
+            buy, sell (float): Cumulative bought and sold quantities.
+            buy_notional, sell_notional (float): Cumulative bought and sold USD notionals.
+            opening_realized_pl (float): Realized PnL at the start of the range.
+            active (bool): Whether the position is open at the start of the range or traded since.
+        """
+        self.currency = currency
+        self.trade_type = trade_type
+        self.buy = buy
+        self.sell = sell
+        self.buy_notional = buy_notional
+        self.sell_notional = sell_notional
+        self.opening_realized_pl = opening_realized_pl
+        self.active = active
+        self.unrealized_pl = None
+        # share of the unrealized PnL total of LivePositions
+        self.counted_unrealized_pl = 0.0
+
+    @property
+    def avg_long(self):
+        return self.buy_notional / self.buy if self.buy > 0 else 0.0
+
+    @property
+    def avg_short(self):
+        return self.sell_notional / self.sell if self.sell > 0 else 0.0
+
+    @property
+    def realized_pl(self):
+        return (self.avg_short - self.avg_long) * min(self.buy, self.sell)
+
+    def apply(self, direction, amount, usd_price):
+        """
+        Applies a fill to the position.
+
+        Args:
+            direction (str): 'buy' or 'sell'.
+            amount (float): Quantity of the fill, in the units of the processed trades.
+            usd_price (float): USD price of the fill.
+        """
+        if direction == 'buy':
+            self.buy += amount
+            self.buy_notional += amount * usd_price
+        else:
+            self.sell += amount
+            self.sell_notional += amount * usd_price
+        self.active = True
+        self.unrealized_pl = None
+
+    def reprice(self, live_price):
+        """
+        Recomputes the unrealized PnL against the USD live price of the instrument.
+        """
+        self.unrealized_pl = (live_price - self.avg_long) * self.buy + (self.avg_short - live_price) * self.sell \
+                           - self.realized_pl
+
+
+class LivePositions():
+    def __init__(self, instrument_registry:InstrumentRegistry, opening_positions=None) -> None:
+        """
+        Initializes the LivePositions, which keep the USD position of every instrument up to date fill
+        by fill. A fill updates its position in O(1), and the unrealized PnL is only recomputed for the
+        instruments whose position or price changed since it was last read.
+
+        The fills can come from the transaction log sync and from the user.trades subscription, they
+        are deduplicated by trade_id.
+
+        Args:
+            instrument_registry (InstrumentRegistry): Registry classifying the instruments of the fills.
+            opening_positions (pd.DataFrame): Position state at the start of the range, indexed by instrument_name.
+        """
+        self.instrument_registry = instrument_registry
+        self.positions = {}
+        self.prices = {}
+        self.trade_ids = set()
+        self.last_timestamp = None
+        self._instruments_by_ccy = {}
+        self._stale = set()
+        # running totals over the active positions, updated by the changed positions only
+        self._realized_pl = 0.0
+        self._unrealized_pl = 0.0
+        self._lock = threading.Lock()
+
+        if opening_positions is not None:
+            for instrument, opening in opening_positions.iterrows():
+                self._add_position(instrument, PositionState(opening['currency'], opening['trade_type'],
+                                                             opening['buy'], opening['sell'],
+                                                             opening['buy_notional'], opening['sell_notional'],
+                                                             opening_realized_pl=opening['realized_pl'],
+                                                             active=not np.isclose(opening['buy'], opening['sell'])))
+
+    def _add_position(self, instrument, position):
+        self.positions[instrument] = position
+        self._instruments_by_ccy.setdefault(position.currency, set()).add(instrument)
+        self._stale.add(instrument)
+        return position
+
+    def _apply_fill(self, trade_id, instrument, currency, trade_type, direction, amount, usd_price, timestamp):
+        if trade_id in self.trade_ids:
+            return
+        self.trade_ids.add(trade_id)
+        position = self.positions.get(instrument)
+        if position is None:
+            position = self._add_position(instrument, PositionState(currency, trade_type))
+        realized_pl = position.realized_pl - position.opening_realized_pl if position.active else 0.0
+        position.apply(direction, amount, usd_price)
+        self._realized_pl += position.realized_pl - position.opening_realized_pl - realized_pl
+        self._stale.add(instrument)
+        if self.last_timestamp is None or timestamp > self.last_timestamp:
+            self.last_timestamp = timestamp
+
+    def apply_trades(self, trades):
+        """
+        Applies processed trades, e.g. loaded from the database after a sync.
+
+        Args:
+            trades (pd.DataFrame): Processed trades.
+        """
+        if trades.empty:
+            return
+        usd_prices = to_usd_prices(trades).to_numpy(dtype=float)
+        with self._lock:
+            for trade, usd_price in zip(trades[['trade_id', 'instrument_name', 'currency', 'trade_type',
+                                                'direction', 'amount', 'timestamp']].itertuples(index=False), usd_prices):
+                self._apply_fill(str(trade.trade_id), trade.instrument_name, trade.currency, trade.trade_type,
+                                 trade.direction, trade.amount, usd_price, trade.timestamp)
+
+    def on_user_trades(self, channel, trades):
+        """
+        Applies the fills of a user.trades notification, converted like the trades loaded from the database.
+
+        Args:
+            channel (str): Name of the channel.
+            trades (list): Trades of the notification.
+        """
+        with self._lock:
+            for trade in trades:
+                if '_' in trade['instrument_name']:
+                    continue
+                # parsed without persisting, the notifications arrive on the price feed thread
+                instrument = self.instrument_registry.instruments.get(trade['instrument_name']) \
+                             or parse_instrument_name(trade['instrument_name'])
+                if instrument.kind == 'future':
+                    amount, usd_price = trade['amount'] / trade['index_price'], trade['price']
+                else:
+                    amount, usd_price = trade['amount'], trade['price'] * trade['index_price']
+                self._apply_fill(str(trade['trade_id']), trade['instrument_name'], instrument.underlying,
+                                 instrument.kind, trade['direction'], amount, usd_price, trade['timestamp'])
+
+    def on_price(self, name, price):
+        """
+        Records the live price of an instrument or currency, marking the positions priced with it.
+
+        Args:
+            name (str): Instrument name or currency code.
+            price (float): Live price.
+        """
+        if self.prices.get(name) == price:
+            return
+        with self._lock:
+            self.prices[name] = price
+            if name in self.positions:
+                self._stale.add(name)
+            else:
+                self._stale.update(self._instruments_by_ccy.get(name, ()))
+
+    def update_prices(self, prices):
+        """
+        Records live prices by instrument name and by currency.
+
+        Args:
+            prices (dict): Live prices.
+        """
+        for name, price in prices.items():
+            self.on_price(name, price)
+
+    def _reprice_stale(self):
+        for instrument in self._stale:
+            position = self.positions[instrument]
+            instrument_price = self.prices.get(instrument)
+            ccy_price = 1.0 if position.trade_type == 'future' else self.prices.get(position.currency)
+            if instrument_price is None or ccy_price is None:
+                position.unrealized_pl = float('nan')
+            else:
+                position.reprice(instrument_price * ccy_price)
+            counted_unrealized_pl = position.unrealized_pl if position.active and not np.isnan(position.unrealized_pl) else 0.0
+            self._unrealized_pl += counted_unrealized_pl - position.counted_unrealized_pl
+            position.counted_unrealized_pl = counted_unrealized_pl
+        self._stale.clear()
+
+    def pnl(self):
+        """
+        Returns the realized and unrealized PnL of the range, summed over the active positions.
+        Positions without live price are left out of the unrealized PnL.
+
+        Returns:
+            realized_pl (float): PnL realized within the range.
+            unrealized_pl (float): PnL of the open positions.
+        """
+        with self._lock:
+            self._reprice_stale()
+            return self._realized_pl, self._unrealized_pl
+
+    def to_frame(self):
+        """
+        Returns the active positions, with the columns of position_engine.carried_positions.
+
+        Returns:
+            positions (pd.DataFrame): One row per instrument traded in the range or open at its start.
+        """
+        with self._lock:
+            self._reprice_stale()
+            rows = [{'instrument_name': instrument, 'currency': position.currency, 'trade_type': position.trade_type,
+                     'buy': position.buy, 'sell': position.sell,
+                     'buy_notional': position.buy_notional, 'sell_notional': position.sell_notional,
+                     'avg_long': position.avg_long, 'avg_short': position.avg_short,
+                     'long/short': 'long' if position.buy > position.sell else 'short',
+                     'realized_pl': position.realized_pl - position.opening_realized_pl,
+                     'unrealized_pl': position.unrealized_pl,
+                     'avg_long_to_short': position.avg_long, 'avg_short_to_long': position.avg_short}
+                    for instrument, position in self.positions.items() if position.active]
+        # the columns are kept without active position
+        return pd.DataFrame(rows, columns=LIVE_POSITION_COLUMNS)
 
 
 class PnLCalculator():
     def __init__(self, config,
                        deribit_wrapper:DeribitApiWrapper,
                        db_wrapper:DBWrapper,
-                       start_range, end_range) -> None:
+                       start_range, end_range,
+                       sync_on_load=True,
+                       trades=None,
+                       price_feed:PriceFeed=None,
+                       opening_positions=None,
+                       streaming=False) -> None:
         """
         Initialize the PnLCalculator.
 
@@ -18,41 +287,53 @@ class PnLCalculator():
             db_wrapper (DBWrapper): Instance of DBWrapper.
             start_range (datetime): Start date for PnL calculations.
             end_range (datetime): End date for PnL calculations.
+            sync_on_load (bool): Whether to sync the transaction logs with Deribit before loading the trades.
+            trades (pd.DataFrame): Processed trades of the range, loaded from the database when not given.
+            price_feed (PriceFeed): Streaming price cache read by update_live_prices, prices are polled when not given.
+            opening_positions (pd.DataFrame): Position state at the start of the range, loaded from the position
+                                              snapshots when not given.
+            streaming (bool): Whether the trades of the range are streamed from the database in chunks of
+                              config['stream_chunk_size'] trades instead of being loaded, see stream_pnl.
         """
+        self.logger = set_logger(name=__name__, log_file='pnl_calc.log', log_level='INFO')
+
         self.config = config
         self.trades = pd.DataFrame()
         self.deribit_wrapper = deribit_wrapper
         self.db_wrapper = db_wrapper
+        self.instrument_registry = InstrumentRegistry(db_wrapper)
+        self.price_feed = price_feed
         self.start_calc_date = start_range
         self.end_calc_date = end_range
-        self._load_trades()
+        self.opening_positions = opening_positions
+        self.live_positions = None
+        self.streaming = streaming
+        self.chunk_size = config.get('stream_chunk_size', 100_000)
+        self.pnl_by_instrument = None
+        self.transaction_sync = TransactionLogSync(config, deribit_wrapper, db_wrapper)
+        if trades is not None:
+            self.trades = trades
+        else:
+            if sync_on_load:
+                self.sync_transactions()
+            if not streaming:
+                self._load_trades()
 
         self.instrument_live_prices = {}
 
     def _calc_expiry(self, instrument_name):
         """
-        Calculate the details for the given instrument.
+        Calculate the details for the given instrument, from the instrument registry.
 
         Args:
             instrument_name (str): Name of the instrument.
 
         Returns:
-            tuple: Tuple containing trade type, expiry, strike, and call/put.
+            tuple: Tuple containing trade type, expiry ('PERP' for perpetuals), strike, and call/put.
         """
-        strike = None
-        cp = None
-        if 'PERP' in instrument_name:
-            return 'future', 'PERP', strike, cp
-        else:
-            instrument_breakdown = instrument_name.split('-')
-            if len(instrument_breakdown) > 2:
-                #option
-                strike = instrument_breakdown[2]
-                cp = instrument_breakdown[3]
-            elif len(instrument_breakdown) == 1:
-                return 'SPOT'
-
-            return 'option', convert_from_deribit_date(instrument_breakdown[1], as_string=False), strike, cp
+        instrument = self.instrument_registry.get(instrument_name)
+        expiry = 'PERP' if instrument.kind == 'future' and instrument.expiry is None else instrument.expiry
+        return instrument.kind, expiry, instrument.strike, instrument.cp
     
     def _get_direction(self, side):
         """
@@ -66,32 +347,189 @@ class PnLCalculator():
         """
         return side.split(' ')[1]
     
+    @traced('pnl.process_transactions')
     def _process_transactions_from_db(self, transactions:pd.DataFrame):
-        transactions = transactions[(transactions['type'] == 'trade') & (~transactions['instrument_name'].str.contains('_'))].reset_index(drop=True)
-        transactions[['trade_type', 'expiry','strike','cp']] = pd.DataFrame(transactions['instrument_name'].apply(self._calc_expiry).to_list())
-        transactions['direction'] = transactions['side'].apply(self._get_direction)
-        transactions['timestamp'] = transactions['timestamp'].apply(int)
-        transactions['datetime'] = transactions['timestamp'].apply(unix_ms_to_datetime)
+        """
+        Adds the instrument details, direction and datetime to the trades loaded from DB.
+
+        Args:
+            transactions (pd.DataFrame): Trades returned by DBWrapper.get_trade_logs_by_datetime_range.
+
+        Returns:
+            transactions: Processed trades, typed by TRADE_COLUMNS.
+        """
+        transactions = transactions.reset_index(drop=True)\
+                                   .astype({column: TRADE_COLUMNS[column] for column in ['instrument_name', 'side']})
+        instruments = transactions['instrument_name']
+        # join the registry details of each distinct instrument with the category codes
+        instrument_details = self.instrument_registry.to_frame(instruments.cat.categories)\
+                                 .rename(columns={'kind': 'trade_type'}).reset_index(drop=True)
+        instrument_details = instrument_details.reindex(instruments.cat.codes).reset_index(drop=True)
+        for column in ['trade_type', 'expiry', 'strike', 'cp']:
+            transactions[column] = instrument_details[column]
+        directions = pd.Series([self._get_direction(side) for side in SIDE_DTYPE.categories], dtype=object)
+        transactions['direction'] = directions.reindex(transactions['side'].cat.codes).to_numpy()
+        transactions['datetime'] = pd.to_datetime(transactions['timestamp'], unit='ms')
+        transactions = transactions.astype({column: dtype for column, dtype in TRADE_COLUMNS.items() if column in transactions})
         transactions.loc[transactions['trade_type'] == 'future', 'amount'] = transactions.loc[transactions['trade_type'] == 'future', 'amount'] / transactions.loc[transactions['trade_type'] == 'future', 'index_price']
 
         return transactions
                    
+    @traced('pnl.sync_transactions')
+    def sync_transactions(self):
+        """
+        Syncs the transaction logs of the calculation range from the Deribit API into the database.
+        """
+        self.deribit_wrapper.run(self.transaction_sync.sync(start_range=self.start_calc_date))
+        self.update_position_snapshots()
+        if self.live_positions is not None:
+            # the fills already applied from user.trades are skipped by trade_id
+            self.live_positions.apply_trades(self._load_trades_between(self.live_positions.last_timestamp or datetime_to_unix_ms(self.start_calc_date),
+                                                                       datetime_to_unix_ms(datetime.now()) + 1))
+
+    @traced('pnl.load_trades')
     def _load_trades(self):
         """
-        Loads trades and transaction data from the database and Deribit API.
+        Loads trades from the database.
         """
-        async def load_transactions_from_deribit():
-            for ccy in self.config['deribit']['currencies']:
-                transactions_from_deribit = await self.deribit_wrapper.get_transaction_log(currency=ccy, count=1000)
-                transactions_from_deribit = pd.DataFrame(transactions_from_deribit['result']['logs'])
-                self.db_wrapper.save_to_db(transactions_from_deribit, table_name="transaction_logs")
-
-        asyncio.run(load_transactions_from_deribit())
-        
-        transactions = self.db_wrapper.get_transactions_by_datetime_range(self.start_calc_date,
-                                                                          self.end_calc_date)
+        transactions = self.db_wrapper.get_trade_logs_by_datetime_range(self.start_calc_date,
+                                                                        self.end_calc_date)
         self.trades = self._process_transactions_from_db(transactions)
 
+    def _load_trades_between(self, start_ts, end_ts):
+        """
+        Loads the trades with start_ts <= timestamp < end_ts (unix ms) from the database.
+        """
+        transactions = self.db_wrapper.get_trade_logs_by_datetime_range(start_ts, end_ts - 1)
+        return self._process_transactions_from_db(transactions)
+
+    def _iter_trades_between(self, start_range, end_range):
+        """
+        Yields the processed trades within the range (inclusive, datetimes or unix ms) in timestamp-ordered
+        chunks of self.chunk_size trades.
+        """
+        for transactions in self.db_wrapper.iter_trade_logs_by_datetime_range(start_range, end_range, self.chunk_size):
+            yield self._process_transactions_from_db(transactions)
+
+    @traced('pnl.update_position_snapshots')
+    def update_position_snapshots(self):
+        """
+        Extends the daily position snapshots up to the last day completely synced, from the latest
+        snapshots and the fills since. They are rebuilt from the first trade when older trades were
+        backfilled after they were built.
+        """
+        time_range = self.db_wrapper.get_trade_log_time_range()
+        if time_range is None:
+            return
+        history_from = time_range[0]
+        snapshot_range = self.db_wrapper.get_position_snapshot_range()
+        if snapshot_range is not None and snapshot_range['history_from'] > history_from:
+            self.logger.info("Older trades were backfilled, rebuilding the position snapshots")
+            self.db_wrapper.clear_position_snapshots()
+            snapshot_range = None
+
+        synced_to = [checkpoint['synced_to'] for checkpoint in self.db_wrapper.get_sync_checkpoints().values()]
+        built_until = min(synced_to + [datetime_to_unix_ms(datetime.now())]) // DAY_MS * DAY_MS
+        built_from = snapshot_range['built_until'] if snapshot_range is not None else history_from
+        if built_until <= built_from:
+            return
+
+        opening = self.db_wrapper.get_position_snapshots(built_from) if snapshot_range is not None else None
+        # the trades are folded chunk by chunk, a day split across two chunks is snapshotted by the second
+        snapshots = []
+        for trades in self._iter_trades_between(built_from, built_until - 1):
+            snapshots.append(daily_position_snapshots(trades, opening))
+            opening = accumulate_positions(trades, opening)
+        snapshots = pd.concat(snapshots).drop_duplicates(['instrument_name', 'snapshot_ts'], keep='last') \
+                    if snapshots else pd.DataFrame()
+        self.db_wrapper.save_position_snapshots(snapshots, history_from, built_until)
+
+    @traced('pnl.load_opening_positions')
+    def _load_opening_positions(self):
+        """
+        Loads the position state at the start of the range from the nearest position snapshot before it
+        and the fills since, all the fills before the range are replayed when there is no valid snapshot.
+        Instruments expired before the range are left out.
+        """
+        start = datetime_to_unix_ms(self.start_calc_date)
+        time_range = self.db_wrapper.get_trade_log_time_range()
+        if time_range is None or time_range[0] >= start:
+            return accumulate_positions(pd.DataFrame())
+
+        opening = None
+        replay_from = time_range[0]
+        snapshot_range = self.db_wrapper.get_position_snapshot_range()
+        if snapshot_range is not None and snapshot_range['history_from'] <= time_range[0]:
+            replay_from = min(snapshot_range['built_until'], start // DAY_MS * DAY_MS)
+            opening = self.db_wrapper.get_position_snapshots(replay_from)
+        for trades in self._iter_trades_between(replay_from, start - 1):
+            opening = accumulate_positions(trades, opening)
+        opening = accumulate_positions(pd.DataFrame(), opening)
+
+        # the range start is read in local time like the trades, the expiries are UTC
+        expired = [instrument for instrument in opening.index if self.instrument_registry.is_expired(instrument, start)]
+        return opening.drop(expired)
+
+    def get_opening_positions(self):
+        """
+        Returns the position state at the start of the range.
+
+        Returns:
+            opening_positions: DataFrame of the USD position state indexed by instrument_name, empty when
+                               nothing was traded before the range.
+        """
+        if self.opening_positions is None:
+            if self.db_wrapper is None:
+                self.opening_positions = accumulate_positions(pd.DataFrame())
+            else:
+                self.opening_positions = self._load_opening_positions()
+        return self.opening_positions
+
+    def get_live_positions(self):
+        """
+        Returns the incremental positions of the range, built once from the opening positions and the trades.
+
+        Returns:
+            live_positions (LivePositions): Positions updated fill by fill.
+        """
+        if self.live_positions is None:
+            live_positions = LivePositions(self.instrument_registry, self.get_opening_positions())
+            if self.streaming:
+                for trades in self._iter_trades_between(self.start_calc_date, self.end_calc_date):
+                    live_positions.apply_trades(trades)
+            else:
+                live_positions.apply_trades(self.trades)
+            live_positions.update_prices(self.instrument_live_prices)
+            self.live_positions = live_positions
+        return self.live_positions
+
+    def track_live_positions(self):
+        """
+        Feeds the live positions with the prices of the price feed and, when the range runs up to now, the
+        fills of the user.trades subscription, both on the price feed event loop. The fills after the end
+        of a range are not part of it.
+
+        Returns:
+            future (concurrent.futures.Future): Completed once the subscriptions are confirmed.
+        """
+        if self.price_feed is None:
+            raise Exception('a price feed is required to track the live positions')
+        if self.price_feed.deribit_wrapper.account != self.db_wrapper.account:
+            raise Exception(f"the price feed session of {self.price_feed.deribit_wrapper.account} cannot track the trades of {self.db_wrapper.account}")
+        live_positions = self.get_live_positions()
+        self.price_feed.add_listener(live_positions.on_price)
+        # the prices streamed before the listener was added are not sent again
+        live_positions.update_prices(dict(self.price_feed.prices))
+        tracked = self.price_feed.track([instrument for instrument, position in live_positions.positions.items()
+                                         if position.active and not self._is_expired(instrument)],
+                                        list({position.currency for position in live_positions.positions.values()}))
+        if self.end_calc_date is not None and self.end_calc_date <= datetime.now():
+            return tracked
+        return self.price_feed.run_coroutine(
+            self.price_feed.deribit_wrapper.subscribe_user_trades(self.config['deribit']['currencies'],
+                                                                  live_positions.on_user_trades,
+                                                                  interval=self.config['deribit'].get('user_trades_interval', '100ms')))
+
     def _get_trades(self):
         """
         Returns the list of trades.
@@ -101,61 +539,266 @@ class PnLCalculator():
         """
         return self.trades
     
-    async def _calc_settlement_price(self, instrument):
+    def _calc_settlement_price(self, instrument, index_settlement):
         """
         Calculates the settlement price for a given instrument.
 
         Args:
             instrument: Name of the instrument.
+            index_settlement: Delivery price of the index at expiry.
 
         Returns:
             settlement_price: Calculated settlement price.
         """
         trade_type, expiry, strike, cp = self._calc_expiry(instrument)
-        result = await self.deribit_wrapper.get_delivery_prices((f"{instrument.split('-')[0]}_usd").lower(),
-                                                                    offset=(datetime.now()-expiry).days)
-        index_settlement = result['result']['data'][0]['delivery_price']
 
         if trade_type == 'future':
             return index_settlement
         elif trade_type == 'option':
-            strike = int(strike)
             return (max(0, (strike - index_settlement)) if cp == 'P' else max(0, (index_settlement - strike))) / index_settlement
         else:
             raise Exception('trade type not supported')
 
+    async def _fetch_delivery_prices(self, index_name, dates):
+        """
+        Fetches the delivery prices of an index covering the given dates with a single request,
+        and stores them in the database.
+
+        Args:
+            index_name: Index name, e.g. 'btc_usd'.
+            dates: Delivery dates as 'YYYY-MM-DD' strings.
+        """
+        today = datetime.now().date()
+        newest = (today - datetime.strptime(max(dates), '%Y-%m-%d').date()).days
+        oldest = (today - datetime.strptime(min(dates), '%Y-%m-%d').date()).days
+        # delivery prices are daily, the margin covers the publication time of today's price
+        offset = max(0, newest - 2)
+        result = await self.deribit_wrapper.get_delivery_prices(index_name, offset=offset,
+                                                                count=min(oldest - offset + 3, 1000))
+        if 'error' in result:
+            self.logger.error(f"public/get_delivery_prices failed for {index_name}: {result['error']}")
+            return
+        self.db_wrapper.save_delivery_prices(index_name, result['result']['data'])
+
+    @traced('prices.settlement')
+    async def _update_settlement_prices(self, instruments):
+        """
+        Updates the prices of expired instruments from their delivery prices, read from the database
+        and fetched once per index for the expiries not stored yet.
+
+        Args:
+            instruments: Names of the expired instruments.
+        """
+        dates_by_index = {}
+        for instrument in instruments:
+            details = self.instrument_registry.get(instrument)
+            index_name = f"{details.underlying.lower()}_usd"
+            dates_by_index.setdefault(index_name, set()).add(details.expiry.strftime('%Y-%m-%d'))
+
+        delivery_prices = {index_name: self.db_wrapper.get_delivery_prices(index_name, dates)
+                           for index_name, dates in dates_by_index.items()}
+        missing_dates = {index_name: dates - set(delivery_prices[index_name])
+                         for index_name, dates in dates_by_index.items()}
+        missing_dates = {index_name: dates for index_name, dates in missing_dates.items() if dates}
+        if missing_dates:
+            await asyncio.gather(*[self._fetch_delivery_prices(index_name, dates) for index_name, dates in missing_dates.items()])
+            for index_name, dates in missing_dates.items():
+                delivery_prices[index_name].update(self.db_wrapper.get_delivery_prices(index_name, dates))
+
+        for instrument in instruments:
+            details = self.instrument_registry.get(instrument)
+            index_settlement = delivery_prices[f"{details.underlying.lower()}_usd"].get(details.expiry.strftime('%Y-%m-%d'))
+            if index_settlement is None:
+                self.logger.warning(f"No delivery price for {instrument}")
+                continue
+            self.instrument_live_prices[instrument] = self._calc_settlement_price(instrument, index_settlement)
+
+    @traced('pnl.update_live_prices')
     async def update_live_prices(self):
         """
         Updates live prices for instruments and currencies.
         """
-        instruments = self.trades['instrument_name'].unique()
-        ccy_list = self.trades['currency'].unique()
+        if self.streaming:
+            # the instruments of the range are read with a DISTINCT query, the trades are not loaded
+            instrument_currencies = self.db_wrapper.get_trade_log_instruments(self.start_calc_date, self.end_calc_date)
+        else:
+            instrument_currencies = self.trades.drop_duplicates('instrument_name')\
+                                               .set_index('instrument_name')['currency'].astype(object).to_dict()
+        # the positions carried into the range are priced too
+        opening_positions = self.get_opening_positions()
+        instrument_currencies.update({instrument: ccy for instrument, ccy in opening_positions['currency'].items()
+                                      if instrument not in instrument_currencies})
+        instruments = list(instrument_currencies)
+        ccy_list = list(dict.fromkeys(instrument_currencies.values()))
+        expired_instruments = [instrument for instrument in instruments if self._is_expired(instrument)]
+        live_instruments = [instrument for instrument in instruments if instrument not in set(expired_instruments)]
+
+        if self.price_feed is not None:
+            # streamed prices first, the instruments without a ticker yet are fetched below
+            self.price_feed.track(live_instruments, ccy_list)
+            with tracer.span('prices.feed', names=len(live_instruments) + len(ccy_list)):
+                streamed_prices = await self.price_feed.wait_for_prices(live_instruments + ccy_list,
+                                                                        timeout=self.config['deribit'].get('price_feed_timeout', 2))
+            self.instrument_live_prices.update(streamed_prices)
+            live_instruments = [instrument for instrument in live_instruments if instrument not in streamed_prices]
+            ccy_list = [ccy for ccy in ccy_list if ccy not in streamed_prices]
+
+        if live_instruments:
+            # one book summary per currency, only the instruments missing from it are polled one by one
+            live_ccy_list = list(dict.fromkeys(instrument_currencies[instrument] for instrument in live_instruments))
+            with tracer.span('prices.snapshot', currencies=len(live_ccy_list)):
+                snapshot = await self.deribit_wrapper.get_mark_price_snapshot(live_ccy_list)
+            self.instrument_live_prices.update({instrument: snapshot[instrument] for instrument in live_instruments if instrument in snapshot})
+            live_instruments = [instrument for instrument in live_instruments if instrument not in snapshot]
+
+        if expired_instruments:
+            await self._update_settlement_prices(expired_instruments)
+
+        instruments = live_instruments
         tasks_instruments = [self._update_instrument_price(instrument) for instrument in instruments]
         tasks_ccy = [self._update_ccy_price(ccy) for ccy in ccy_list]
 
-        batch_size = 20
-        num_batches = len(tasks_instruments) // batch_size + (1 if len(tasks_instruments) % batch_size > 0 else 0)
+        # the requests are throttled by the rate limiter of the DeribitApiWrapper
+        with tracer.span('prices.polling', instruments=len(instruments), currencies=len(ccy_list)):
+            results = await asyncio.gather(*tasks_instruments)
+            for instrument, px in zip(instruments, results):
+                self.instrument_live_prices[instrument] = px
 
-        for batch_idx in range(num_batches):
-            start_idx = batch_idx * batch_size
-            end_idx = start_idx + batch_size
-            batch_tasks = tasks_instruments[start_idx:end_idx]
+            results = await asyncio.gather(*tasks_ccy)
+            for ccy, ccy_px in zip(ccy_list, results):
+                self.instrument_live_prices[ccy] = ccy_px
 
-            results = await asyncio.gather(*batch_tasks)
+    async def _fetch_price_history(self, name, resolution, start_ts, end_ts):
+        """
+        Fetches the closing prices of the bars of an instrument, or of the perpetual standing in for the index
+        of a currency, and stores them. A bar's price is stored at its close, only closed bars are kept.
 
-            for instrument, px in zip(instruments[start_idx:end_idx], results):
-                self.instrument_live_prices[instrument] = px
+        Args:
+            name (str): Instrument name or currency code.
+            resolution (str): Chart resolution, see PNL_BUCKETS.
+            start_ts (int): Start of the range in unix ms.
+            end_ts (int): End of the range in unix ms, before now.
+        """
+        source = f"{name}-PERPETUAL" if '-' not in name else name
+        bar_ms = next(bar_ms for bar_resolution, bar_ms in PNL_BUCKETS.values() if bar_resolution == resolution)
+        windows = [(window_start, min(window_start + MAX_CHART_BARS * bar_ms, end_ts))
+                   for window_start in range(start_ts, end_ts, MAX_CHART_BARS * bar_ms)]
+        responses = await asyncio.gather(*[self.deribit_wrapper.get_tradingview_chart_data(source, window_start, window_end, resolution)
+                                           for window_start, window_end in windows])
+        prices = []
+        for response in responses:
+            if 'error' in response:
+                self.logger.error(f"public/get_tradingview_chart_data failed for {source}: {response['error']}")
+                return
+            result = response['result']
+            prices.extend((tick + bar_ms, close) for tick, close in zip(result.get('ticks', []), result.get('close', []))
+                          if close is not None and tick + bar_ms <= end_ts)
+        self.db_wrapper.save_price_history(name, resolution, prices, start_ts, end_ts)
+
+    @traced('prices.history')
+    async def update_price_history(self, names, resolution, start_ts, end_ts):
+        """
+        Fetches the historical prices of the range missing from the database, the stored ranges are only
+        extended, each with one request per MAX_CHART_BARS bars.
+
+        Args:
+            names (list): Instrument names and currency codes.
+            resolution (str): Chart resolution, see PNL_BUCKETS.
+            start_ts (int): Start of the range in unix ms.
+            end_ts (int): End of the range in unix ms.
+        """
+        end_ts = min(end_ts, datetime_to_unix_ms(datetime.now()))
+        stored_ranges = self.db_wrapper.get_price_history_ranges(names, resolution)
+        fetches = []
+        for name in names:
+            name_end_ts = end_ts
+            if '-' in name and self.instrument_registry.get(name).expiry is not None:
+                # no bars after the expiry, the settlement price takes over
+                name_end_ts = min(end_ts, utc_datetime_to_unix_ms(self.instrument_registry.get(name).expiry))
+            stored = stored_ranges.get(name)
+            if stored is None:
+                gaps = [(start_ts, name_end_ts)]
+            else:
+                gaps = [(start_ts, stored[0]), (stored[1], name_end_ts)]
+            fetches += [self._fetch_price_history(name, resolution, gap_start, gap_end)
+                        for gap_start, gap_end in gaps if gap_start < gap_end]
+        await asyncio.gather(*fetches)
+
+    @traced('pnl.time_series')
+    def pnl_time_series(self, bucket='day'):
+        """
+        Calculates the mark-to-market PnL of the range at the end of each day or hour, against historical
+        marks. The closing prices of the chart bars are fetched once and stored, the marks of the fills and
+        the settlement prices of the expired instruments complete them.
+
+        Args:
+            bucket (str): 'day' or 'hour'.
+
+        Returns:
+            series (pd.DataFrame): PnL by boundary, see position_engine.pnl_time_series.
+        """
+        resolution, bucket_ms = PNL_BUCKETS[bucket]
+        start_ts = datetime_to_unix_ms(self.start_calc_date)
+        end_ts = datetime_to_unix_ms(min(self.end_calc_date or datetime.now(), datetime.now()))
+        boundaries = np.unique(np.concatenate([[start_ts],
+                                               np.arange((start_ts // bucket_ms + 1) * bucket_ms, end_ts, bucket_ms),
+                                               [end_ts]]))
+
+        # the fills are reduced to their flows and marks by bucket, chunk by chunk in streaming mode
+        trade_chunks = self._iter_trades_between(self.start_calc_date, self.end_calc_date) if self.streaming else [self.trades]
+        flows, fill_marks = [bucket_flows(pd.DataFrame(), boundaries)], []
+        for trades in trade_chunks:
+            if not trades.empty:
+                flows.append(bucket_flows(trades, boundaries))
+                fill_marks.append(bucket_marks(trades, boundaries))
+        flows = concat_trade_logs(flows)
+
+        opening_positions = self.get_opening_positions()
+        instrument_currencies = opening_positions['currency'].astype(object).to_dict()
+        instrument_currencies.update(zip(flows['instrument_name'], flows['currency']))
+        names = list(instrument_currencies) + list(dict.fromkeys(instrument_currencies.values()))
+        expired_instruments = [instrument for instrument in instrument_currencies if self._is_expired(instrument)]
+        # a range running into the current bucket ends on the live prices, like the positions
+        ends_now = datetime_to_unix_ms(datetime.now()) - end_ts < bucket_ms
+
+        async def update_marks():
+            # the bar before the start prices the opening positions
+            if ends_now:
+                prices_update = self.update_live_prices()
+            elif expired_instruments:
+                prices_update = self._update_settlement_prices(expired_instruments)
+            else:
+                prices_update = asyncio.sleep(0)
+            await asyncio.gather(self.update_price_history(names, resolution, start_ts - bucket_ms, end_ts), prices_update)
+        self.deribit_wrapper.run(update_marks())
+
+        marks = [self.db_wrapper.get_price_history(names, resolution, start_ts - bucket_ms, end_ts)] + fill_marks
+        settled = [instrument for instrument in expired_instruments if instrument in self.instrument_live_prices]
+        marks.append(pd.DataFrame({'name': settled,
+                                   'timestamp': [utc_datetime_to_unix_ms(self.instrument_registry.get(instrument).expiry)
+                                                 for instrument in settled],
+                                   'price': [self.instrument_live_prices[instrument] for instrument in settled]}))
+        if ends_now:
+            live = [name for name in names if name in self.instrument_live_prices and name not in set(expired_instruments)]
+            marks.append(pd.DataFrame({'name': live, 'timestamp': end_ts,
+                                       'price': [self.instrument_live_prices[name] for name in live]}))
+        return pnl_time_series(flows, opening_positions, pd.concat(marks, ignore_index=True), boundaries)
+
+    def _is_expired(self, instrument):
+        """
+        Checks whether an instrument has expired.
 
-            if batch_idx < num_batches - 1:
-                await asyncio.sleep(1)
+        Args:
+            instrument: Name of the instrument.
 
-        results = await asyncio.gather(*tasks_ccy)
-        for ccy, ccy_px in zip(ccy_list, results):
-            self.instrument_live_prices[ccy] = ccy_px
+        Returns:
+            expired: True if the instrument has an expiry in the past.
+        """
+        return self.instrument_registry.is_expired(instrument)
 
     async def _update_instrument_price(self, instrument):
         """
-        Updates the live price of a specific instrument.
+        Updates the live price of a specific instrument, which has not expired.
 
         Args:
             instrument: Name of the instrument.
@@ -163,14 +806,8 @@ class PnLCalculator():
         Returns:
             price: Updated live price.
         """
-        _, expiry, _, _ = self._calc_expiry(instrument)
-
-        if isinstance(expiry, datetime) and expiry < datetime.now():
-            # expired instrument
-            return await self._calc_settlement_price(instrument)
-        else:
-            result = await self.deribit_wrapper.get_order_book_by_instrument(instrument)
-            return result['result']['mark_price']
+        result = await self.deribit_wrapper.get_order_book_by_instrument(instrument)
+        return result['result']['mark_price']
 
     async def _update_ccy_price(self, ccy):
         """
@@ -211,79 +848,131 @@ class PnLCalculator():
         usd_fees = trade['commission'] * trade['index_price']
         return usd_pnl, usd_pnl - usd_fees, usd_fees
         
+    @traced('pnl.reprice_trades')
+    def reprice_trades(self):
+        """
+        Reprices all trades against the current live prices, in one columnar pass. The PnL columns are
+        added to an empty range too.
+        """
+        usd_pnl, usd_pnl_including_fees, usd_fees = mark_to_market(self.trades, self.instrument_live_prices)
+        self.trades['usd_pnl'] = usd_pnl
+        self.trades['usd_pnl_including_fees'] = usd_pnl_including_fees
+        self.trades['usd_fees'] = usd_fees
+
+    @traced('pnl.update_pnl')
     def update_pnl(self):
         """
         Updates PnL for all trades.
         """
-        asyncio.run(self.update_live_prices())
-
-        for idx, trade in self.trades.iterrows():
-            usd_pnl, usd_pnl_including_fees, usd_fees = self.usd_pnl_by_trade(trade)
-            self.trades.loc[idx, 'usd_pnl'] = usd_pnl
-            self.trades.loc[idx, 'usd_pnl_including_fees'] = usd_pnl_including_fees
-            self.trades.loc[idx, 'usd_fees'] = usd_fees
+        self.deribit_wrapper.run(self.update_live_prices())
+        if self.streaming:
+            positions, self.pnl_by_instrument = self.stream_pnl()
+            return positions
+        self.reprice_trades()
         
         positions = self.calculate_positions()
+        self.pnl_by_instrument = instrument_pnl(self.trades)
         return positions
+
+    @traced('pnl.stream_pnl')
+    def stream_pnl(self, on_trades=None):
+        """
+        Calculates the positions and the PnL by instrument of the range against the live prices, folding the
+        trades chunk by chunk into the position state of each instrument. At most one chunk of trades is held
+        in memory, the rest of the state is per instrument.
+
+        Args:
+            on_trades (callable): Called with each chunk of trades repriced with their PnL, e.g. to write them.
+
+        Returns:
+            positions (pd.DataFrame): Positions by instrument, see position_engine.carried_positions.
+            pnl_by_instrument (pd.DataFrame): PnL of the trades by instrument, see position_engine.instrument_pnl.
+        """
+        opening = self.get_opening_positions()
+        state = opening
+        fees = pd.DataFrame(columns=['trades', 'usd_fees'], dtype=float)
+        for trades in self._iter_trades_between(self.start_calc_date, self.end_calc_date):
+            state = accumulate_positions(trades, state)
+            usd_fees = pd.Series(trades['commission'].to_numpy() * trades['index_price'].to_numpy(),
+                                 index=trades['instrument_name'].astype(object).to_numpy())
+            fees = fees.add(usd_fees.groupby(level=0).agg(['size', 'sum']).set_axis(['trades', 'usd_fees'], axis=1),
+                            fill_value=0.0)
+            if on_trades is not None:
+                usd_pnl, usd_pnl_including_fees, usd_fees = mark_to_market(trades, self.instrument_live_prices)
+                on_trades(trades.assign(usd_pnl=usd_pnl, usd_pnl_including_fees=usd_pnl_including_fees, usd_fees=usd_fees))
+
+        state = accumulate_positions(pd.DataFrame(), state)
+        fees = fees.rename_axis('instrument_name').astype({'trades': 'int64'})
+        positions = priced_positions(state, self.instrument_live_prices, opening, list(fees.index))
+        pnl_by_instrument = fold_instrument_pnl(state, opening, fees, self.instrument_live_prices)
+        return positions, pnl_by_instrument
     
-    def calculate_positions(self, currency='usd'):
-        if currency == 'usd':
-            self.trades.loc[self.trades['trade_type'] == 'option', 'price'] = self.trades.loc[self.trades['trade_type'] == 'option', 'price']\
-                                                                * (self.trades.loc[self.trades['trade_type'] == 'option', 'index_price'])
-        positions = pd.DataFrame() 
-        for instrument in self.trades['instrument_name'].unique():
-            trades_subset = self.trades[self.trades['instrument_name'] == instrument].sort_values(by='timestamp', ascending=True).reset_index(drop=True)
-            for idx, row in trades_subset.iterrows():
-                trades_subset.loc[idx, 'buy'] = trades_subset[trades_subset['direction'] == 'buy'].loc[0:idx, 'amount'].sum()
-                trades_subset.loc[idx, 'sell'] = trades_subset[trades_subset['direction'] == 'sell'].loc[0:idx, 'amount'].sum()
-                trades_subset.loc[idx, 'long/short'] = 'long' if trades_subset.loc[idx, 'buy'] > trades_subset.loc[idx, 'sell'] else 'short'
-
-                buy_amount_subset = trades_subset[trades_subset['direction'] == 'buy'].loc[0:idx, 'amount']
-                buy_price_subset = trades_subset[trades_subset['direction'] == 'buy'].loc[0:idx, 'price']
-                sell_amount_subset = trades_subset[trades_subset['direction'] == 'sell'].loc[0:idx, 'amount']
-                sell_price_subset = trades_subset[trades_subset['direction'] == 'sell'].loc[0:idx, 'price']
-                
-                if not buy_amount_subset.empty:
-                    trades_subset.loc[idx, 'avg_long'] = buy_amount_subset.dot(buy_price_subset) / buy_amount_subset.sum()
-                else:
-                    trades_subset.loc[idx, 'avg_long'] = 0
+    @traced('risk.option_book')
+    def option_book(self):
+        """
+        Returns the option positions open at the end of the range and not expired, the input of the Greeks.
 
-                if not sell_amount_subset.empty:
-                    trades_subset.loc[idx, 'avg_short'] = sell_amount_subset.dot(sell_price_subset) / sell_amount_subset.sum()
-                else:
-                    trades_subset.loc[idx, 'avg_short'] = 0
-                
-            last_idx = trades_subset.index[-1]
-            trades_subset.loc[last_idx, 'avg_long_to_short'] = trades_subset.loc[(trades_subset['buy'] < trades_subset['sell']).index[-1], 'avg_long']
-            trades_subset.loc[last_idx, 'avg_short_to_long'] = trades_subset.loc[(trades_subset['sell'] < trades_subset['buy']).index[-1], 'avg_short']
-            
-
-            last_row = trades_subset.iloc[last_idx]
-            if last_row['long/short'] == 'long':
-                trades_subset.loc[last_idx, 'realized_pl'] = (last_row['avg_short'] - last_row['avg_long_to_short']) * last_row['sell'] 
-            else:
-                trades_subset.loc[last_idx, 'realized_pl'] = (last_row['avg_short_to_long'] - last_row['avg_long']) * last_row['buy']
+        Returns:
+            book (pd.DataFrame): 'currency', 'expiry' (UTC), 'strike', 'cp' and the net 'position' of each
+                                 option, indexed by instrument_name.
+        """
+        opening = self.get_opening_positions()
+        if self.streaming:
+            state = opening
+            for trades in self._iter_trades_between(self.start_calc_date, self.end_calc_date):
+                state = accumulate_positions(trades, state)
+            state = accumulate_positions(pd.DataFrame(), state)
+        else:
+            state = accumulate_positions(self.trades, opening)
+        state = state[(state['trade_type'] == 'option') & ~np.isclose(state['buy'], state['sell'])]
+        instruments = self.instrument_registry.to_frame(state.index)
+        book = pd.DataFrame({'currency': state['currency'].astype(object),
+                             'expiry': pd.to_datetime(instruments['expiry']),
+                             'strike': instruments['strike'].astype(float),
+                             'cp': instruments['cp'],
+                             'position': state['buy'] - state['sell']},
+                            index=state.index)
+        return book[book['expiry'] > datetime.utcnow()]
+
+    @traced('risk.greeks')
+    def calculate_greeks(self, book=None):
+        """
+        Calculates the Black-76 Greeks of the open option positions against the live prices, in one array
+        pass. The book can be kept across price updates, only the Greeks are recomputed.
 
-            # print(trades_subset)
-            live_price = self.instrument_live_prices[instrument] * (1 if last_row['trade_type'] == 'future' else self.instrument_live_prices[last_row['currency']])
-            trades_subset.loc[last_idx, 'unrealized_pl'] = (live_price - last_row['avg_long']) * last_row['buy'] \
-                                                         + (last_row['avg_short'] - live_price) * last_row['sell'] \
-                                                         - trades_subset.loc[last_idx, 'realized_pl']
-            
-            # if trades_subset.loc[0, 'trade_type'] == 'option':
-            #     trades_subset.loc[last_idx, 'realized_pl'] = trades_subset.loc[last_idx, 'realized_pl']  * self.instrument_live_prices[last_row['currency']]
-            #     trades_subset.loc[last_idx, 'unrealized_pl'] = trades_subset.loc[last_idx, 'unrealized_pl'] * self.instrument_live_prices[last_row['currency']]
+        Args:
+            book (pd.DataFrame): Open option positions, see option_book, built from the trades when None.
 
-            positions = pd.concat([positions, pd.DataFrame(trades_subset.loc[last_idx]).T], axis=0)
-            # print(trades_subset)
+        Returns:
+            greeks (pd.DataFrame): Greeks by instrument, see risk_engine.option_greeks.
+        """
+        book = self.option_book() if book is None else book
+        return option_greeks(book, self.instrument_live_prices, datetime_to_unix_ms(datetime.now()))
 
-        return positions
+    @traced('pnl.calculate_positions')
+    def calculate_positions(self, currency='usd'):
+        """
+        Calculates the realized and unrealized PnL by instrument. In USD, the positions open at the start
+        of the range are carried into it, the opening state is empty when nothing was traded before it.
+
+        Args:
+            currency (str): Currency of the position prices, 'usd' converts option prices to USD.
+
+        Returns:
+            positions: DataFrame of the positions by instrument, see position_engine.carried_positions.
+                       Other currencies return the last running position of each instrument, see
+                       position_engine.calculate_positions.
+        """
+        if currency == 'usd':
+            return carried_positions(self.trades, self.instrument_live_prices, self.get_opening_positions())
+        return calculate_positions(self.trades, self.instrument_live_prices, currency=currency)
         
         
 
 if __name__ == "__main__":
     config = read_json('config.json')
-    db_wrapper = DBWrapper(config['db_path'])
+    tracer.configure(config.get('tracing', False))
+    db_wrapper = DBWrapper(config['db_path'], check_same_thread=False)
     deribit_wrapper = DeribitApiWrapper(config)
     start = datetime(2023, 8, 1)
     end = datetime.now()
@@ -0,0 +1,466 @@
+import numpy as np
+import pandas as pd
+
+HOUR_MS = 60 * 60 * 1000
+DAY_MS = 24 * HOUR_MS
+# cumulative quantities and notionals from which the averages and realized PnL of a position derive
+POSITION_FLOW_COLUMNS = ['buy', 'sell', 'buy_notional', 'sell_notional']
+# PnL of the trades summed by instrument
+INSTRUMENT_PNL_COLUMNS = ['usd_pnl', 'usd_pnl_including_fees', 'usd_fees']
+
+def to_usd_prices(trades):
+    """
+    Returns the trade prices expressed in USD.
+
+    Option prices are quoted in the underlying currency and are converted with the
+    index price of the trade, future prices are already in USD.
+
+    Args:
+        trades (pd.DataFrame): Processed trades.
+
+    Returns:
+        prices (pd.Series): USD prices aligned on the trades index.
+    """
+    is_option = trades['trade_type'] == 'option'
+    return trades['price'].where(~is_option, trades['price'] * trades['index_price'])
+
+
+def position_flows(trades, price_column='price'):
+    """
+    Splits every trade into bought/sold quantities and notionals.
+
+    Args:
+        trades (pd.DataFrame): Processed trades.
+        price_column (str): Column holding the trade price used for the notionals.
+
+    Returns:
+        flows (pd.DataFrame): POSITION_FLOW_COLUMNS aligned on the trades index.
+    """
+    is_buy = (trades['direction'] == 'buy').to_numpy()
+    amount = trades['amount'].to_numpy(dtype=float)
+    notional = amount * trades[price_column].to_numpy(dtype=float)
+    return pd.DataFrame({'buy': np.where(is_buy, amount, 0.0),
+                         'sell': np.where(is_buy, 0.0, amount),
+                         'buy_notional': np.where(is_buy, notional, 0.0),
+                         'sell_notional': np.where(is_buy, 0.0, notional)},
+                        index=trades.index)
+
+
+def _with_averages(state):
+    """
+    Adds the average prices, side and realized PnL derived from the cumulative flows of positions.
+    """
+    buy = state['buy'].to_numpy(dtype=float)
+    sell = state['sell'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        state['avg_long'] = np.where(buy > 0, state['buy_notional'].to_numpy(dtype=float) / buy, 0.0)
+        state['avg_short'] = np.where(sell > 0, state['sell_notional'].to_numpy(dtype=float) / sell, 0.0)
+    state['long/short'] = np.where(buy > sell, 'long', 'short')
+    state['realized_pl'] = (state['avg_short'] - state['avg_long']) * np.minimum(buy, sell)
+    return state
+
+
+def accumulate_positions(trades, opening=None):
+    """
+    Computes the USD position state of every instrument after the trades, on top of an opening state.
+
+    Args:
+        trades (pd.DataFrame): Processed trades.
+        opening (pd.DataFrame): Opening state indexed by instrument_name, e.g. position snapshots.
+
+    Returns:
+        state (pd.DataFrame): Currency, trade type, cumulative flows, averages and realized PnL,
+                              indexed by instrument_name.
+    """
+    frames = []
+    if opening is not None and not opening.empty:
+        frames.append(opening[['currency', 'trade_type'] + POSITION_FLOW_COLUMNS])
+    if not trades.empty:
+        usd_trades = trades.assign(price=to_usd_prices(trades))
+        flows = position_flows(usd_trades)
+        flows['currency'] = usd_trades['currency'].astype(object)
+        flows['trade_type'] = usd_trades['trade_type'].astype(object)
+        flows.index = usd_trades['instrument_name'].astype(object).to_numpy()
+        frames.append(flows[['currency', 'trade_type'] + POSITION_FLOW_COLUMNS])
+    if not frames:
+        return _with_averages(pd.DataFrame(columns=['currency', 'trade_type'] + POSITION_FLOW_COLUMNS,
+                                           index=pd.Index([], name='instrument_name'))
+                                .astype({column: float for column in POSITION_FLOW_COLUMNS}))
+
+    state = pd.concat(frames).groupby(level=0, sort=False)\
+                             .agg({'currency': 'last', 'trade_type': 'last',
+                                   **{column: 'sum' for column in POSITION_FLOW_COLUMNS}})
+    state.index.name = 'instrument_name'
+    return _with_averages(state)
+
+
+def daily_position_snapshots(trades, opening=None):
+    """
+    Computes the USD position state of every instrument at the end of each day it traded, on top of
+    an opening state. A snapshot at snapshot_ts includes the fills before it.
+
+    Args:
+        trades (pd.DataFrame): Processed trades.
+        opening (pd.DataFrame): Opening state indexed by instrument_name, e.g. position snapshots.
+
+    Returns:
+        snapshots (pd.DataFrame): One row per instrument and day (snapshot_ts at the next midnight UTC,
+                                  in unix ms) with the columns of accumulate_positions.
+    """
+    usd_trades = trades.assign(price=to_usd_prices(trades))
+    flows = position_flows(usd_trades)
+    flows['instrument_name'] = usd_trades['instrument_name'].astype(object).to_numpy()
+    flows['snapshot_ts'] = (usd_trades['timestamp'].to_numpy(dtype='int64') // DAY_MS + 1) * DAY_MS
+    daily = flows.groupby(['instrument_name', 'snapshot_ts'])[POSITION_FLOW_COLUMNS].sum()
+    snapshots = daily.groupby(level='instrument_name').cumsum()
+
+    instruments = snapshots.index.get_level_values('instrument_name')
+    if opening is not None and not opening.empty:
+        snapshots += opening[POSITION_FLOW_COLUMNS].reindex(instruments).fillna(0.0).to_numpy()
+
+    details = usd_trades.astype({'instrument_name': object, 'currency': object, 'trade_type': object})\
+                        .groupby('instrument_name')[['currency', 'trade_type']].last()
+    snapshots = snapshots.reset_index()
+    snapshots['currency'] = details['currency'].reindex(instruments).to_numpy()
+    snapshots['trade_type'] = details['trade_type'].reindex(instruments).to_numpy()
+    return _with_averages(snapshots)
+
+
+def carried_positions(trades, live_prices, opening):
+    """
+    Calculates the realized and unrealized USD PnL of every instrument from an opening state carried
+    into the range and the trades of the range.
+
+    Args:
+        trades (pd.DataFrame): Processed trades of the range.
+        live_prices (dict): Live prices by instrument name and by currency.
+        opening (pd.DataFrame): Position state at the start of the range, indexed by instrument_name.
+
+    Returns:
+        positions (pd.DataFrame): One row per instrument traded in the range or open at its start.
+                                  realized_pl is realized within the range, unrealized_pl is the PnL
+                                  of the position still open.
+    """
+    closing = accumulate_positions(trades, opening)
+    traded = trades['instrument_name'].astype(object).unique() if not trades.empty else []
+    return priced_positions(closing, live_prices, opening, traded)
+
+
+def live_usd_prices(state, live_prices):
+    """
+    Returns the USD live prices of the instruments of a position state, option prices are converted
+    with the live index price.
+
+    Args:
+        state (pd.DataFrame): Position state indexed by instrument_name.
+        live_prices (dict): Live prices by instrument name and by currency.
+
+    Returns:
+        prices (pd.Series): USD live prices aligned on the state index.
+    """
+    return state.index.to_series().map(live_prices).astype(float) \
+         * state['currency'].map(live_prices).astype(float).where(state['trade_type'] != 'future', 1.0)
+
+
+def priced_positions(closing, live_prices, opening, traded):
+    """
+    Calculates the realized and unrealized USD PnL of the instruments traded in the range or open at
+    its start, from their position state at the start and at the end of the range.
+
+    Args:
+        closing (pd.DataFrame): Position state at the end of the range, see accumulate_positions.
+        live_prices (dict): Live prices by instrument name and by currency.
+        opening (pd.DataFrame): Position state at the start of the range, indexed by instrument_name.
+        traded (list): Instruments traded in the range.
+
+    Returns:
+        positions (pd.DataFrame): One row per instrument, see carried_positions.
+    """
+    opened = opening.index[~np.isclose(opening['buy'], opening['sell'])]
+    positions = closing[closing.index.isin(traded) | closing.index.isin(opened)].copy()
+
+    live_price = live_usd_prices(positions, live_prices)
+    positions['unrealized_pl'] = (live_price - positions['avg_long']) * positions['buy'] \
+                               + (positions['avg_short'] - live_price) * positions['sell'] \
+                               - positions['realized_pl']
+    positions['realized_pl'] = positions['realized_pl'] - opening['realized_pl'].reindex(positions.index).fillna(0.0)
+    positions['avg_long_to_short'] = positions['avg_long']
+    positions['avg_short_to_long'] = positions['avg_short']
+    return positions.reset_index()
+
+
+def instrument_pnl(trades):
+    """
+    Sums the PnL of repriced trades by instrument.
+
+    Args:
+        trades (pd.DataFrame): Processed trades with their PnL, see mark_to_market.
+
+    Returns:
+        pnl (pd.DataFrame): Currency, trade type, number of trades and INSTRUMENT_PNL_COLUMNS sums,
+                            indexed by instrument_name.
+    """
+    trades = trades.astype({'instrument_name': object, 'currency': object, 'trade_type': object})
+    return trades.groupby('instrument_name').agg(currency=('currency', 'last'), trade_type=('trade_type', 'last'),
+                                                 trades=('amount', 'size'),
+                                                 **{column: (column, 'sum') for column in INSTRUMENT_PNL_COLUMNS})
+
+
+def fold_instrument_pnl(closing, opening, fees, live_prices):
+    """
+    Calculates the PnL by instrument of the trades of a range from the position states at its start
+    and end, without the trades: the PnL of the trades of an instrument against its live price is
+    the live value of their net quantity minus their net notional.
+
+    Args:
+        closing (pd.DataFrame): Position state at the end of the range, see accumulate_positions.
+        opening (pd.DataFrame): Position state at the start of the range, indexed by instrument_name.
+        fees (pd.DataFrame): Number of 'trades' and 'usd_fees' of the range, indexed by instrument_name.
+        live_prices (dict): Live prices by instrument name and by currency.
+
+    Returns:
+        pnl (pd.DataFrame): Same as instrument_pnl.
+    """
+    state = closing.loc[fees.index]
+    flows = state[POSITION_FLOW_COLUMNS] - opening[POSITION_FLOW_COLUMNS].reindex(fees.index).fillna(0.0)
+    pnl = state[['currency', 'trade_type']].assign(trades=fees['trades'])
+    pnl['usd_pnl'] = live_usd_prices(state, live_prices) * (flows['buy'] - flows['sell']) \
+                   - flows['buy_notional'] + flows['sell_notional']
+    pnl['usd_pnl_including_fees'] = pnl['usd_pnl'] - fees['usd_fees']
+    pnl['usd_fees'] = fees['usd_fees']
+    return pnl
+
+
+def bucket_flows(trades, boundaries):
+    """
+    Reduces fills to their flows summed by instrument and bucket of the boundaries, stamped with the last
+    fill of the bucket. The as-of joins of pnl_time_series read the same cumulative flows from the reduced
+    rows as from the fills, so the reductions of consecutive chunks of fills can be concatenated.
+
+    Args:
+        trades (pd.DataFrame): Processed trades.
+        boundaries (np.ndarray): Ascending boundaries in unix ms.
+
+    Returns:
+        flows (pd.DataFrame): 'instrument_name', 'currency', 'trade_type', 'timestamp', POSITION_FLOW_COLUMNS
+                              and 'usd_fees', one row per instrument and bucket with fills.
+    """
+    if trades.empty:
+        return pd.DataFrame({'instrument_name': pd.Series(dtype=object), 'currency': pd.Series(dtype=object),
+                             'trade_type': pd.Series(dtype=object), 'timestamp': pd.Series(dtype='int64'),
+                             **{column: pd.Series(dtype=float) for column in POSITION_FLOW_COLUMNS + ['usd_fees']}})
+    flows = position_flows(trades.assign(price=to_usd_prices(trades)))
+    flows['usd_fees'] = trades['commission'].to_numpy(dtype=float) * trades['index_price'].to_numpy(dtype=float)
+    flows['instrument_name'] = trades['instrument_name'].astype(object).to_numpy()
+    flows['currency'] = trades['currency'].astype(object).to_numpy()
+    flows['trade_type'] = trades['trade_type'].astype(object).to_numpy()
+    flows['timestamp'] = trades['timestamp'].to_numpy(dtype='int64')
+    # a fill at a boundary belongs to the next bucket, like the position snapshots
+    flows['bucket'] = np.searchsorted(np.asarray(boundaries, dtype='int64'), flows['timestamp'].to_numpy(), side='right')
+    return flows.groupby(['instrument_name', 'bucket'], sort=False)\
+                .agg({'currency': 'last', 'trade_type': 'last', 'timestamp': 'max',
+                      **{column: 'sum' for column in POSITION_FLOW_COLUMNS + ['usd_fees']}})\
+                .reset_index()\
+                .drop(columns='bucket')
+
+
+def bucket_marks(trades, boundaries):
+    """
+    Returns the marks of the fills, the mark price of the instrument and the index price of the currency,
+    keeping the last one of each bucket of the boundaries.
+
+    Args:
+        trades (pd.DataFrame): Processed trades.
+        boundaries (np.ndarray): Ascending boundaries in unix ms.
+
+    Returns:
+        marks (pd.DataFrame): 'name', 'timestamp' and 'price', see pnl_time_series.
+    """
+    marks = pd.concat([trades[['instrument_name', 'timestamp', 'mark_price']].set_axis(['name', 'timestamp', 'price'], axis=1),
+                       trades[['currency', 'timestamp', 'index_price']].set_axis(['name', 'timestamp', 'price'], axis=1)],
+                      ignore_index=True)
+    marks = marks.astype({'name': object, 'timestamp': 'int64', 'price': float})
+    # unlike a fill, a mark at a boundary prices it
+    marks['bucket'] = np.searchsorted(np.asarray(boundaries, dtype='int64'), marks['timestamp'].to_numpy(), side='left')
+    return marks.sort_values('timestamp', kind='stable')\
+                .drop_duplicates(['name', 'bucket'], keep='last')\
+                .drop(columns='bucket')
+
+
+def pnl_time_series(flows, opening, marks, boundaries):
+    """
+    Computes the mark-to-market PnL of the positions at each boundary of a range, from the cumulative flows
+    of the fills and the marks known at the boundary. Both are read with sorted as-of joins on a grid of
+    instruments and boundaries, in one pass over the flows whatever the number of boundaries.
+
+    The PnL follows carried_positions: at a boundary, the realized PnL is the realized PnL of the state minus
+    the one of the opening state, and the unrealized PnL is the rest of the value of the positions against
+    their average prices. Without flows, the positions of the opening state are marked. The marks are carried
+forward from the last price known at the boundary, the total and unrealized PnL of a boundary with open
+positions never marked are left NaN rather than summed without them.
+
+    Args:
+        flows (pd.DataFrame): Flows of the fills of the range, see bucket_flows.
+        opening (pd.DataFrame): Position state at the start of the range, indexed by instrument_name.
+        marks (pd.DataFrame): Historical prices with 'name' (instrument name, or currency for the index),
+                              'timestamp' (unix ms) and 'price', in the units of the live prices.
+        boundaries (np.ndarray): Ascending boundaries in unix ms, the first one is the start of the range.
+
+    Returns:
+        series (pd.DataFrame): 'timestamp', 'datetime', 'realized_pl', 'unrealized_pl', 'total_pl', the 'pnl'
+                               since the previous boundary, the cumulative 'usd_fees' and the number of open
+                               positions without mark ('unpriced'), one row per boundary. 'total_pl',
+                               'unrealized_pl' and 'pnl' are NaN around the boundaries with unpriced positions.
+    """
+    boundaries = np.asarray(boundaries, dtype='int64')
+    opening = accumulate_positions(pd.DataFrame(), opening)
+    instruments = pd.concat([opening[['currency', 'trade_type']].astype(object),
+                             flows.groupby('instrument_name', sort=False)[['currency', 'trade_type']].last()])
+    instruments = instruments[~instruments.index.duplicated(keep='last')]
+    opening = opening.reindex(instruments.index)
+    opening[POSITION_FLOW_COLUMNS + ['realized_pl']] = opening[POSITION_FLOW_COLUMNS + ['realized_pl']].fillna(0.0)
+
+    # cumulative flows of each instrument after each of its buckets
+    cumulated = flows.sort_values('timestamp', kind='stable')
+    cumulated = cumulated[['instrument_name', 'timestamp']].join(
+        cumulated.groupby('instrument_name', sort=False)[POSITION_FLOW_COLUMNS + ['usd_fees']].cumsum())
+
+    names = instruments.index.to_numpy(dtype=object)
+    grid = pd.DataFrame({'timestamp': np.repeat(boundaries, len(names)),
+                         'instrument_name': np.tile(names, len(boundaries))})
+    # a fill at a boundary belongs to the next bucket, like the position snapshots
+    grid = pd.merge_asof(grid, cumulated, on='timestamp', by='instrument_name', allow_exact_matches=False)
+    for column in POSITION_FLOW_COLUMNS + ['usd_fees']:
+        grid[column] = grid[column].fillna(0.0).to_numpy() \
+                     + (opening[column].reindex(grid['instrument_name']).to_numpy() if column != 'usd_fees' else 0.0)
+    grid['currency'] = instruments['currency'].reindex(grid['instrument_name']).to_numpy()
+    is_option = instruments['trade_type'].reindex(grid['instrument_name']).to_numpy() == 'option'
+
+    marks = marks.sort_values('timestamp', kind='stable')[['name', 'timestamp', 'price']].astype({'name': object, 'timestamp': 'int64'})
+    grid = pd.merge_asof(grid, marks.rename(columns={'name': 'instrument_name', 'price': 'mark'}),
+                         on='timestamp', by='instrument_name')
+    grid = pd.merge_asof(grid, marks.rename(columns={'name': 'currency', 'price': 'index'}),
+                         on='timestamp', by='currency')
+
+    buy = grid['buy'].to_numpy()
+    sell = grid['sell'].to_numpy()
+    net = buy - sell
+    usd_mark = grid['mark'].to_numpy() * np.where(is_option, grid['index'].to_numpy(), 1.0)
+    is_open = ~np.isclose(buy, sell)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_long = np.where(buy > 0, grid['buy_notional'].to_numpy() / buy, 0.0)
+        avg_short = np.where(sell > 0, grid['sell_notional'].to_numpy() / sell, 0.0)
+    opening_realized_pl = opening['realized_pl'].reindex(grid['instrument_name']).to_numpy()
+    grid['realized_pl'] = (avg_short - avg_long) * np.minimum(buy, sell) - opening_realized_pl
+    grid['total_pl'] = np.where(is_open, usd_mark * net, 0.0) - grid['buy_notional'] + grid['sell_notional'] \
+                     - opening_realized_pl
+    grid['unpriced'] = is_open & np.isnan(usd_mark)
+
+    series = grid.groupby('timestamp')[['realized_pl', 'total_pl', 'usd_fees', 'unpriced']].sum()\
+                 .reindex(boundaries, fill_value=0.0)
+    series.index.name = 'timestamp'
+    series.loc[series['unpriced'] > 0, 'total_pl'] = np.nan
+    series['unrealized_pl'] = series['total_pl'] - series['realized_pl']
+    series['pnl'] = series['total_pl'].diff()
+    series.loc[boundaries[0], 'pnl'] = 0.0
+    series['unpriced'] = series['unpriced'].astype('int64')
+    series = series.reset_index()
+    series['datetime'] = pd.to_datetime(series['timestamp'], unit='ms')
+    return series[['timestamp', 'datetime', 'realized_pl', 'unrealized_pl', 'total_pl', 'pnl', 'usd_fees', 'unpriced']]
+
+
+def running_positions(trades, price_column='price'):
+    """
+    Computes the running position of every instrument in a single grouped pass.
+
+    Args:
+        trades (pd.DataFrame): Processed trades.
+        price_column (str): Column holding the trade price used for the averages.
+
+    Returns:
+        running (pd.DataFrame): Trades sorted by timestamp with cumulative 'buy'/'sell'
+                                quantities, 'long/short' state and running 'avg_long'/'avg_short' prices.
+    """
+    running = trades.sort_values(by='timestamp', kind='mergesort')
+    flows = position_flows(running, price_column)
+    cumulated = flows.groupby(running['instrument_name'].to_numpy(), sort=False).cumsum()
+
+    buy = cumulated['buy'].to_numpy()
+    sell = cumulated['sell'].to_numpy()
+    with np.errstate(divide='ignore', invalid='ignore'):
+        avg_long = np.where(buy > 0, cumulated['buy_notional'].to_numpy() / buy, 0.0)
+        avg_short = np.where(sell > 0, cumulated['sell_notional'].to_numpy() / sell, 0.0)
+
+    running = running.copy()
+    running['buy'] = buy
+    running['sell'] = sell
+    running['long/short'] = np.where(buy > sell, 'long', 'short')
+    running['avg_long'] = avg_long
+    running['avg_short'] = avg_short
+    return running
+
+
+def calculate_positions(trades, live_prices, currency='usd'):
+    """
+    Calculates the realized and unrealized PnL of every instrument.
+
+    Args:
+        trades (pd.DataFrame): Processed trades.
+        live_prices (dict): Live prices by instrument name and by currency.
+        currency (str): Currency of the position prices, 'usd' converts option prices to USD.
+
+    Returns:
+        positions (pd.DataFrame): Last running position of each instrument, one row per instrument.
+    """
+    if currency == 'usd':
+        trades = trades.assign(price=to_usd_prices(trades))
+
+    running = running_positions(trades)
+    instruments = trades['instrument_name'].unique()
+    positions = running.drop_duplicates(subset='instrument_name', keep='last')\
+                       .set_index('instrument_name', drop=False)\
+                       .loc[instruments]
+
+    # the position is read on the last fill, so the averages of the reversed side are the current ones
+    positions['avg_long_to_short'] = positions['avg_long']
+    positions['avg_short_to_long'] = positions['avg_short']
+    positions['realized_pl'] = (positions['avg_short'] - positions['avg_long']) \
+                             * np.minimum(positions['buy'], positions['sell'])
+
+    instrument_price = positions['instrument_name'].map(live_prices).astype(float)
+    ccy_price = positions['currency'].map(live_prices).astype(float)
+    live_price = instrument_price * ccy_price.where(positions['trade_type'] != 'future', 1.0)
+    positions['unrealized_pl'] = (live_price - positions['avg_long']) * positions['buy'] \
+                               + (positions['avg_short'] - live_price) * positions['sell'] \
+                               - positions['realized_pl']
+
+    positions.index = trades.groupby('instrument_name', observed=True, sort=False).size().loc[instruments].to_numpy() - 1
+    return positions
+
+
+def mark_to_market(trades, live_prices):
+    """
+    Calculates the USD PnL of every trade against the live prices, vectorized equivalent of
+    PnLCalculator.usd_pnl_by_trade.
+
+    Args:
+        trades (pd.DataFrame): Processed trades.
+        live_prices (dict): Live prices by instrument name and by currency.
+
+    Returns:
+        usd_pnl (pd.Series): USD PnL of each trade.
+        usd_pnl_including_fees (pd.Series): USD PnL net of fees.
+        usd_fees (pd.Series): USD fees.
+    """
+    instrument_price = trades['instrument_name'].map(live_prices).astype(float)
+    ccy_price = trades['currency'].map(live_prices).astype(float)
+    is_option = trades['trade_type'] == 'option'
+    is_future = trades['trade_type'] == 'future'
+
+    option_pnl = instrument_price * ccy_price - trades['price'] * trades['index_price']
+    future_pnl = instrument_price - trades['price']
+    usd_pnl = option_pnl.where(is_option, future_pnl.where(is_future)) * trades['amount']
+    usd_pnl = usd_pnl.where(trades['direction'] == 'buy', -usd_pnl)
+
+    usd_fees = trades['commission'] * trades['index_price']
+    return usd_pnl, usd_pnl - usd_fees, usd_fees
@@ -0,0 +1,149 @@
+import asyncio
+import threading
+import time
+
+from deribit_api_wrapper import DeribitApiWrapper
+from utils import *
+
+
+class PriceFeed():
+    def __init__(self, config, account=None) -> None:
+        """
+        Initializes the PriceFeed, which keeps the mark prices of instruments and the index prices of
+        currencies up to date from ticker and price index subscriptions.
+
+        The feed runs its own event loop in a background thread with its own DeribitApiWrapper session,
+        the cached prices can be read from any thread.
+
+        Args:
+            config (dict): Configuration with the 'deribit' credentials and client url.
+            account (dict): Account of the session, whose trades track_live_positions receives.
+                            Defaults to the first account of the config.
+        """
+        self.logger = set_logger(name=__name__, log_file='price_feed.log', log_level='INFO')
+
+        self.deribit_wrapper = DeribitApiWrapper(config, account)
+        self.ticker_interval = config['deribit'].get('ticker_interval', '100ms')
+        self.prices = {}
+        self.updated_at = {}
+        self._listeners = []
+        self._channels = set()
+        self._loop = None
+        self._thread = None
+
+    def start(self):
+        """
+        Starts the event loop of the feed in a daemon thread.
+        """
+        if self._thread is not None:
+            return
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name='price_feed', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Closes the subscriptions and stops the event loop.
+        """
+        if self._thread is None:
+            return
+        asyncio.run_coroutine_threadsafe(self.deribit_wrapper.close(), self._loop).result(timeout=10)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=10)
+        self._thread = None
+
+    def add_listener(self, listener):
+        """
+        Registers a function called on the feed thread with (name, price) for every price update.
+
+        Args:
+            listener (callable): Function called with the instrument name or currency code and its price.
+        """
+        self._listeners.append(listener)
+
+    def run_coroutine(self, coroutine):
+        """
+        Runs a coroutine on the feed event loop, e.g. to subscribe to more channels on its session.
+
+        Args:
+            coroutine: Coroutine to run.
+
+        Returns:
+            future (concurrent.futures.Future): Result of the coroutine.
+        """
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
+
+    def _on_ticker(self, channel, data):
+        self.prices[data['instrument_name']] = data['mark_price']
+        self.updated_at[data['instrument_name']] = data['timestamp']
+        for listener in self._listeners:
+            listener(data['instrument_name'], data['mark_price'])
+
+    def _on_price_index(self, channel, data):
+        ccy = data['index_name'].split('_')[0].upper()
+        self.prices[ccy] = data['price']
+        self.updated_at[ccy] = data['timestamp']
+        for listener in self._listeners:
+            listener(ccy, data['price'])
+
+    async def _subscribe(self, instruments, currencies):
+        ticker_channels = [f"ticker.{instrument}.{self.ticker_interval}" for instrument in instruments]
+        index_channels = [f"deribit_price_index.{ccy.lower()}_usd" for ccy in currencies]
+        ticker_channels = [channel for channel in ticker_channels if channel not in self._channels]
+        index_channels = [channel for channel in index_channels if channel not in self._channels]
+        self._channels.update(ticker_channels + index_channels)
+
+        try:
+            if ticker_channels:
+                await self.deribit_wrapper.subscribe(ticker_channels, self._on_ticker)
+            if index_channels:
+                await self.deribit_wrapper.subscribe(index_channels, self._on_price_index)
+        except Exception as e:
+            # the next track() call retries them
+            self._channels.difference_update(ticker_channels + index_channels)
+            self.logger.error(f"Subscription failed: {e}")
+            raise
+        if ticker_channels or index_channels:
+            self.logger.info(f"Subscribed to {len(ticker_channels) + len(index_channels)} channels")
+
+    def track(self, instruments, currencies):
+        """
+        Subscribes to the instruments and currencies not tracked yet, without blocking.
+
+        Args:
+            instruments (list): Names of the instruments.
+            currencies (list): Currency codes.
+
+        Returns:
+            future (concurrent.futures.Future): Completed once the subscriptions are confirmed.
+        """
+        return self.run_coroutine(self._subscribe(list(instruments), list(currencies)))
+
+    async def wait_for_prices(self, names, timeout):
+        """
+        Waits until prices are cached for all the names, or the timeout expires.
+
+        Args:
+            names (list): Instrument names and currency codes.
+            timeout (float): Maximum wait in seconds.
+
+        Returns:
+            prices (dict): Cached prices of the names received so far.
+        """
+        deadline = time.monotonic() + timeout
+        while any(name not in self.prices for name in names) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return self.get_prices(names)
+
+    def get_prices(self, names):
+        """
+        Returns the cached prices of the names received so far.
+
+        Args:
+            names (list): Instrument names and currency codes.
+
+        Returns:
+            prices (dict): Price by name, names without price yet are omitted.
+        """
+        return {name: self.prices[name] for name in names if name in self.prices}
@@ -0,0 +1,88 @@
+import asyncio
+import threading
+import time
+
+# credit buckets by account and engine, shared by all the sessions of an account in the process
+_account_buckets = {}
+_account_buckets_lock = threading.Lock()
+
+
+class TokenBucket():
+    def __init__(self, max_credits, refill_rate) -> None:
+        """
+        Initializes a credit bucket following Deribit's rate limit model: every request costs credits,
+        the bucket holds at most max_credits and refills at refill_rate credits per second.
+
+        The refill rate is halved when Deribit rejects a request for exceeding its limits, and
+        recovers gradually with successful requests.
+
+        Args:
+            max_credits (float): Capacity of the bucket, i.e. the allowed burst.
+            refill_rate (float): Credits added per second.
+        """
+        self.max_credits = max_credits
+        self.max_refill_rate = refill_rate
+        self.refill_rate = refill_rate
+        self.credits = max_credits
+        self._updated_at = time.monotonic()
+        # the sessions of an account share the bucket from their own event loop threads
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.credits = min(self.max_credits, self.credits + (now - self._updated_at) * self.refill_rate)
+        self._updated_at = now
+
+    async def acquire(self, cost):
+        """
+        Waits until the bucket holds enough credits for a request and consumes them.
+
+        Args:
+            cost (float): Credits consumed by the request.
+        """
+        while True:
+            with self._lock:
+                self._refill()
+                if self.credits >= cost:
+                    self.credits -= cost
+                    return
+                wait = (cost - self.credits) / self.refill_rate
+            await asyncio.sleep(wait)
+
+    def throttle(self):
+        """
+        Empties the bucket and halves the refill rate, down to a tenth of the configured rate.
+        """
+        with self._lock:
+            self._refill()
+            self.credits = 0
+            self.refill_rate = max(self.max_refill_rate / 10, self.refill_rate / 2)
+
+    def recover(self):
+        """
+        Raises the refill rate back towards the configured rate by a twentieth of it.
+        """
+        with self._lock:
+            if self.refill_rate < self.max_refill_rate:
+                self.refill_rate = min(self.max_refill_rate, self.refill_rate + self.max_refill_rate / 20)
+
+
+def account_rate_limiters(account_key, rate_limits):
+    """
+    Returns the credit buckets of an account, one per engine, created by the first session of the account.
+    Deribit counts the credits per account, so the sessions of an account (e.g. the price feed and the
+    requests of the app) spend the same credits and back off together.
+
+    Args:
+        account_key (tuple): Identity of the account, e.g. the client url and client_id.
+        rate_limits (dict): 'max_credits' and 'refill_rate' by engine, used when the buckets are created.
+
+    Returns:
+        rate_limiters (dict): TokenBucket by engine.
+    """
+    with _account_buckets_lock:
+        buckets = _account_buckets.setdefault(account_key, {})
+        for engine, limits in rate_limits.items():
+            if engine not in buckets:
+                buckets[engine] = TokenBucket(limits['max_credits'], limits['refill_rate'])
+        return {engine: buckets[engine] for engine in rate_limits}
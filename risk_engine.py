@@ -0,0 +1,164 @@
+import numpy as np
+import pandas as pd
+
+from position_engine import DAY_MS
+
+YEAR_MS = 365 * DAY_MS
+# sensitivities of the option positions: delta in underlying units, gamma in underlying units per USD,
+# vega in USD per volatility point and theta in USD per day
+GREEK_COLUMNS = ['delta', 'gamma', 'vega', 'theta']
+# Newton steps of the implied volatilities, their target and the tolerance on the repriced options, as shares
+# of the forward
+IV_ITERATIONS = 20
+IV_PRECISION = 1e-10
+IV_TOLERANCE = 1e-6
+MAX_IV = 20.0
+
+# coefficients of the rational approximation of erf, Abramowitz and Stegun 7.1.26, absolute error below 1.5e-7
+_ERF_P = 0.3275911
+_ERF_A = (0.254829592, -0.284496736, 1.421413741, -1.453152027, 1.061405429)
+
+
+def norm_cdf(x):
+    """
+    Returns the standard normal cumulative distribution of an array, without scipy.
+
+    Args:
+        x (np.ndarray): Values.
+
+    Returns:
+        cdf (np.ndarray): N(x), within 1e-7.
+    """
+    z = np.abs(x) / np.sqrt(2.0)
+    t = 1.0 / (1.0 + _ERF_P * z)
+    polynomial = t * (_ERF_A[0] + t * (_ERF_A[1] + t * (_ERF_A[2] + t * (_ERF_A[3] + t * _ERF_A[4]))))
+    erf = 1.0 - polynomial * np.exp(-z * z)
+    return 0.5 * (1.0 + np.sign(x) * erf)
+
+
+def norm_pdf(x):
+    return np.exp(-0.5 * x * x) / np.sqrt(2.0 * np.pi)
+
+
+def black76(forward, strike, time_to_expiry, vol, is_call):
+    """
+    Prices options on a forward and computes their Greeks with the Black-76 model, in one pass over arrays.
+    The rates are zero, Deribit options are margined like futures.
+
+    Args:
+        forward (np.ndarray): Forward prices of the underlying in USD.
+        strike (np.ndarray): Strikes in USD.
+        time_to_expiry (np.ndarray): Times to expiry in years.
+        vol (np.ndarray): Volatilities, 0.5 for 50%.
+        is_call (np.ndarray): True for the calls, False for the puts.
+
+    Returns:
+        greeks (dict): USD 'price' and GREEK_COLUMNS of one option by name, arrays aligned on the inputs.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        vol_sqrt_t = vol * np.sqrt(time_to_expiry)
+        d1 = (np.log(forward / strike) + 0.5 * vol_sqrt_t * vol_sqrt_t) / vol_sqrt_t
+        d2 = d1 - vol_sqrt_t
+        pdf_d1 = norm_pdf(d1)
+        call_delta = norm_cdf(d1)
+        call_price = forward * call_delta - strike * norm_cdf(d2)
+        return {'price': np.where(is_call, call_price, call_price - forward + strike),
+                'delta': np.where(is_call, call_delta, call_delta - 1.0),
+                'gamma': pdf_d1 / (forward * vol_sqrt_t),
+                'vega': forward * pdf_d1 * np.sqrt(time_to_expiry) / 100.0,
+                'theta': -forward * pdf_d1 * vol / (2.0 * np.sqrt(time_to_expiry)) / 365.0}
+
+
+def _price_vega(forward, strike, time_to_expiry, vol, is_call):
+    """
+    Returns the Black-76 prices and the vegas per unit of volatility, the only outputs the Newton steps need.
+    """
+    sqrt_t = np.sqrt(time_to_expiry)
+    vol_sqrt_t = vol * sqrt_t
+    d1 = (np.log(forward / strike) + 0.5 * vol_sqrt_t * vol_sqrt_t) / vol_sqrt_t
+    call_price = forward * norm_cdf(d1) - strike * norm_cdf(d1 - vol_sqrt_t)
+    return np.where(is_call, call_price, call_price - forward + strike), forward * norm_pdf(d1) * sqrt_t
+
+
+def implied_vols(price, forward, strike, time_to_expiry, is_call):
+    """
+    Computes the Black-76 implied volatilities of option prices with vectorized Newton steps. Started
+    from the inflection point of the price in volatility, the steps converge monotonically.
+
+    Args:
+        price (np.ndarray): USD prices of the options.
+        forward, strike, time_to_expiry, is_call (np.ndarray): See black76.
+
+    Returns:
+        vols (np.ndarray): Implied volatilities, NaN for the prices outside of the no-arbitrage bounds
+                           or not converged.
+    """
+    intrinsic = np.maximum(np.where(is_call, forward - strike, strike - forward), 0.0)
+    upper_bound = np.where(is_call, forward, strike)
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        valid = (price > intrinsic) & (price < upper_bound) & (time_to_expiry > 0)
+        price, forward, strike, time_to_expiry, is_call = (np.asarray(array)[valid] for array in
+                                                           (price, forward, strike, time_to_expiry, is_call))
+        vol = np.clip(np.sqrt(2.0 * np.abs(np.log(forward / strike)) / time_to_expiry), 1e-3, MAX_IV)
+        # only the options not converged yet take the next step, the short dated wings need the most
+        active = np.arange(len(price))
+        for _ in range(IV_ITERATIONS):
+            model_price, vega = _price_vega(forward[active], strike[active], time_to_expiry[active], vol[active], is_call[active])
+            error = model_price - price[active]
+            pending = np.abs(error) > IV_PRECISION * forward[active]
+            active, error, vega = active[pending], error[pending], vega[pending]
+            if not len(active):
+                break
+            # the prices without time value have no vega, any volatility reprices them
+            vol[active] = np.clip(vol[active] - np.nan_to_num(error / vega), 1e-4, MAX_IV)
+        converged = np.abs(_price_vega(forward, strike, time_to_expiry, vol, is_call)[0] - price) <= IV_TOLERANCE * forward
+    vols = np.full(len(valid), np.nan)
+    vols[valid] = np.where(converged, vol, np.nan)
+    return vols
+
+
+def option_greeks(book, live_prices, now_ms):
+    """
+    Computes the Greeks of the option positions from the live prices. The live index stands for the
+    forward, the volatilities are implied from the live mark prices, or are the median implied volatility
+    of the expiry for the marks without time value.
+
+    Args:
+        book (pd.DataFrame): Open option positions indexed by instrument_name, with 'currency', 'expiry'
+                             (datetime, UTC), 'strike', 'cp' and the net 'position'.
+        live_prices (dict): Live prices by instrument name and by currency.
+        now_ms (int): Valuation time in unix ms.
+
+    Returns:
+        greeks (pd.DataFrame): The book with 'forward', 'iv', 'usd_mark' and GREEK_COLUMNS of the positions.
+    """
+    # dict lookups, a price update should not rebuild a Series of all the live prices
+    forward = np.array([live_prices.get(ccy, np.nan) for ccy in book['currency']], dtype=float)
+    usd_mark = np.array([live_prices.get(name, np.nan) for name in book.index], dtype=float) * forward
+    strike = book['strike'].to_numpy(dtype=float)
+    expiry_ms = book['expiry'].to_numpy(dtype='datetime64[ms]').astype('int64')
+    time_to_expiry = np.maximum(expiry_ms - now_ms, 0) / YEAR_MS
+    is_call = (book['cp'] == 'C').to_numpy()
+
+    vol = implied_vols(usd_mark, forward, strike, time_to_expiry, is_call)
+    if np.isnan(vol).any():
+        # a mark without time value, e.g. deep in the money, takes the median volatility of its expiry
+        vol = pd.Series(vol).fillna(pd.Series(vol).groupby([book['currency'].to_numpy(), expiry_ms]).transform('median')).to_numpy()
+    greeks = black76(forward, strike, time_to_expiry, vol, is_call)
+    position = book['position'].to_numpy(dtype=float)
+    return book.assign(forward=forward, iv=vol, usd_mark=usd_mark,
+                       **{column: greeks[column] * position for column in GREEK_COLUMNS})
+
+
+def aggregate_greeks(greeks, by=('currency', 'expiry', 'strike')):
+    """
+    Sums the Greeks of the option positions by group.
+
+    Args:
+        greeks (pd.DataFrame): Greeks of the positions, see option_greeks.
+        by (tuple): Grouping columns.
+
+    Returns:
+        risk (pd.DataFrame): GREEK_COLUMNS and the net 'position' by group.
+    """
+    return greeks.groupby(list(by), observed=True, sort=True)[['position'] + GREEK_COLUMNS].sum(min_count=1)
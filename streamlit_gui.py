@@ -1,12 +1,255 @@
 import streamlit as st
 import pandas as pd
+from accounts import load_accounts
 from deribit_api_wrapper import DeribitApiWrapper
-from db_wrapper import DBWrapper
+from db_wrapper import DBWrapper, concat_trade_logs
 from pnl_calc import PnLCalculator
+from price_feed import PriceFeed
+from risk_engine import GREEK_COLUMNS, aggregate_greeks
+from tracing import LATENCY_BUCKETS_MS, tracer
 from utils import *
 import asyncio
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import timedelta
 
+# seconds before the transaction logs are synced again with Deribit
+SYNC_TTL = 60
+# seconds before the live prices are read again from the price feed
+PRICE_TTL = 5
+# account selection showing the consolidated PnL of all the accounts
+ALL_ACCOUNTS = 'All accounts'
+
+
+@st.cache_resource
+def get_wrappers(account):
+    """
+    Creates the DB and API wrappers of an account once per process, they are shared by all sessions
+    and reruns. The lock serializes the use of the shared SQLite connection and websocket session.
+    """
+    db_wrapper = DBWrapper(config['db_path'], check_same_thread=False, account=account)
+    deribit_wrapper = DeribitApiWrapper(config, next(item for item in get_accounts(config) if item['name'] == account))
+    return db_wrapper, deribit_wrapper, threading.Lock()
+
+
+@st.cache_resource
+def get_price_feed(account):
+    """
+    Starts the streaming price feed of an account once per process, its session receives the fills of
+    the account.
+    """
+    price_feed = PriceFeed(config, next(item for item in get_accounts(config) if item['name'] == account))
+    price_feed.start()
+    return price_feed
+
+
+def get_pnl_calculator(account, start_range, end_range, trades=None, opening_positions=None):
+    """
+    Creates a PnLCalculator on the shared wrappers of an account, loading the trades from DB without
+    syncing when they are not given.
+    """
+    db_wrapper, deribit_wrapper, wrappers_lock = get_wrappers(account)
+    with wrappers_lock:
+        return PnLCalculator(config,
+                             db_wrapper=db_wrapper,
+                             deribit_wrapper=deribit_wrapper,
+                             start_range=start_range,
+                             end_range=end_range,
+                             sync_on_load=False,
+                             trades=trades,
+                             price_feed=get_price_feed(account),
+                             opening_positions=opening_positions)
+
+
+@st.cache_data(ttl=SYNC_TTL, show_spinner="Syncing transaction logs...")
+def sync_transactions(start_range):
+    """
+    Syncs the transaction logs and extends the position snapshots of all the accounts concurrently,
+    and returns the sync checkpoints, used as the version of the DB content.
+    """
+    def sync_account(account, pnl_calc):
+        db_wrapper, _, wrappers_lock = get_wrappers(account)
+        with wrappers_lock:
+            pnl_calc.sync_transactions()
+            return tuple((account, ccy, tuple(checkpoint.values())) for ccy, checkpoint in db_wrapper.get_sync_checkpoints().items())
+
+    # the cached wrappers are created by the script thread, the accounts sync on their own connections
+    pnl_calcs = {account: get_pnl_calculator(account, start_range, None, trades=pd.DataFrame()) for account in get_account_names()}
+    with ThreadPoolExecutor(max_workers=len(pnl_calcs)) as executor:
+        return sum(executor.map(sync_account, pnl_calcs.keys(), pnl_calcs.values()), ())
+
+
+@st.cache_resource
+def get_process_pool():
+    """
+    Creates the pool of processes loading the accounts once per process. The workers are spawned, a fork
+    would copy the threads of the price feeds and API sessions in an unknown state.
+    """
+    return ProcessPoolExecutor(max_workers=min(os.cpu_count(), len(get_account_names())),
+                               mp_context=multiprocessing.get_context('spawn'))
+
+
+@st.cache_data(show_spinner="Loading trades and opening positions...")
+def load_account_data(start_range, end_range, sync_version):
+    """
+    Loads the processed trades and the opening positions of the range of all the accounts, one process
+    per account, cached until the DB content changes.
+    """
+    return load_accounts(config, start_range, end_range, executor=get_process_pool())
+
+
+def load_trades(account, start_range, end_range, sync_version):
+    return load_account_data(start_range, end_range, sync_version)[account][0]
+
+
+def load_opening_positions(account, start_range, end_range, sync_version):
+    return load_account_data(start_range, end_range, sync_version)[account][1]
+
+
+@st.cache_data(ttl=PRICE_TTL, show_spinner="Fetching live prices...")
+def fetch_live_prices(account, start_range, end_range, sync_version):
+    """
+    Fetches the live prices of the instruments traded in the range.
+
+    Returns:
+        live_prices (dict): Live prices by instrument name and by currency.
+        fetched_at (float): Time of the fetch, used as the version of the prices.
+    """
+    pnl_calc = get_pnl_calculator(account, start_range, end_range, trades=load_trades(account, start_range, end_range, sync_version),
+                                  opening_positions=load_opening_positions(account, start_range, end_range, sync_version))
+    with get_wrappers(account)[2]:
+        pnl_calc.deribit_wrapper.run(pnl_calc.update_live_prices())
+    return pnl_calc.instrument_live_prices, time.time()
+
+
+@st.cache_data(show_spinner="Calculating PnL...")
+def calculate_pnl(account, start_range, end_range, sync_version, prices_fetched_at, _live_prices):
+    """
+    Reprices the trades, cached for a given DB content and price fetch.
+    """
+    pnl_calc = get_pnl_calculator(account, start_range, end_range, trades=load_trades(account, start_range, end_range, sync_version),
+                                  opening_positions=load_opening_positions(account, start_range, end_range, sync_version))
+    pnl_calc.instrument_live_prices = _live_prices
+    pnl_calc.reprice_trades()
+    return pnl_calc._get_trades()
+
+
+@st.cache_resource(show_spinner="Tracking live positions...")
+def track_positions(account, start_range, end_range, _sync_version):
+    """
+    Builds the live positions of the range once per process from the first loaded trades, and tracks them on
+    the price feed of the account. The price ticks, and the fills of user.trades for a range running up to now,
+    update them between the refreshes.
+    """
+    pnl_calc = get_pnl_calculator(account, start_range, end_range, trades=load_trades(account, start_range, end_range, _sync_version),
+                                  opening_positions=load_opening_positions(account, start_range, end_range, _sync_version))
+    with get_wrappers(account)[2]:
+        pnl_calc.track_live_positions()
+    return pnl_calc.live_positions
+
+
+def live_positions(account, start_range, end_range, sync_version, live_prices):
+    """
+    Returns the positions of the range from the live positions, brought up to date with the fills synced
+    since the last refresh and the fetched prices of the names the price feed does not stream, e.g. the
+    settlement prices. Only the fills since the last one and the instruments whose price changed are processed.
+    """
+    positions = track_positions(account, start_range, end_range, sync_version)
+    trades = load_trades(account, start_range, end_range, sync_version)
+    if positions.last_timestamp is not None:
+        # the fills applied already are skipped by trade_id
+        trades = trades[trades['timestamp'] >= positions.last_timestamp]
+    positions.apply_trades(trades)
+    streamed_prices = get_price_feed(account).prices
+    positions.update_prices({name: price for name, price in live_prices.items() if name not in streamed_prices})
+    return positions.to_frame()
+
+
+@st.cache_data(show_spinner="Calculating PnL time series...")
+def pnl_series(account, start_range, end_range, sync_version, prices_fetched_at, bucket):
+    """
+    Calculates the mark-to-market PnL at the end of each bucket of the range, the historical prices are
+    fetched once and stored in DB.
+    """
+    pnl_calc = get_pnl_calculator(account, start_range, end_range, trades=load_trades(account, start_range, end_range, sync_version),
+                                  opening_positions=load_opening_positions(account, start_range, end_range, sync_version))
+    with get_wrappers(account)[2]:
+        return pnl_calc.pnl_time_series(bucket)
+
+
+@st.cache_data(show_spinner="Loading option positions...")
+def load_option_book(account, start_range, end_range, sync_version):
+    """
+    Loads the option positions open at the end of the range, cached until the DB content changes.
+    """
+    pnl_calc = get_pnl_calculator(account, start_range, end_range, trades=load_trades(account, start_range, end_range, sync_version),
+                                  opening_positions=load_opening_positions(account, start_range, end_range, sync_version))
+    with get_wrappers(account)[2]:
+        return pnl_calc.option_book()
+
+
+@st.cache_data(show_spinner="Calculating Greeks...")
+def calculate_risk(account, start_range, end_range, sync_version, prices_fetched_at, _live_prices):
+    """
+    Calculates the Greeks of the option positions, cached for a given DB content and price fetch.
+    """
+    pnl_calc = get_pnl_calculator(account, start_range, end_range, trades=pd.DataFrame(), opening_positions=pd.DataFrame())
+    pnl_calc.instrument_live_prices = _live_prices
+    return pnl_calc.calculate_greeks(load_option_book(account, start_range, end_range, sync_version))
+
+
+def get_account_names():
+    return [account['name'] for account in get_accounts(config)]
+
+
+def account_pnl(account, start_range, end_range, sync_version):
+    """
+    Returns the positions and the trades with their PnL of an account, with an 'account' column.
+    """
+    live_prices, prices_fetched_at = fetch_live_prices(account, start_range, end_range, sync_version)
+    trades = calculate_pnl(account, start_range, end_range, sync_version, prices_fetched_at, live_prices)
+    positions = live_positions(account, start_range, end_range, sync_version, live_prices)
+    return positions.assign(account=account), trades.assign(account=account)
+
+
+def account_risk(account, start_range, end_range, sync_version):
+    """
+    Returns the Greeks of the option positions of an account, with an 'account' column.
+    """
+    live_prices, prices_fetched_at = fetch_live_prices(account, start_range, end_range, sync_version)
+    return calculate_risk(account, start_range, end_range, sync_version, prices_fetched_at, live_prices).assign(account=account)
+
+
+def diagnostics_panel():
+    """
+    Shows the stage timings, API latencies and counters recorded by the tracer since the last reset.
+    Cached results are not recomputed, so only the stages run by cache misses appear.
+    """
+    with st.expander("Diagnostics"):
+        snapshot = tracer.snapshot()
+        st.write("Stages:")
+        st.dataframe(pd.DataFrame([{'stage': name, 'calls': stats['count'],
+                                    'total (ms)': stats['total_s'] * 1000,
+                                    'mean (ms)': stats['total_s'] * 1000 / stats['count'],
+                                    'max (ms)': stats['max_s'] * 1000,
+                                    'last (ms)': stats['last_s'] * 1000}
+                                   for name, stats in sorted(snapshot['spans'].items())]))
+
+        st.write("API latency histograms (requests by latency bucket):")
+        bucket_labels = [f"<= {bound} ms" for bound in LATENCY_BUCKETS_MS] + [f"> {LATENCY_BUCKETS_MS[-1]} ms"]
+        st.dataframe(pd.DataFrame([{'method': method, 'requests': histogram['count'],
+                                    'mean (ms)': histogram['total_s'] * 1000 / histogram['count'],
+                                    **dict(zip(bucket_labels, histogram['buckets']))}
+                                   for method, histogram in sorted(snapshot['latencies'].items())]))
+
+        st.write("Counters:")
+        st.dataframe(pd.Series(snapshot['counters'], name='value', dtype='int64').sort_index())
+        st.button("Reset diagnostics", on_click=tracer.reset)
+
+
 def main():
     st.title("Deribit PnL calculator")
 
@@ -15,43 +258,71 @@ def main():
     date_range = st.date_input(
         "Date range for pnl calculations",
         (start, end),
-        end - timedelta(weeks=52),
+        min(start, end - timedelta(weeks=52)),
         end
     )
-    
+
+    account_names = get_account_names()
+    selected_account = st.selectbox("Account", account_names + [ALL_ACCOUNTS] if len(account_names) > 1 else account_names)
+    accounts = account_names if selected_account == ALL_ACCOUNTS else [selected_account]
+    summary_index = 'account' if selected_account == ALL_ACCOUNTS else 'currency'
+
     if len(date_range) > 1:
         start_range = datetime.combine(date_range[0], datetime.min.time())
         end_range = datetime.combine(date_range[1], datetime.min.time())
-        pnl_calc = PnLCalculator(config,
-                             db_wrapper=db_wrapper,
-                             deribit_wrapper=deribit_wrapper,
-                             start_range=start_range,
-                             end_range=end_range)
-        positions = pnl_calc.update_pnl()
-        raw_data_with_pnl = pnl_calc._get_trades()
-        
+        sync_version = sync_transactions(start_range)
+        results = [account_pnl(account, start_range, end_range, sync_version) for account in accounts]
+        positions = concat_trade_logs([positions for positions, _ in results])
+        raw_data_with_pnl = concat_trade_logs([trades for _, trades in results])
+
         # filtered_data = raw_data_with_pnl[(raw_data_with_pnl['datetime'] >= datetime.combine(date_range[0], datetime.min.time())) \
         #                                   & (raw_data_with_pnl['datetime'] <= datetime.combine(date_range[1], datetime.min.time()))]
 
         col1, col2 = st.columns(2)
         with col1:
             st.write("PnL summary:")
-            st.dataframe(raw_data_with_pnl.pivot_table(index='currency', values=['usd_pnl', 'usd_pnl_including_fees', 'usd_fees'], aggfunc=sum, margins=True))
+            st.dataframe(raw_data_with_pnl.pivot_table(index=summary_index, values=['usd_pnl', 'usd_pnl_including_fees', 'usd_fees'], aggfunc='sum', margins=True, observed=True))
 
         with col2:
             st.write("PnL realized/unrealized")
-            st.dataframe(positions.pivot_table(index='currency', values=['realized_pl', 'unrealized_pl'], aggfunc=sum, margins=True))
+            st.dataframe(positions.pivot_table(index=summary_index, values=['realized_pl', 'unrealized_pl'], aggfunc='sum', margins=True, observed=True))
+
+        greeks = pd.concat([account_risk(account, start_range, end_range, sync_version) for account in accounts])
+        # the Greeks are in the units of each underlying, they are only summed within a currency
+        risk_index = ['account', 'currency'] if selected_account == ALL_ACCOUNTS else ['currency']
+        col3, col4 = st.columns(2)
+        with col3:
+            st.write("Greeks:")
+            st.dataframe(aggregate_greeks(greeks, risk_index)[GREEK_COLUMNS])
+
+        with col4:
+            st.write("Greeks by expiry:")
+            st.dataframe(aggregate_greeks(greeks, ('currency', 'expiry'))[GREEK_COLUMNS])
+
+        st.write("Greeks by strike:")
+        st.dataframe(aggregate_greeks(greeks, ('currency', 'expiry', 'strike')))
 
         st.write("PnL by instrument:")
-        st.dataframe(raw_data_with_pnl.pivot_table(index='instrument_name', values=['usd_pnl', 'usd_pnl_including_fees', 'usd_fees'], columns='currency', aggfunc=sum, margins=True))
+        st.dataframe(raw_data_with_pnl.pivot_table(index='instrument_name', values=['usd_pnl', 'usd_pnl_including_fees', 'usd_fees'], columns='currency', aggfunc='sum', margins=True, observed=True))
+
+        st.write("PnL over time:")
+        bucket = st.selectbox("Bucket", ['day', 'hour'])
+        series = pd.concat([pnl_series(account, start_range, end_range, sync_version,
+                                       fetch_live_prices(account, start_range, end_range, sync_version)[1], bucket)
+                            for account in accounts])\
+                   .groupby('datetime')[['realized_pl', 'unrealized_pl', 'total_pl', 'pnl']].sum(min_count=len(accounts))
+        st.line_chart(series[['total_pl', 'realized_pl', 'unrealized_pl']])
+        st.bar_chart(series['pnl'])
+
+        # only the price layer is invalidated, the trades stay cached
+        st.button("Refresh PnL", on_click=fetch_live_prices.clear)
 
-        if st.button("Refresh PnL"):
-            pnl_calc.update_pnl()
+    if tracer.enabled:
+        diagnostics_panel()
 
 if __name__ == "__main__":
     config = read_json('config.json')
-    db_wrapper = DBWrapper(config['db_path'])
-    deribit_wrapper = DeribitApiWrapper(config)
+    tracer.configure(config.get('tracing', False))
 
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
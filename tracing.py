@@ -0,0 +1,171 @@
+import asyncio
+import bisect
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+from utils import *
+
+# upper bounds in ms of the API latency histogram buckets, the last bucket is unbounded
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000]
+
+
+class _NoSpan():
+    """
+    Context manager returned by Tracer.span when tracing is disabled.
+    """
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class Tracer():
+    def __init__(self) -> None:
+        """
+        Initializes the Tracer, which times the stages of the PnL calculation, keeps API latency
+        histograms and request, byte and row counters, and writes every span to the log as a
+        structured record.
+
+        The tracer is disabled by default: spans are a shared no-op context manager and the
+        instrumented code checks `enabled` before measuring anything.
+        """
+        self.enabled = False
+        self.logger = None
+        self._lock = threading.Lock()
+        self.reset()
+
+    def configure(self, enabled):
+        """
+        Enables or disables the tracer.
+
+        Args:
+            enabled (bool): Whether spans, latencies and counters are recorded.
+        """
+        if enabled and self.logger is None:
+            self.logger = set_logger(name=__name__, log_file='tracing.log', log_level='INFO')
+        self.enabled = enabled
+
+    def reset(self):
+        """
+        Clears the recorded spans, latencies and counters.
+        """
+        with self._lock:
+            self.spans = {}
+            self.latencies = {}
+            self.counters = {}
+
+    def span(self, name, **fields):
+        """
+        Times a stage.
+
+        Args:
+            name (str): Name of the stage, e.g. 'pnl.load_trades'.
+            **fields: Extra fields of the structured log record.
+
+        Returns:
+            span: Context manager timing its block, a no-op when the tracer is disabled.
+        """
+        if not self.enabled:
+            return _NO_SPAN
+        return self._span(name, fields)
+
+    @contextmanager
+    def _span(self, name, fields):
+        start = time.perf_counter()
+        status = 'ok'
+        try:
+            yield fields
+        except BaseException:
+            status = 'error'
+            raise
+        finally:
+            duration = time.perf_counter() - start
+            with self._lock:
+                stats = self.spans.setdefault(name, {'count': 0, 'total_s': 0.0, 'max_s': 0.0, 'last_s': 0.0})
+                stats['count'] += 1
+                stats['total_s'] += duration
+                stats['max_s'] = max(stats['max_s'], duration)
+                stats['last_s'] = duration
+            self.logger.info('TRACE ' + json.dumps({'span': name, 'duration_ms': round(duration * 1000, 3),
+                                                    'status': status, **fields}, default=str))
+
+    def record_latency(self, method, seconds):
+        """
+        Adds a request latency to the histogram of its API method.
+
+        Args:
+            method (str): JSON-RPC method.
+            seconds (float): Time between the request and its response.
+        """
+        with self._lock:
+            histogram = self.latencies.get(method)
+            if histogram is None:
+                histogram = self.latencies[method] = {'count': 0, 'total_s': 0.0, 'buckets': [0] * (len(LATENCY_BUCKETS_MS) + 1)}
+            histogram['count'] += 1
+            histogram['total_s'] += seconds
+            histogram['buckets'][bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def count(self, name, value=1):
+        """
+        Increments a counter.
+
+        Args:
+            name (str): Name of the counter, e.g. 'api.bytes_received'.
+            value (int): Increment.
+        """
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def snapshot(self):
+        """
+        Returns a copy of the recorded spans, latencies and counters.
+
+        Returns:
+            snapshot (dict): 'spans', 'latencies' and 'counters'.
+        """
+        with self._lock:
+            return {
+                'spans': {name: dict(stats) for name, stats in self.spans.items()},
+                'latencies': {method: {**histogram, 'buckets': list(histogram['buckets'])}
+                              for method, histogram in self.latencies.items()},
+                'counters': dict(self.counters),
+            }
+
+
+tracer = Tracer()
+
+
+def traced(name):
+    """
+    Decorator timing every call of a function or coroutine function as a span of the tracer.
+
+    Args:
+        name (str): Name of the span.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not tracer.enabled:
+                    return await func(*args, **kwargs)
+                with tracer.span(name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,199 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from deribit_api_wrapper import DeribitApiWrapper
+from db_wrapper import DBWrapper
+from db_writer import DBWriter
+from tracing import traced
+from utils import *
+
+# shortest slice of time fetched on its own by the concurrent page chains of a window
+MIN_SLICE_MS = 24 * 3600 * 1000
+
+
+class TransactionLogSync():
+    def __init__(self, config,
+                       deribit_wrapper:DeribitApiWrapper,
+                       db_wrapper:DBWrapper) -> None:
+        """
+        Initializes the TransactionLogSync, which keeps the transaction_logs table up to date
+        with Deribit using a per currency checkpoint.
+
+        The currencies and the slices of long windows are fetched concurrently, the parsed pages go
+        through a bounded queue to a writer thread owning its own SQLite connection.
+
+        Args:
+            config (dict): Configuration with the 'deribit' currencies.
+            deribit_wrapper (DeribitApiWrapper): Instance of DeribitApiWrapper.
+            db_wrapper (DBWrapper): Instance of DBWrapper.
+        """
+        self.logger = set_logger(name=__name__, log_file='transaction_sync.log', log_level='INFO')
+
+        self.currencies = config['deribit']['currencies']
+        self.page_size = config['deribit'].get('sync_page_size', 1000)
+        self.initial_history = timedelta(weeks=config['deribit'].get('sync_history_weeks', 52))
+        self.concurrency = config['deribit'].get('sync_concurrency', 4)
+        self.write_queue_size = config['deribit'].get('sync_write_queue', 16)
+        self.deribit_wrapper = deribit_wrapper
+        self.db_wrapper = db_wrapper
+
+    async def _fetch_window(self, currency, start_timestamp, end_timestamp, min_user_seq=None):
+        """
+        Fetches and queues for saving all the transaction log entries of a window. Windows longer than a day
+        are split in up to `concurrency` slices of time, whose continuation tokens are followed concurrently.
+
+        Args:
+            currency (str): Currency code.
+            start_timestamp (int): Start of the window (unix ms).
+            end_timestamp (int): End of the window (unix ms).
+            min_user_seq (int): Entries with a user_seq lower or equal are already saved and skipped.
+
+        Returns:
+            max_user_seq (int): Highest user_seq fetched, None if the window is empty.
+            rows (int): Number of entries fetched.
+        """
+        slices = max(1, min(self.concurrency, -(-(end_timestamp - start_timestamp) // MIN_SLICE_MS)))
+        bounds = [start_timestamp + (end_timestamp - start_timestamp) * i // slices for i in range(slices)] + [end_timestamp + 1]
+        results = await asyncio.gather(*[self._fetch_slice(currency, bounds[i], bounds[i + 1] - 1, min_user_seq)
+                                         for i in range(slices)])
+        max_user_seqs = [max_user_seq for max_user_seq, _ in results if max_user_seq is not None]
+        return max(max_user_seqs, default=None), sum(rows for _, rows in results)
+
+    async def _fetch_slice(self, currency, start_timestamp, end_timestamp, min_user_seq=None):
+        """
+        Fetches the pages of a slice of time following the continuation tokens, and queues them for saving.
+        """
+        continuation = None
+        max_user_seq = None
+        rows = 0
+        while True:
+            response = await self.deribit_wrapper.get_transaction_log(currency=currency,
+                                                                      count=self.page_size,
+                                                                      start_timestamp=start_timestamp,
+                                                                      end_timestamp=end_timestamp,
+                                                                      continuation=continuation)
+            if 'error' in response:
+                raise Exception(f"get_transaction_log failed for {currency}: {response['error']}")
+
+            # the entries are saved as they were parsed, the writer builds the rows
+            logs = response['result']['logs']
+            if logs:
+                max_user_seq = max(max_user_seq or 0, max(log['user_seq'] for log in logs))
+                if min_user_seq is not None:
+                    logs = [log for log in logs if log['user_seq'] > min_user_seq]
+            if logs:
+                rows += len(logs)
+                await self._writer.submit('save_records', logs, 'transaction_logs')
+
+            continuation = response['result'].get('continuation')
+            if continuation is None:
+                return max_user_seq, rows
+
+    async def sync_currency(self, currency):
+        """
+        Fetches the transaction log entries newer than the checkpoint of a currency. The checkpoint is
+        queued after the entries, it is committed with or after them.
+
+        Args:
+            currency (str): Currency code.
+
+        Returns:
+            rows (int): Number of new entries.
+        """
+        now = datetime_to_unix_ms(datetime.now())
+        checkpoint = self.db_wrapper.get_sync_checkpoint(currency)
+        if checkpoint is None:
+            checkpoint = {'last_user_seq': None,
+                          'synced_from': datetime_to_unix_ms(datetime.now() - self.initial_history),
+                          'synced_to': None}
+
+        # the window restarts on the last synced millisecond so that entries sharing it are not missed
+        start_timestamp = checkpoint['synced_to'] if checkpoint['synced_to'] is not None else checkpoint['synced_from']
+        max_user_seq, rows = await self._fetch_window(currency, start_timestamp, now,
+                                                      min_user_seq=checkpoint['last_user_seq'])
+
+        last_user_seq = max([seq for seq in (max_user_seq, checkpoint['last_user_seq']) if seq is not None], default=None)
+        await self._writer.submit('save_sync_checkpoint', currency, last_user_seq, checkpoint['synced_from'], now)
+        self.logger.info(f"{currency} synced, {rows} new transaction log entries")
+        return rows
+
+    async def backfill_currency(self, currency, start_range):
+        """
+        Fetches the transaction log entries older than the synced window of a currency.
+
+        Args:
+            currency (str): Currency code.
+            start_range (datetime): Start of the history to backfill.
+
+        Returns:
+            rows (int): Number of backfilled entries.
+        """
+        start_timestamp = datetime_to_unix_ms(start_range)
+        checkpoint = self.db_wrapper.get_sync_checkpoint(currency)
+        if checkpoint is None:
+            # nothing synced yet, the regular sync will cover the recent history
+            await self.sync_currency(currency)
+            await self._writer.flush()
+            checkpoint = self.db_wrapper.get_sync_checkpoint(currency)
+        if start_timestamp >= checkpoint['synced_from']:
+            return 0
+
+        _, rows = await self._fetch_window(currency, start_timestamp, checkpoint['synced_from'])
+        await self._writer.submit('save_sync_checkpoint', currency, checkpoint['last_user_seq'], start_timestamp, checkpoint['synced_to'])
+        self.logger.info(f"{currency} backfilled, {rows} transaction log entries")
+        return rows
+
+    async def _sync_and_backfill_currency(self, currency, start_range):
+        rows = await self.sync_currency(currency)
+        if start_range is None:
+            return rows
+        # the backfill reads the checkpoint saved by the sync
+        await self._writer.flush()
+        return rows + await self.backfill_currency(currency, start_range)
+
+    async def _run(self, coroutines):
+        """
+        Runs the coroutines of the currencies concurrently, their writes go through a single writer
+        thread which is closed, committing the remaining writes, once they complete.
+        """
+        self._writer = DBWriter(self.db_wrapper.db_path, account=self.db_wrapper.account,
+                                max_queue=self.write_queue_size)
+        self._writer.start()
+        try:
+            results = await asyncio.gather(*coroutines)
+        finally:
+            await self._writer.close()
+        return results
+
+    @traced('sync.sync')
+    async def sync(self, currencies=None, start_range=None):
+        """
+        Syncs the transaction logs of all the currencies concurrently.
+
+        Args:
+            currencies (list): Currencies to sync, defaults to the configured currencies.
+            start_range (datetime): Start of the history to backfill after the sync of each currency, no
+                                    backfill when None.
+
+        Returns:
+            rows (dict): Number of new entries by currency.
+        """
+        currencies = currencies or self.currencies
+        results = await self._run([self._sync_and_backfill_currency(ccy, start_range) for ccy in currencies])
+        return dict(zip(currencies, results))
+
+    @traced('sync.backfill')
+    async def backfill(self, start_range, currencies=None):
+        """
+        Backfills the transaction logs of all the currencies concurrently.
+
+        Args:
+            start_range (datetime): Start of the history to backfill.
+            currencies (list): Currencies to backfill, defaults to the configured currencies.
+
+        Returns:
+            rows (dict): Number of backfilled entries by currency.
+        """
+        currencies = currencies or self.currencies
+        results = await self._run([self.backfill_currency(ccy, start_range) for ccy in currencies])
+        return dict(zip(currencies, results))
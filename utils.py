@@ -1,5 +1,5 @@
 import json
-from datetime import datetime
+from datetime import datetime, timezone
 import logging
 
 def read_json(file_path):
@@ -12,6 +12,10 @@ def unix_ms_to_datetime(unix_ms):
 def datetime_to_unix_ms(dt):
     return int(dt.timestamp() * 1000)
 
+def utc_datetime_to_unix_ms(dt):
+    # naive datetimes are UTC, e.g. the instrument expiries, unlike datetime_to_unix_ms which reads them as local time
+    return datetime_to_unix_ms(dt.replace(tzinfo=timezone.utc) if dt.tzinfo is None else dt)
+
 def set_logger(name, log_file, log_level='ERROR'):
     log_levels = {'INFO':logging.INFO,
                   'WARNING':logging.WARNING,
@@ -46,4 +50,19 @@ def convert_from_deribit_date(date, as_string=True):
     else:
         return datetime.strptime(date, '%d%b%y')
     # except:
-    #     return date
\ No newline at end of file
+    #     return date
+
+# name of the account of a config holding a single client_id/client_secret
+DEFAULT_ACCOUNT = 'default'
+
+def get_accounts(config):
+    """
+    Returns the Deribit accounts of the config: the 'accounts' list of the 'deribit' section, each with
+    a 'name', 'client_id' and 'client_secret', or the single account of its client_id/client_secret.
+    """
+    deribit_config = config['deribit']
+    if 'accounts' in deribit_config:
+        return deribit_config['accounts']
+    return [{'name': DEFAULT_ACCOUNT,
+             'client_id': deribit_config['client_id'],
+             'client_secret': deribit_config['client_secret']}]